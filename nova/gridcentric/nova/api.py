@@ -16,6 +16,10 @@
 
 """Handles all requests relating to GridCentric functionality."""
 import random
+import re
+
+from eventlet import greenpool
+from eventlet import greenthread
 
 from nova import compute
 from nova.compute import task_states
@@ -25,18 +29,94 @@ from nova.db import base
 from nova import quota
 from nova.openstack.common import log as logging
 from nova.openstack.common import rpc
+from nova.openstack.common import timeutils
 from nova import utils
 from oslo.config import cfg
 
+from gridcentric.nova import tracing
+
 LOG = logging.getLogger('nova.gridcentric.api')
 CONF = cfg.CONF
 
 gridcentric_api_opts = [
                cfg.StrOpt('gridcentric_topic',
                default='gridcentric',
-               help='the topic gridcentric nodes listen on') ]
+               help='the topic gridcentric nodes listen on'),
+
+               cfg.ListOpt('gridcentric_migration_bandwidth',
+               default=[],
+               help='The network bandwidth between hosts, used to pick migration targets. '
+                    'Entries are of the form source:destination:bandwidth, or '
+                    'destination:bandwidth for the bandwidth from any source. Hosts without '
+                    'an entry are assumed to have the largest configured bandwidth.'),
+
+               cfg.ListOpt('gridcentric_vms_policy_profiles',
+               default=[],
+               help='Named vms memory policies that can be picked per blessed instance (through '
+                    'its gc:vms_policy metadata) or per launch. Entries are of the form '
+                    'name:policy, where policy is handed verbatim to vms as its memory.policy '
+                    'option (see the vms documentation for the policies it accepts). None are '
+                    'defined by default.'),
+
+               cfg.StrOpt('gridcentric_default_vms_policy',
+               default='',
+               help='The vms memory policy profile used by launches that do not pick one. By '
+                    'default vms uses its own policy.'),
+
+               cfg.IntOpt('gridcentric_prewarm_timeout',
+               default=600,
+               help='How long, in seconds, a host may take to pre-warm a blessed instance.'),
+
+               cfg.FloatOpt('gridcentric_prewarm_min_residency',
+               default=0.9,
+               help='The fraction of a blessed instance\'s artifacts that must be in the page '
+                    'cache of a host for launches to prefer that host.'),
+
+               cfg.IntOpt('gridcentric_prewarm_max_age',
+               default=3600,
+               help='How long, in seconds, launches trust that a host pre-warmed a blessed '
+                    'instance. The page cache of the host may have been evicted since.'),
+
+               cfg.IntOpt('gridcentric_fanout_timeout',
+               default=600,
+               help='How long, in seconds, the launches of a fan-out batch may take. The '
+                    'memory server shared by the batch is stopped after this long.'),
+
+               cfg.IntOpt('gridcentric_idempotency_window',
+               default=3600,
+               help='How long, in seconds, the idempotency key of a bless or launch is '
+                    'remembered. Repeating the request with the same key within this window '
+                    'returns the instances created by the original request.') ]
 CONF.register_opts(gridcentric_api_opts)
 
+# The system metadata key of the pre-warming result of a host is this prefix and the host.
+PREWARMED_PREFIX = 'gc_prewarmed_'
+
+def vms_policy_profiles():
+    """ Returns the configured vms memory policy profiles, keyed by name. """
+    profiles = {}
+    for entry in CONF.gridcentric_vms_policy_profiles:
+        (name, sep, policy) = entry.partition(':')
+        profiles[name.strip()] = policy.strip()
+    return profiles
+
+def memory_string_to_pages(mem):
+    mem = mem.lower()
+    units = { '^(\d+)tb$' : 40,
+              '^(\d+)gb$' : 30,
+              '^(\d+)mb$' : 20,
+              '^(\d+)kb$' : 10,
+              '^(\d+)b$' : 0,
+              '^(\d+)$' : 0 }
+    for (pattern, shift) in units.items():
+        m = re.match(pattern, mem)
+        if m is not None:
+            val = long(m.group(1))
+            memory = val << shift
+            # Shift to obtain pages, at least one
+            return max(1, memory >> 12)
+    raise ValueError('Invalid target string %s.' % mem)
+
 class API(base.Base):
     """API for interacting with the gridcentric manager."""
 
@@ -70,6 +150,7 @@ class API(base.Base):
             queue = rpc.queue_get_for(context, CONF.gridcentric_topic, host)
 
         params['instance_uuid'] = instance_uuid
+        params['trace_id'] = tracing.for_context(context)
         kwargs = {'method': method, 'args': params}
         rpc.cast(context, queue, kwargs)
 
@@ -97,7 +178,9 @@ class API(base.Base):
     def _rollback_reservation(self, context, reservations):
         quota.QUOTAS.rollback(context, reservations)
 
-    def _copy_instance(self, context, instance_uuid, new_name, launch=False, new_user_data=None, security_groups=None):
+    def _copy_instance(self, context, instance_uuid, new_name, launch=False, new_user_data=None,
+                       security_groups=None, pooled=False, idempotency_key=None,
+                       idempotency_count=1):
         # (dscannell): Basically we want to copy all of the information from
         # instance with id=instance_uuid into a new instance. This is because we
         # are basically "cloning" the vm as far as all the properties are
@@ -108,10 +191,13 @@ class API(base.Base):
         if image_ref == '':
             image_ref = instance_ref.get('image_id', '')
 
-        if launch:
+        if pooled:
+            metadata = {'pooled_from':'%s' % (instance_ref['uuid'])}
+        elif launch:
             metadata = {'launched_from':'%s' % (instance_ref['uuid'])}
         else:
             metadata = {'blessed_from':'%s' % (instance_ref['uuid'])}
+        metadata.update(self._idempotency_metadata(idempotency_key, idempotency_count))
 
         instance = {
            'reservation_id': utils.generate_uid('r'),
@@ -164,6 +250,63 @@ class API(base.Base):
 
         return self.db.instance_metadata_update(context, instance_uuid, metadata, True)
 
+    def _idempotency_metadata(self, idempotency_key, count=1):
+        """
+        Returns the metadata that records the idempotency key of a request, if any, along with
+        the number of instances the request creates.
+        """
+        if not(idempotency_key):
+            return {}
+        return {'gc:idempotency_key': idempotency_key,
+                'gc:idempotency_time': timeutils.strtime(),
+                'gc:idempotency_count': str(count)}
+
+    def _find_idempotent_result(self, context, instance_uuid, origin, idempotency_key):
+        """
+        Returns the instances created from instance_uuid (according to their origin metadata,
+        i.e. blessed_from or launched_from) by an earlier request with the same idempotency key,
+        or None if there was no such request within the gridcentric_idempotency_window. Raises an
+        exception if the earlier request is still creating its instances or if it failed.
+        """
+        if not(idempotency_key):
+            return None
+        filter = {
+                  'metadata':{origin:'%s' % instance_uuid,
+                              'gc:idempotency_key':idempotency_key},
+                  'deleted':False
+                  }
+        now = timeutils.utcnow()
+        instances = []
+        expected = 1
+        for instance in self.compute_api.get_all(context, filter):
+            metadata = self._instance_metadata(context, instance['uuid'])
+            requested = timeutils.parse_strtime(metadata['gc:idempotency_time'])
+            if timeutils.delta_seconds(requested, now) > CONF.gridcentric_idempotency_window:
+                # The key has expired, so these belong to an unrelated request.
+                LOG.debug(_("Ignoring instance %s of an expired request with idempotency key "
+                            "%s"), instance['uuid'], idempotency_key)
+                continue
+            expected = int(metadata.get('gc:idempotency_count', 1))
+            instances.append(self.get(context, instance['uuid']))
+        if len(instances) == 0:
+            return None
+
+        if len(instances) < expected:
+            # A fan-out launch creates its clones one at a time.
+            raise exception.NovaException(_("The request with idempotency key %s is still in "
+                                            "progress (%s of %s instances created), retry it "
+                                            "later.") %
+                                          (idempotency_key, len(instances), expected))
+        failed = [instance['uuid'] for instance in instances
+                  if instance['vm_state'] == vm_states.ERROR]
+        if failed:
+            raise exception.NovaException(_("The request with idempotency key %s failed "
+                                            "(instances in error: %s), use a new key to try "
+                                            "again.") % (idempotency_key, ", ".join(failed)))
+        LOG.debug(_("Request with idempotency key %s already created %s"), idempotency_key,
+                  ", ".join([instance['uuid'] for instance in instances]))
+        return instances
+
     def _next_clone_num(self, context, instance_uuid):
         """ Returns the next clone number for the instance_uuid """
 
@@ -185,17 +328,32 @@ class API(base.Base):
         metadata = self._instance_metadata(context, instance_uuid)
         return "launched_from" in metadata
 
-    def _list_gridcentric_hosts(self, context):
-        """ Returns a list of all the hosts known to openstack running the gridcentric service. """
+    def _list_gridcentric_hosts(self, context, include_disabled=True):
+        """
+        Returns a list of all the hosts known to openstack running the gridcentric service. Hosts
+        whose gridcentric service has been disabled (i.e. hosts that are being drained) are left
+        out unless include_disabled is set.
+        """
         admin_context = context.elevated()
         services = self.db.service_get_all_by_topic(admin_context, CONF.gridcentric_topic)
         hosts = []
         for srv in services:
+            if srv['disabled'] and not(include_disabled):
+                continue
             if srv['host'] not in hosts:
                 hosts.append(srv['host'])
         return hosts
 
-    def bless_instance(self, context, instance_uuid):
+    def bless_instance(self, context, instance_uuid, idempotency_key=None):
+        """
+        Blesses the instance. A repeat of a bless with the same idempotency key returns the
+        blessed instance of the original request.
+        """
+        result = self._find_idempotent_result(context, instance_uuid, 'blessed_from',
+                                              idempotency_key)
+        if result != None:
+            return result[0]
+
         # Setup the DB representation for the new VM.
         instance = self.get(context, instance_uuid)
 
@@ -218,7 +376,8 @@ class API(base.Base):
         try:
             clonenum = self._next_clone_num(context, instance_uuid)
             new_instance = self._copy_instance(context, instance_uuid,
-                                               "%s-%s" % (instance['display_name'], str(clonenum)), launch=False)
+                                               "%s-%s" % (instance['display_name'], str(clonenum)), launch=False,
+                                               idempotency_key=idempotency_key)
 
             LOG.debug(_("Casting gridcentric message for bless_instance") % locals())
             self._cast_gridcentric_message('bless_instance', context, new_instance['uuid'],
@@ -240,7 +399,13 @@ class API(base.Base):
             # The instance is not blessed. We can't discard it.
             raise exception.NovaException(_(("Instance %s is not blessed. " +
                                      "Cannot discard an non-blessed instance.") % instance_uuid))
-        elif len(self.list_launched_instances(context, instance_uuid)) > 0:
+
+        # Pooled clones are only ever handed out from this blessed instance, so they
+        # are torn down along with it rather than blocking the discard.
+        for pooled_instance in self._list_pooled_instances(context, instance_uuid):
+            self.compute_api.delete(context, pooled_instance)
+
+        if len(self.list_launched_instances(context, instance_uuid)) > 0:
             # There are still launched instances based off of this one.
             raise exception.NovaException(_(("Instance %s still has launched instances. " +
                                      "Cannot discard an instance with remaining launched ones.") %
@@ -261,7 +426,11 @@ class API(base.Base):
             self._rollback_reservation(context, reservations)
             raise
 
-    def launch_instance(self, context, instance_uuid, params={}):
+    def launch_instance(self, context, instance_uuid, params={}, idempotency_key=None):
+        """
+        Launches an instance from the blessed instance. A repeat of a launch with the same
+        idempotency key returns the instance launched by the original request.
+        """
         pid = context.project_id
         uid = context.user_id
 
@@ -272,6 +441,13 @@ class API(base.Base):
                   _(("Instance %s is not blessed. " +
                      "Please bless the instance before launching from it.") % instance_uuid))
 
+        result = self._find_idempotent_result(context, instance_uuid, 'launched_from',
+                                              idempotency_key)
+        if result != None:
+            return result[0]
+
+        self._check_vms_policy(params)
+
         # Set up security groups to be added - we are passed in names, but need ID's
         security_group_names = params.pop('security_groups', None)
         if security_group_names != None:
@@ -280,13 +456,19 @@ class API(base.Base):
         else:
             security_groups = None
 
+        if self._can_use_pool(params):
+            pooled_instance = self._claim_pooled_instance(context, instance_uuid)
+            if pooled_instance != None:
+                return self._unpool_instance(context, instance, pooled_instance, params,
+                                             security_groups, idempotency_key=idempotency_key)
+
         reservations = self._acquire_addition_reservation(context, instance)
         try:
             # Create a new launched instance.
             new_instance_ref = self._copy_instance(context, instance_uuid,
                 params.get('name', "%s-%s" % (instance['display_name'], "clone")),
                 launch=True, new_user_data=params.pop('user_data', None),
-                security_groups=security_groups)
+                security_groups=security_groups, idempotency_key=idempotency_key)
 
 
             LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
@@ -294,14 +476,26 @@ class API(base.Base):
 
             # FIXME: The Folsom scheduler removed support for calling
             # arbitrary functions via the scheduler. Damn. So now we
-            # have to make scheduling decisions internally. Until this
-            # is sorted, we will simply cast the message and let a random
-            # host pick it up. Note that this is simply a stopgap measure.
+            # have to make scheduling decisions internally. We pick the
+            # host with the most memory to spare, preferring the hosts
+            # that have been pre-warmed for this blessed instance. If no
+            # host has reported its resources, we simply cast the message
+            # and let a random host pick it up.
+            prewarmed_hosts = self._prewarmed_hosts(context, instance_uuid)
+            host = self._pick_launch_host(context, prewarmed_hosts or
+                        self._list_gridcentric_hosts(context, include_disabled=False))
+            if host == None and prewarmed_hosts:
+                host = random.choice(prewarmed_hosts)
+            if host != None:
+                queue = rpc.queue_get_for(context, CONF.gridcentric_topic, host)
+            else:
+                queue = CONF.gridcentric_topic
             rpc.cast(context,
-                         CONF.gridcentric_topic,
+                         queue,
                          {"method": "launch_instance",
                           "args": {"instance_uuid": new_instance_ref['uuid'],
-                                   "params": params}})
+                                   "params": params,
+                                   "trace_id": tracing.for_context(context)}})
             self._commit_reservation(context, reservations)
         except:
             self._rollback_reservation(context, reservations)
@@ -309,21 +503,439 @@ class API(base.Base):
 
         return self.get(context, new_instance_ref['uuid'])
 
-    def _find_migration_target(self, context, instance_host, dest):
-        gridcentric_hosts = self._list_gridcentric_hosts(context)
+    def launch_instances(self, context, instance_uuid, hosts, params={}, idempotency_key=None):
+        """
+        Launches one instance from the blessed instance on each of the hosts (a host may be
+        listed more than once). A single memory server sends the memory of the blessed instance
+        out to all of the launches at once, so the memory only crosses the network once.
+        """
+        instance = self.get(context, instance_uuid)
+        if not(self._is_instance_blessed(context, instance_uuid)):
+            # The instance is not blessed. We can't launch new instances from it.
+            raise exception.NovaException(
+                  _(("Instance %s is not blessed. " +
+                     "Please bless the instance before launching from it.") % instance_uuid))
+
+        result = self._find_idempotent_result(context, instance_uuid, 'launched_from',
+                                              idempotency_key)
+        if result != None:
+            return result
+
+        self._check_vms_policy(params)
+
+        gridcentric_hosts = self._list_gridcentric_hosts(context, include_disabled=False)
+        for host in hosts:
+            if host not in gridcentric_hosts:
+                raise exception.NovaException(_("Cannot launch on host %s because it is not "
+                                                "running the gridcentric service.") % host)
+
+        security_group_names = params.pop('security_groups', None)
+        if security_group_names != None:
+            security_groups = [self.db.security_group_get_by_name(context,
+                context.project_id, sg) for sg in security_group_names]
+        else:
+            security_groups = None
+        user_data = params.pop('user_data', None)
+
+        # All of the clones are created before any of them is launched, so that a failure part
+        # of the way through leaves nothing behind.
+        launches = {}
+        new_instance_uuids = []
+        all_reservations = []
+        try:
+            for host in hosts:
+                all_reservations.append(self._acquire_addition_reservation(context, instance))
+                new_instance_ref = self._copy_instance(context, instance_uuid,
+                    params.get('name', "%s-%s" % (instance['display_name'], "clone")),
+                    launch=True, new_user_data=user_data,
+                    security_groups=security_groups, idempotency_key=idempotency_key,
+                    idempotency_count=len(hosts))
+                launches.setdefault(host, []).append(new_instance_ref['uuid'])
+                new_instance_uuids.append(new_instance_ref['uuid'])
+        except:
+            for new_instance_uuid in new_instance_uuids:
+                try:
+                    self.db.instance_destroy(context, new_instance_uuid)
+                except:
+                    LOG.exception(_("Failed to remove clone %s of a failed batch"),
+                                  new_instance_uuid)
+            for reservations in all_reservations:
+                self._rollback_reservation(context, reservations)
+            raise
+        for reservations in all_reservations:
+            self._commit_reservation(context, reservations)
+
+        # The blessed instance's own host serves the memory if it can, since that is where the
+        # instance was blessed. Otherwise any of the launch hosts will do.
+        if instance['host'] in gridcentric_hosts:
+            source = instance['host']
+        else:
+            source = hosts[0]
+        greenthread.spawn_n(self._fanout_launch, context, instance_uuid, source, launches, params)
+
+        return [self.get(context, new_instance_uuid) for new_instance_uuid in new_instance_uuids]
+
+    def _fanout_launch(self, context, instance_uuid, source, launches, params):
+        """
+        Runs a batch of launches that share a memory server on the source host. If the memory
+        server cannot be started, the instances are launched as usual.
+        """
+        source_queue = rpc.queue_get_for(context, CONF.gridcentric_topic, source)
+        remote_hosts = [host for host in launches if host != source]
+        trace_id = tracing.for_context(context)
+
+        memory_url = None
+        if len(remote_hosts) > 0:
+            try:
+                memory_url = rpc.call(context, source_queue,
+                                      {"method": "serve_instance",
+                                       "args": {"instance_uuid": instance_uuid,
+                                                "dest": remote_hosts[0],
+                                                "trace_id": trace_id}},
+                                      timeout=None)
+            except Exception, e:
+                LOG.warn(_("Failed to start the memory server for %s on %s, launching the "
+                           "instances separately: %s"), instance_uuid, source, str(e))
+
+        def launch(host, new_instance_uuid):
+            args = {"instance_uuid": new_instance_uuid,
+                    "params": params,
+                    "trace_id": trace_id}
+            if host != source:
+                # The source host launches straight from its local copy of the memory.
+                args["memory_url"] = memory_url
+            try:
+                rpc.call(context, rpc.queue_get_for(context, CONF.gridcentric_topic, host),
+                         {"method": "launch_instance",
+                          "args": args},
+                         timeout=CONF.gridcentric_fanout_timeout)
+            except Exception, e:
+                LOG.warn(_("Fan-out launch of %s on %s failed: %s"),
+                         new_instance_uuid, host, str(e))
+
+        pool = greenpool.GreenPool(sum([len(uuids) for uuids in launches.values()]))
+        for host, new_instance_uuids in launches.iteritems():
+            for new_instance_uuid in new_instance_uuids:
+                pool.spawn_n(launch, host, new_instance_uuid)
+        pool.waitall()
+
+        if memory_url != None:
+            rpc.cast(context, source_queue,
+                     {"method": "stop_serving",
+                      "args": {"memory_url": memory_url}})
+
+    def get_stats(self, context, instance_uuid):
+        """ Returns the vms runtime counters of a running launched instance. """
+        instance_ref = self.get(context, instance_uuid)
+        if not(self._is_instance_launched(context, instance_uuid)):
+            raise exception.NovaException(_("Instance %s is not a launched instance.") %
+                                          instance_uuid)
+        elif instance_ref['vm_state'] != vm_states.ACTIVE or not(instance_ref['host']):
+            raise exception.NovaException(_("Instance %s is not running.") % instance_uuid)
+
+        return rpc.call(context,
+                        rpc.queue_get_for(context, CONF.gridcentric_topic, instance_ref['host']),
+                        {"method": "get_stats",
+                         "args": {"instance_uuid": instance_uuid}})
+
+    def prewarm_instance(self, context, instance_uuid, hosts=None, mlock=False):
+        """
+        Has the hosts (by default, all of the gridcentric hosts) load the artifacts of the blessed
+        instance into their page cache ahead of launches. The residency reached on each host is
+        recorded, along with the time, in the blessed instance's gc_prewarmed_<host> system
+        metadata.
+        """
+        if not(self._is_instance_blessed(context, instance_uuid)):
+            raise exception.NovaException(_("Instance %s is not blessed.") % instance_uuid)
+
+        gridcentric_hosts = self._list_gridcentric_hosts(context, include_disabled=False)
+        if not(hosts):
+            hosts = gridcentric_hosts
+        for host in hosts:
+            if host not in gridcentric_hosts:
+                raise exception.NovaException(_("Cannot pre-warm host %s because it is not "
+                                                "running the gridcentric service.") % host)
+
+        greenthread.spawn_n(self._prewarm_hosts, context, instance_uuid, hosts, mlock)
+
+    def _prewarm_hosts(self, context, instance_uuid, hosts, mlock):
+        def prewarm(host):
+            try:
+                residency = rpc.call(context,
+                                     rpc.queue_get_for(context, CONF.gridcentric_topic, host),
+                                     {"method": "prewarm_instance",
+                                      "args": {"instance_uuid": instance_uuid,
+                                               "mlock": mlock}},
+                                     timeout=CONF.gridcentric_prewarm_timeout)
+            except Exception, e:
+                LOG.warn(_("Failed to pre-warm %s on %s: %s"), instance_uuid, host, str(e))
+                residency = 0.0
+            self.db.instance_system_metadata_update(context, instance_uuid,
+                                {PREWARMED_PREFIX + host: "%s,%s" % (residency or 0.0,
+                                                                     timeutils.strtime())},
+                                False)
+
+        pool = greenpool.GreenPool(len(hosts))
+        for host in hosts:
+            pool.spawn_n(prewarm, host)
+        pool.waitall()
+
+    def _prewarmed_hosts(self, context, instance_uuid):
+        """
+        Returns the available hosts that hold the blessed instance in their page cache. Hosts
+        pre-warmed more than gridcentric_prewarm_max_age ago are not trusted to still hold it.
+        """
+        now = timeutils.utcnow()
+        prewarmed_hosts = []
+        system_metadata = self.db.instance_system_metadata_get(context, instance_uuid)
+        for key, value in system_metadata.iteritems():
+            if not(key.startswith(PREWARMED_PREFIX)):
+                continue
+            (residency, prewarmed) = value.split(',')
+            if float(residency) < CONF.gridcentric_prewarm_min_residency:
+                continue
+            if timeutils.delta_seconds(timeutils.parse_strtime(prewarmed), now) > \
+               CONF.gridcentric_prewarm_max_age:
+                continue
+            prewarmed_hosts.append(key[len(PREWARMED_PREFIX):])
+        if not(prewarmed_hosts):
+            return []
+        gridcentric_hosts = self._list_gridcentric_hosts(context, include_disabled=False)
+        return [host for host in prewarmed_hosts if host in gridcentric_hosts]
+
+    def _host_capabilities(self, context):
+        """
+        Returns what is known about the resources of each host, keyed by host: the free memory
+        reported by nova-compute and the gridcentric_* stats published next to it by the
+        gridcentric service of the host.
+        """
+        capabilities = {}
+        for compute_node in self.db.compute_node_get_all(context.elevated()):
+            host_capabilities = {'free_ram_mb': compute_node['free_ram_mb']}
+            for stat in compute_node['stats']:
+                if stat['key'].startswith('gridcentric_'):
+                    host_capabilities[stat['key']] = int(stat['value'])
+            capabilities[compute_node['service']['host']] = host_capabilities
+        return capabilities
+
+    def _available_ram_mb(self, host_capabilities):
+        # Nova-compute accounts for the full memory of every instance, but clones that run with
+        # a memory target are held to less than that.
+        return host_capabilities.get('free_ram_mb', 0) + \
+               host_capabilities.get('gridcentric_overcommit_mb', 0)
+
+    def _pick_launch_host(self, context, hosts):
+        """
+        Returns one of the hosts with the most memory available for clones (shared among the
+        memory servers running there). Returns None if none of the hosts reported their resources.
+        """
+        capabilities = self._host_capabilities(context)
+        hosts = [host for host in hosts if host in capabilities]
+        if not(hosts):
+            return None
+
+        def score(host):
+            return max(self._available_ram_mb(capabilities[host]), 0) / \
+                   (1.0 + capabilities[host].get('gridcentric_memservers', 0))
+
+        # The resources are only reported periodically, so a burst of launches would all land
+        # on the single best host. Instead, pick randomly among the hosts that are not much worse.
+        best = max([score(host) for host in hosts])
+        return random.choice([host for host in hosts if score(host) >= best / 2])
+
+    def _check_vms_policy(self, params):
+        vms_policy = params.get('vms_policy', None)
+        if vms_policy and vms_policy not in vms_policy_profiles():
+            raise exception.NovaException(_("Unknown vms policy profile %s (known: %s).") %
+                                          (vms_policy, ', '.join(vms_policy_profiles().keys())))
+
+    def _can_use_pool(self, params):
+        """
+        Returns True if a launch with the given params can be served by a pooled clone. Pooled
+        clones are launched with the default memory target and policy, and no guest parameters.
+        """
+        return params.get('target', '0') == '0' and not(params.get('guest', None)) and \
+               not(params.get('vms_policy', None))
+
+    def _list_pooled_instances(self, context, instance_uuid):
+        filter = {
+                  'metadata':{'pooled_from':'%s' % instance_uuid},
+                  'deleted':False
+                  }
+        return self.compute_api.get_all(context, filter)
+
+    def _claim_pooled_instance(self, context, instance_uuid):
+        """
+        Claims a paused clone from the pool of the blessed instance. Returns None if there are no
+        pooled clones available.
+        """
+        filter = {
+                  'metadata':{'pooled_from':'%s' % instance_uuid},
+                  'vm_state':vm_states.PAUSED,
+                  'project_id':context.project_id,
+                  'deleted':False
+                  }
+        for pooled_instance in self.compute_api.get_all(context, filter):
+            try:
+                # The update only goes through if nobody else has claimed this clone (they would
+                # have set the task state).
+                return self.db.instance_update(context, pooled_instance['uuid'],
+                                               {'task_state':task_states.UNPAUSING,
+                                                'expected_task_state':[None]})
+            except exception.UnexpectedTaskStateError:
+                continue
+        return None
+
+    def _unpool_instance(self, context, instance, pooled_instance, params, security_groups,
+                         idempotency_key=None):
+        """
+        Turns a claimed pooled clone into a launched instance with the name, user data and
+        security groups of the launch request.
+        """
+        pooled_uuid = pooled_instance['uuid']
+        new_name = params.get('name', "%s-%s" % (instance['display_name'], "clone"))
+        self.db.instance_update(context, pooled_uuid,
+                                {'display_name': new_name,
+                                 'hostname': utils.sanitize_hostname(new_name),
+                                 'user_data': params.pop('user_data', None) or ''})
+
+        metadata = self._instance_metadata(context, pooled_uuid)
+        metadata.pop('pooled_from', None)
+        metadata['launched_from'] = '%s' % (instance['uuid'])
+        metadata.update(self._idempotency_metadata(idempotency_key))
+        self._instance_metadata_update(context, pooled_uuid, metadata)
+
+        if security_groups != None:
+            elevated = context.elevated()
+            for security_group in self.db.security_group_get_by_instance(context,
+                                                                         pooled_instance['id']):
+                self.db.instance_remove_security_group(elevated, pooled_uuid,
+                                                       security_group['id'])
+            for security_group in security_groups:
+                self.db.instance_add_security_group(elevated, pooled_uuid,
+                                                    security_group['id'])
+
+        LOG.debug(_("Casting gridcentric message for unpool_instance") % locals())
+        self._cast_gridcentric_message('unpool_instance', context, pooled_uuid,
+                                       host=pooled_instance['host'],
+                                       params={'refresh_security_groups':
+                                                    security_groups != None})
+        return self.get(context, pooled_uuid)
+
+    def create_pooled_instance(self, context, instance_uuid):
+        """
+        Creates the database entry for a new pooled clone of the blessed instance. The
+        gridcentric manager launches and pauses these ahead of time so that launch_instance()
+        can hand them out without waiting on a full launch.
+        """
+        instance = self.get(context, instance_uuid)
+        reservations = self._acquire_addition_reservation(context, instance)
+        try:
+            new_instance_ref = self._copy_instance(context, instance_uuid,
+                "%s-%s" % (instance['display_name'], "pool"), pooled=True)
+            self._commit_reservation(context, reservations)
+        except:
+            self._rollback_reservation(context, reservations)
+            raise
+
+        return new_instance_ref
+
+    def _migration_bandwidth(self, src, dest):
+        """ Returns the configured bandwidth from src to dest, or None if it is not known. """
+        bandwidth = None
+        for entry in CONF.gridcentric_migration_bandwidth:
+            fields = entry.split(':')
+            try:
+                if len(fields) == 3 and fields[0] == src and fields[1] == dest:
+                    # The bandwidth between this pair of hosts trumps everything else.
+                    return float(fields[2])
+                elif len(fields) == 2 and fields[0] == dest:
+                    bandwidth = float(fields[1])
+            except ValueError:
+                LOG.warn(_("Invalid migration bandwidth entry %s"), entry)
+        return bandwidth
+
+    def _max_migration_bandwidth(self):
+        """ Returns the largest configured migration bandwidth (1 if there are none). """
+        max_bandwidth = 1.0
+        for entry in CONF.gridcentric_migration_bandwidth:
+            try:
+                max_bandwidth = max(max_bandwidth, float(entry.split(':')[-1]))
+            except ValueError:
+                pass
+        return max_bandwidth
+
+    def migration_cost(self, src, dest):
+        """
+        Returns the bandwidth a migration from src to dest is expected to use. Hosts without a
+        configured bandwidth are assumed to have the largest configured bandwidth.
+        """
+        bandwidth = self._migration_bandwidth(src, dest)
+        if bandwidth == None:
+            bandwidth = self._max_migration_bandwidth()
+        return bandwidth
+
+    def incoming_migrations(self, context):
+        """ Returns the instances currently migrating to each host, keyed by host. """
+        incoming = {}
+        migrating_instances = self.db.instance_get_all_by_filters(context,
+                                                    {'task_state': task_states.MIGRATING,
+                                                     'deleted': False})
+        for instance in migrating_instances:
+            metadata = self._instance_metadata(context, instance['uuid'])
+            dst_host = metadata.get('gc_dst_host', None)
+            if dst_host != None and dst_host != instance['host']:
+                incoming.setdefault(dst_host, []).append(instance)
+        return incoming
+
+    def _rank_migration_targets(self, context, instance_ref, hosts):
+        """
+        Orders the hosts from the best to the worst migration target for the instance. Hosts
+        are scored on their available memory (less the memory of the migrations already
+        landing there), the bandwidth from the instance's host and the number of migrations
+        already sharing that bandwidth. Hosts without enough free memory for the instance come
+        last.
+        """
+        admin_context = context.elevated()
+
+        free_ram_mb = {}
+        for host, host_capabilities in self._host_capabilities(admin_context).iteritems():
+            free_ram_mb[host] = self._available_ram_mb(host_capabilities)
+
+        incoming = self.incoming_migrations(admin_context)
+
+        max_bandwidth = self._max_migration_bandwidth()
+
+        def score(host):
+            incoming_instances = incoming.get(host, [])
+            free = free_ram_mb.get(host, 0) - \
+                   sum([instance['memory_mb'] for instance in incoming_instances])
+            bandwidth = self.migration_cost(instance_ref['host'], host)
+            # The incoming migrations share the bandwidth to the host.
+            throughput = (bandwidth / max_bandwidth) / (1 + len(incoming_instances))
+            return (free >= instance_ref['memory_mb'], max(free, 0) * throughput)
+
+        # Shuffle first so that ties are broken randomly.
+        ranked_hosts = list(hosts)
+        random.shuffle(ranked_hosts)
+        ranked_hosts.sort(key=score, reverse=True)
+        return ranked_hosts
+
+    def find_migration_target(self, context, instance_ref, dest):
+        instance_host = instance_ref['host']
 
         if dest == None:
-            # We will pick a random host.
+            # We will pick the least loaded host that is not being drained.
+            gridcentric_hosts = self._list_gridcentric_hosts(context, include_disabled=False)
             if instance_host in gridcentric_hosts:
                 # We cannot migrate to ourselves so take that host out of the list.
                 gridcentric_hosts.remove(instance_host)
 
             if len(gridcentric_hosts) == 0:
                 raise exception.NovaException(_("There are no available hosts for the migration target."))
-            random.shuffle(gridcentric_hosts)
-            dest = gridcentric_hosts[0]
+            dest = self._rank_migration_targets(context, instance_ref, gridcentric_hosts)[0]
 
-        elif dest not in gridcentric_hosts:
+        elif dest not in self._list_gridcentric_hosts(context):
             raise exception.NovaException(_("Cannot migrate to host %s because it is not running the"
                                     " gridcentric service.") % dest)
         elif dest == instance_host:
@@ -342,7 +954,7 @@ class API(base.Base):
         elif instance_ref['vm_state'] != vm_states.ACTIVE:
             raise exception.NovaException(_("Unable to migrate instance %s because it is not active") %
                                   instance_uuid)
-        dest = self._find_migration_target(context, instance_ref['host'], dest)
+        dest = self.find_migration_target(context, instance_ref, dest)
 
         self.db.instance_update(context, instance_ref['uuid'], {'task_state':task_states.MIGRATING})
         LOG.debug(_("Casting gridcentric message for migrate_instance") % locals())
@@ -350,6 +962,67 @@ class API(base.Base):
                                        instance_ref['uuid'], host=instance_ref['host'],
                                        params={"dest" : dest})
 
+    def cancel_migration(self, context, instance_uuid):
+        """
+        Cancels the migration of an instance. The instance stays on (or goes back to) the host it
+        is migrating from, unless it is already running on the destination.
+        """
+        instance_ref = self.get(context, instance_uuid)
+        if instance_ref['task_state'] != task_states.MIGRATING:
+            raise exception.NovaException(_("Instance %s is not migrating.") % instance_uuid)
+
+        LOG.debug(_("Casting gridcentric message for cancel_migration") % locals())
+        self._cast_gridcentric_message('cancel_migration', context, instance_uuid,
+                                       host=instance_ref['host'])
+
+    def set_target(self, context, instance_uuid, target):
+        """ Changes the memory target of a running launched instance. """
+        instance_ref = self.get(context, instance_uuid)
+        if not(self._is_instance_launched(context, instance_uuid)):
+            raise exception.NovaException(_("Instance %s is not a launched instance.") %
+                                          instance_uuid)
+        elif instance_ref['vm_state'] != vm_states.ACTIVE:
+            raise exception.NovaException(_("Unable to set the target of instance %s because "
+                                            "it is not active.") % instance_uuid)
+        if target != "0":
+            try:
+                memory_string_to_pages(target)
+            except ValueError:
+                raise exception.NovaException(_("Invalid memory target %s.") % target)
+
+        LOG.debug(_("Casting gridcentric message for set_target") % locals())
+        self._cast_gridcentric_message('set_target', context, instance_uuid,
+                                       host=instance_ref['host'],
+                                       params={"target": target})
+
+    def evacuate_host(self, context, host, parallelism=None):
+        """
+        Migrates every active instance off the host. The host is marked as being drained so that
+        no further instances are migrated onto it.
+        """
+        if not context.is_admin:
+            raise exception.NovaException(_("This feature is restricted to only admin users."))
+        if host not in self._list_gridcentric_hosts(context):
+            raise exception.NovaException(_("Cannot evacuate host %s because it is not running "
+                                            "the gridcentric service.") % host)
+
+        LOG.debug(_("Casting gridcentric message for evacuate_host") % locals())
+        rpc.cast(context, rpc.queue_get_for(context, CONF.gridcentric_topic, host),
+                 {"method": "evacuate_host",
+                  "args": {"parallelism": parallelism}})
+
+    def evacuation_status(self, context, host):
+        """ Returns the progress of the latest evacuation of the host. """
+        if not context.is_admin:
+            raise exception.NovaException(_("This feature is restricted to only admin users."))
+        if host not in self._list_gridcentric_hosts(context):
+            raise exception.NovaException(_("Host %s is not running the gridcentric service.")
+                                          % host)
+
+        return rpc.call(context, rpc.queue_get_for(context, CONF.gridcentric_topic, host),
+                        {"method": "evacuation_status",
+                         "args": {}})
+
     def list_launched_instances(self, context, instance_uuid):
         # Assert that the instance with the uuid actually exists.
         self.get(context, instance_uuid)
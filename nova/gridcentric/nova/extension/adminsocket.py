@@ -0,0 +1,78 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A local unix socket for looking into a running gridcentric service. A client connects, sends a
+command and its arguments on one line, and reads the reply (as json) until the socket closes.
+For example:
+
+    echo recorder | socat - UNIX-CONNECT:/var/lib/nova/gridcentric.sock
+"""
+
+import json
+import os
+
+from eventlet import greenthread
+from eventlet.green import socket
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('nova.gridcentric.adminsocket')
+
+class AdminSocket(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.commands = {}
+        self.sock = None
+
+    def register(self, command, fn):
+        """ Serves command with fn, which is called with the arguments given to the command. """
+        self.commands[command] = fn
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        # Only root and the service itself get to look inside.
+        os.chmod(self.path, 0600)
+        sock.listen(4)
+        self.sock = sock
+        greenthread.spawn_n(self._serve)
+
+    def _serve(self):
+        while True:
+            conn, addr = self.sock.accept()
+            greenthread.spawn_n(self._handle, conn)
+
+    def _handle(self, conn):
+        try:
+            stream = conn.makefile('rw')
+            words = stream.readline().split()
+            if len(words) == 0 or words[0] not in self.commands:
+                reply = {'error': "Unknown command. Commands are: %s" %
+                                  ", ".join(sorted(self.commands.keys()))}
+            else:
+                try:
+                    reply = self.commands[words[0]](*words[1:])
+                except Exception, e:
+                    LOG.exception(_("Error during admin command %s"), words[0])
+                    reply = {'error': str(e)}
+            stream.write(json.dumps(reply, indent=2))
+            stream.write("\n")
+            stream.close()
+        finally:
+            conn.close()
@@ -0,0 +1,109 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keeps a record of the most recent operations of the gridcentric service, so that a misbehaving
+host can be looked into after the fact.
+"""
+
+import collections
+import json
+import time
+
+from eventlet import corolocal
+
+class Operation(object):
+    """ One operation on an instance, timed phase by phase. """
+
+    def __init__(self, name, instance_uuid, trace_id, parent):
+        self.name = name
+        self.instance_uuid = instance_uuid
+        self.trace_id = trace_id
+        self.parent = parent
+        self.start = time.time()
+        self.last_mark = self.start
+        self.phases = []
+        self.outcome = 'running'
+        self.duration = None
+
+    def phase(self, name):
+        """
+        Ends the phase called name, which started at the end of the previous phase, and returns
+        its duration.
+        """
+        now = time.time()
+        duration = now - self.last_mark
+        self.phases.append((name, duration))
+        self.last_mark = now
+        return duration
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.duration = time.time() - self.start
+        self.parent = None
+
+    def to_dict(self):
+        return {'operation': self.name,
+                'instance_uuid': self.instance_uuid,
+                'trace_id': self.trace_id,
+                'start': self.start,
+                'duration': self.duration,
+                'phases': self.phases,
+                'outcome': self.outcome}
+
+class FlightRecorder(object):
+    """
+    A ring buffer of the latest operations. Operations are recorded when they begin, so the
+    ones still running (or stuck) show up in a dump too.
+    """
+
+    def __init__(self, size=200):
+        self.operations = collections.deque(maxlen=size)
+        self._local = corolocal.local()
+
+    def resize(self, size):
+        if size != self.operations.maxlen:
+            self.operations = collections.deque(self.operations, maxlen=size)
+
+    def current(self):
+        """ Returns the operation running in this greenthread, if any. """
+        return getattr(self._local, 'operation', None)
+
+    def begin(self, name, instance_uuid=None, trace_id=None):
+        operation = Operation(name, instance_uuid, trace_id, self.current())
+        self.operations.append(operation)
+        self._local.operation = operation
+        return operation
+
+    def end(self, operation, outcome):
+        self._local.operation = operation.parent
+        operation.finish(outcome)
+
+    def phase(self, name):
+        """ Ends a phase of the operation running in this greenthread. """
+        operation = self.current()
+        if operation != None:
+            operation.phase(name)
+
+    def dump(self):
+        """ Returns the recorded operations, oldest first. """
+        return [operation.to_dict() for operation in list(self.operations)]
+
+    def write(self, stream):
+        for operation in self.dump():
+            stream.write("%s\n" % json.dumps(operation))
+
+# The recorder of this process.
+RECORDER = FlightRecorder()
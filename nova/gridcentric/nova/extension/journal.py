@@ -0,0 +1,134 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A write-ahead journal of the operations running on this host. Each operation gets a file in the
+journal directory, to which it appends a line for every phase it completes (along with whatever
+is needed to pick the operation up from there). The file is removed when the operation is over,
+one way or another, so the files left after a crash are exactly the interrupted operations.
+"""
+
+import json
+import os
+import time
+
+from eventlet import corolocal
+from eventlet import tpool
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('nova.gridcentric.journal')
+
+class Entry(object):
+    """ The journal of one operation. """
+
+    def __init__(self, path, operation, instance_uuid, phases=None, parent=None):
+        self.path = path
+        self.operation = operation
+        self.instance_uuid = instance_uuid
+        self.phases = phases or {}
+        self.parent = parent
+
+    def record(self, phase, **data):
+        """ Durably records that the operation completed phase. """
+        data['time'] = time.time()
+        self.phases[phase] = data
+        if self.path == None:
+            return
+        # The syncs block until the disk has the line, so they are kept off the hub.
+        tpool.execute(self._append, json.dumps(dict(data, phase=phase)))
+
+    def _append(self, line):
+        created = not(os.path.exists(self.path))
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, line + "\n")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if created:
+            # Make sure the new file itself survives a crash.
+            fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """ Drops the journal of the operation, which is over. """
+        if self.path != None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class Journal(object):
+    """ The journal in the directory path. Nothing is written if path is empty. """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = corolocal.local()
+
+    def _entry_path(self, operation, instance_uuid):
+        if not(self.path):
+            return None
+        return os.path.join(self.path, "%s.%s" % (instance_uuid, operation))
+
+    def begin(self, operation, instance_uuid):
+        """
+        Starts the journal of an operation, which becomes the current operation of this
+        greenthread until it ends. Nothing is written until the operation records a phase.
+        """
+        if self.path and not(os.path.exists(self.path)):
+            os.makedirs(self.path)
+        entry = Entry(self._entry_path(operation, instance_uuid), operation, instance_uuid,
+                      parent=self.current())
+        self._local.entry = entry
+        return entry
+
+    def end(self, entry):
+        self._local.entry = entry.parent
+        entry.parent = None
+        entry.close()
+
+    def current(self):
+        return getattr(self._local, 'entry', None)
+
+    def record(self, phase, **data):
+        """ Records a phase of the current operation of this greenthread. """
+        entry = self.current()
+        if entry != None:
+            entry.record(phase, **data)
+
+    def load(self):
+        """ Returns the entries of the operations that were interrupted. """
+        entries = []
+        if not(self.path) or not(os.path.exists(self.path)):
+            return entries
+        for name in sorted(os.listdir(self.path)):
+            try:
+                instance_uuid, operation = name.split(".", 1)
+            except ValueError:
+                continue
+            phases = {}
+            for line in open(os.path.join(self.path, name)).readlines():
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # The last line may be torn if the host went down while writing it.
+                    LOG.warn(_("Ignoring a torn journal line for %s of %s."),
+                             operation, instance_uuid)
+                    continue
+                phases[data.pop('phase')] = data
+            entries.append(Entry(os.path.join(self.path, name), operation, instance_uuid,
+                                 phases=phases))
+        return entries
@@ -20,14 +20,17 @@ The :py:class:`GridCentricManager` class is a :py:class:`nova.manager.Manager` t
 handles RPC calls relating to GridCentric functionality creating instances.
 """
 
+import random
 import time
 import traceback
 import os
-import re
 import socket
 import subprocess
 
 import greenlet
+from eventlet import event
+from eventlet import greenpool
+from eventlet import greenthread
 from eventlet.green import threading as gthreading
 
 
@@ -55,7 +58,127 @@ gridcentric_opts = [
                      'mutliple launches on the same host will be processed synchronously. '
                      'This timeout can be raised to ensure that launch waits long enough '
                      'for nova-compute to process its request. By default this uses the '
-                     'standard nova-wide rpc timeout.')]
+                     'standard nova-wide rpc timeout.'),
+
+                cfg.ListOpt('gridcentric_reservoir_networks',
+                default=[],
+                help='The uuids of the networks on which each host keeps a reservoir of '
+                     'pre-allocated fixed IPs for clone launches. When set, every launched '
+                     'instance is attached to exactly these networks (and no others), whatever '
+                     'networks its blessed instance was on.'),
+
+                cfg.IntOpt('gridcentric_reservoir_size',
+                default=4,
+                help='The number of fixed IPs to keep reserved on each of the '
+                     'gridcentric_reservoir_networks.'),
+
+                cfg.IntOpt('gridcentric_refresh_host_ticks',
+                default=10,
+                help='When the hypervisor delivers lifecycle events, the number of periodic '
+                     'ticks between full scans of the instances on the host. Without lifecycle '
+                     'events the instances are scanned on every tick.'),
+
+                cfg.IntOpt('gridcentric_evacuate_parallelism',
+                default=2,
+                help='The number of migrations that evacuating a host runs at the same time.'),
+
+                cfg.FloatOpt('gridcentric_migration_budget',
+                default=0.0,
+                help='The total bandwidth that the migrations started by host evacuations may '
+                     'use across the cluster, in the units of gridcentric_migration_bandwidth. '
+                     'Without any configured bandwidths each migration counts as 1. A value of '
+                     '0 does not limit the migrations.'),
+
+                cfg.BoolOpt('gridcentric_auto_target',
+                default=False,
+                help='Launches that do not ask for a memory target get the target learned from '
+                     'the working sets of earlier clones of the same blessed instance. A '
+                     'launch can always ask for the learned target with a target of "auto".'),
+
+                cfg.FloatOpt('gridcentric_working_set_margin',
+                default=0.2,
+                help='The fraction added on top of the learned working set when it is used '
+                     'as a memory target.'),
+
+                cfg.IntOpt('gridcentric_working_set_min_samples',
+                default=3,
+                help='The number of working set samples needed before a learned memory target '
+                     'is used.'),
+
+                cfg.FloatOpt('gridcentric_working_set_weight',
+                default=0.25,
+                help='The weight of each new working set sample in the learned working set of '
+                     'a blessed instance (an exponentially weighted moving average).'),
+
+                cfg.IntOpt('gridcentric_working_set_interval',
+                default=300,
+                help='The minimum number of seconds between two passes sampling the working sets '
+                     'of the clones on a host.'),
+
+                cfg.FloatOpt('gridcentric_memory_pressure',
+                default=0.0,
+                help='The fraction of host memory that should stay free. When less is free, the '
+                     'memory targets of the clones on the host are lowered towards their working '
+                     'sets, and they are restored once twice as much is free again. A value of 0 '
+                     'disables the policy.'),
+
+                cfg.IntOpt('gridcentric_prefetch_capture_delay',
+                default=30,
+                help='How long, in seconds, after the first launch of a blessed instance the '
+                     'pages touched by that clone are recorded as a prefetch hint for later '
+                     'launches. The hints are shared through the image service, so they are only '
+                     'recorded when gridcentric_use_image_service is set. A value of 0 disables '
+                     'the prefetch hints.'),
+
+                cfg.IntOpt('gridcentric_flight_recorder_size',
+                default=200,
+                help='The number of recent operations kept, with their phase timings and '
+                     'outcome, for the recorder admin command and the SIGUSR2 dump.'),
+
+                cfg.StrOpt('gridcentric_admin_socket',
+                default='',
+                help='The path of a unix socket serving local admin commands (such as '
+                     '"recorder"). The socket is not created if this is not set.'),
+
+                cfg.IntOpt('gridcentric_metrics_port',
+                default=0,
+                help='The local port (on 127.0.0.1) that serves the metrics of the gridcentric '
+                     'service in the prometheus text format. 0 disables the exporter.'),
+
+                cfg.StrOpt('gridcentric_metrics_file',
+                default='',
+                help='A file that the metrics of the gridcentric service are periodically '
+                     'written to, in the prometheus text format.'),
+
+                cfg.IntOpt('gridcentric_db_retries',
+                default=12,
+                help='The number of times a failed instance update is retried.'),
+
+                cfg.FloatOpt('gridcentric_db_retry_delay',
+                default=0.5,
+                help='The delay, in seconds, before the first retry of a failed instance '
+                     'update. The delay doubles with every retry, and each retry waits for a '
+                     'random part of it so that hosts do not retry in lockstep.'),
+
+                cfg.FloatOpt('gridcentric_db_retry_max_delay',
+                default=15.0,
+                help='The longest delay, in seconds, between two retries of an instance update.'),
+
+                cfg.IntOpt('gridcentric_db_max_retrying',
+                default=4,
+                help='The number of failed instance updates that may be retried at the same '
+                     'time. The others wait for their turn.'),
+
+                cfg.StrOpt('gridcentric_journal_dir',
+                default='$state_path/gridcentric_journal',
+                help='The directory of the journal that lets the gridcentric service resume or '
+                     'roll back the operations interrupted by a restart. The journal is not '
+                     'kept if this is empty.'),
+
+                cfg.IntOpt('gridcentric_migration_address_ttl',
+                default=300,
+                help='How long, in seconds, the device used to migrate to a host is cached. '
+                     'The cache is also dropped whenever the routes of this host change.')]
 CONF.register_opts(gridcentric_opts)
 
 from nova import manager
@@ -73,67 +196,95 @@ from nova.compute import task_states
 from nova.compute import vm_states
 from nova.compute import utils as compute_utils
 from nova.compute import manager as compute_manager
+from nova.virt import event as virtevent
 
 from nova.openstack.common.notifier import api as notifier
 from nova import notifications
 
 from gridcentric.nova.api import API
+from gridcentric.nova.api import memory_string_to_pages
+from gridcentric.nova.api import PREWARMED_PREFIX
+from gridcentric.nova.api import vms_policy_profiles
+from gridcentric.nova import tracing
+from gridcentric.nova.extension import adminsocket
+from gridcentric.nova.extension import flightrecorder
+from gridcentric.nova.extension import journal
+from gridcentric.nova.extension import metrics
+from gridcentric.nova.extension import profiler
+from gridcentric.nova.extension import routes
 import gridcentric.nova.extension.vmsconn as vmsconn
 
+tracing.trace_log(LOG)
+
+# The system metadata key of the working set learned by a host is this prefix and the host.
+WORKING_SET_PREFIX = 'gc_working_set_'
+
+# The system metadata key of the prefetch hint recorded by a host is this prefix and the host.
+PREFETCH_PREFIX = 'gc_prefetch_'
+
+# The operations that are journaled, so that they can be recovered after a restart.
+JOURNALED_OPERATIONS = ('bless_instance', 'launch_instance', 'migrate_instance',
+                        'discard_instance')
+
 def _lock_call(fn):
     """
     A decorator to lock methods to ensure that mutliple operations do not occur on the same
     instance at a time. Note that this is a local lock only, so it just prevents concurrent
-    operations on the same host.
+    operations on the same host. The call runs under the trace ID passed in by the caller, or
+    under a new one taken from the request context.
     """
 
     def wrapped_fn(self, context, **kwargs):
         instance_uuid = kwargs.get('instance_uuid', None)
         instance_ref = kwargs.get('instance_ref', None)
+        trace_id = kwargs.pop('trace_id', None) or tracing.for_context(context)
+        previous_trace_id = tracing.set_current(trace_id)
+        operation = self.recorder.begin(fn.__name__, instance_uuid or instance_ref['uuid'],
+                                        trace_id)
+        entry = None
+        outcome = 'error'
 
-        # Ensure we've got exactly one of uuid or ref.
-        if instance_uuid and not(instance_ref):
-            instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
-            kwargs['instance_ref'] = instance_ref
-        elif instance_ref and not(instance_uuid):
-            instance_uuid = instance_ref['uuid']
-            kwargs['instance_uuid'] = instance_ref['uuid']
-
-        LOG.debug(_("%s called: %s"), fn.__name__, str(kwargs))
-        if type(instance_ref) == dict:
-            # Cover for the case where we don't have a proper object.
-            instance_ref['name'] = CONF.instance_name_template % instance_ref['id']
-
-        LOG.debug("Locking instance %s (fn:%s)" % (instance_uuid, fn.__name__))
-        self._lock_instance(instance_uuid)
         try:
-            return fn(self, context, **kwargs)
+            if fn.__name__ in JOURNALED_OPERATIONS:
+                entry = self.journal.begin(fn.__name__, operation.instance_uuid)
+
+            # Ensure we've got exactly one of uuid or ref.
+            if instance_uuid and not(instance_ref):
+                instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+                kwargs['instance_ref'] = instance_ref
+            elif instance_ref and not(instance_uuid):
+                instance_uuid = instance_ref['uuid']
+                kwargs['instance_uuid'] = instance_ref['uuid']
+
+            LOG.debug(_("%s called: %s"), fn.__name__, str(kwargs))
+            if type(instance_ref) == dict:
+                # Cover for the case where we don't have a proper object.
+                instance_ref['name'] = CONF.instance_name_template % instance_ref['id']
+
+            LOG.debug("Locking instance %s (fn:%s)" % (instance_uuid, fn.__name__))
+            # Keep the instance lookup out of the time spent waiting for the lock.
+            operation.phase("lookup")
+            self._lock_instance(instance_uuid)
+            metrics.LOCK_WAITS.observe(operation.phase("lock wait"), (fn.__name__,))
+            try:
+                result = fn(self, context, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                self._unlock_instance(instance_uuid)
+                LOG.debug(_("Unlocked instance %s (fn: %s)" % (instance_uuid, fn.__name__)))
         finally:
-            self._unlock_instance(instance_uuid)
-            LOG.debug(_("Unlocked instance %s (fn: %s)" % (instance_uuid, fn.__name__)))
+            if entry != None:
+                self.journal.end(entry)
+            self.recorder.end(operation, outcome)
+            metrics.OPERATIONS.observe(operation.duration, (fn.__name__, outcome))
+            tracing.set_current(previous_trace_id)
 
     wrapped_fn.__name__ = fn.__name__
     wrapped_fn.__doc__ = fn.__doc__
 
     return wrapped_fn
 
-def memory_string_to_pages(mem):
-    mem = mem.lower()
-    units = { '^(\d+)tb$' : 40,
-              '^(\d+)gb$' : 30,
-              '^(\d+)mb$' : 20,
-              '^(\d+)kb$' : 10,
-              '^(\d+)b$' : 0,
-              '^(\d+)$' : 0 }
-    for (pattern, shift) in units.items():
-        m = re.match(pattern, mem)
-        if m is not None:
-            val = long(m.group(1))
-            memory = val << shift
-            # Shift to obtain pages, at least one
-            return max(1, memory >> 12)
-    raise ValueError('Invalid target string %s.' % mem)
-
 def _log_error(operation):
     """ Log exceptions with a common format. """
     LOG.exception(_("Error during %s") % operation)
@@ -144,6 +295,8 @@ class GridCentricManager(manager.SchedulerDependentManager):
         self.vms_conn = kwargs.pop('vmsconn', None)
 
         self._init_vms()
+        self.lifecycle_events = False
+        self.refresh_ticks = 0
         self.network_api = network.API()
         self.gridcentric_api = API()
         self.compute_manager = compute_manager.ComputeManager()
@@ -154,6 +307,50 @@ class GridCentricManager(manager.SchedulerDependentManager):
         # it. Since the main threading module is not monkey patched we cannot use it directly.
         self.cond = gthreading.Condition()
         self.locked_instances = {}
+
+        # Only a single pass over the clone pools runs at a time, otherwise a refill kicked off by
+        # an unpool could race with the periodic one and overfill the pool.
+        self.pool_lock = gthreading.Lock()
+
+        # The fixed IP addresses reserved on this host, keyed by network uuid.
+        self.network_reservoir = {}
+        self.reservoir_lock = gthreading.Lock()
+
+        # The progress of the latest evacuation of this host.
+        self.evacuation = None
+
+        # The memory servers run by this host for fan-out launches, mapped to their start time.
+        self.memory_servers = {}
+
+        # The migrations out of this host and the migration launches into this host that are in
+        # flight, by instance uuid, see cancel_migration().
+        self.migrations = {}
+        self.incoming_launches = {}
+
+        # The clones whose memory target was lowered by the memory pressure policy, mapped to
+        # the target they had before.
+        self.pressure_targets = {}
+
+        # When the working sets of the clones on this host were last sampled.
+        self.working_sets_sampled = 0
+
+        # The blessed instances whose prefetch hint is being recorded on this host.
+        self.prefetch_captures = set()
+
+        # The instance updates being retried, keyed by instance uuid, see _instance_update.
+        self.pending_updates = {}
+        self.db_retry_semaphore = gthreading.Semaphore(CONF.gridcentric_db_max_retrying)
+
+        # The outgoing device for migrations, by destination host.
+        self.route_cache = routes.RouteCache(CONF.gridcentric_migration_address_ttl)
+
+        # The operations in flight on this host, see journal.
+        self.journal = journal.Journal(CONF.gridcentric_journal_dir)
+
+        # The recent operations on instances, see flightrecorder.
+        self.recorder = flightrecorder.RECORDER
+        self.recorder.resize(CONF.gridcentric_flight_recorder_size)
+        self.admin_socket = None
         super(GridCentricManager, self).__init__(service_name="gridcentric", *args, **kwargs)
 
     def _init_vms(self):
@@ -199,22 +396,102 @@ class GridCentricManager(manager.SchedulerDependentManager):
         finally:
             self.cond.release()
 
+    def init_host(self):
+        """ Recovers the state of this host left over by a previous run of the service. """
+        context = nova_context.get_admin_context()
+        try:
+            self._recover_network_reservoir(context)
+        except:
+            _log_error("network reservoir recovery")
+
+        try:
+            self._register_lifecycle_events()
+        except:
+            _log_error("lifecycle event registration")
+
+        try:
+            self._recover_journal(context)
+        except:
+            _log_error("journal recovery")
+
+        if CONF.gridcentric_admin_socket:
+            try:
+                self._start_admin_socket()
+            except:
+                _log_error("admin socket setup")
+
+        if CONF.gridcentric_metrics_port:
+            try:
+                metrics.serve(CONF.gridcentric_metrics_port)
+            except:
+                _log_error("metrics exporter setup")
+
+    def _start_admin_socket(self):
+        self.admin_socket = adminsocket.AdminSocket(CONF.gridcentric_admin_socket)
+        self.admin_socket.register('recorder', self.recorder.dump)
+        self.admin_socket.register('profile', self._start_profile)
+        self.admin_socket.start()
+
+    def _start_profile(self, seconds=None):
+        """ Profiles the service for a while, see profiler. """
+        if seconds != None:
+            seconds = int(seconds)
+        return {'profile': profiler.PROFILER.start(seconds)}
+
     def _instance_update(self, context, instance_uuid, **kwargs):
-        """Update an instance in the database using kwargs as value."""
+        """
+        Update an instance in the database using kwargs as value. While a failed update of an
+        instance is being retried, later updates of the same instance are merged into it (the
+        latest value of each field wins) and wait for it to be written.
+        """
+        pending = self.pending_updates.get(instance_uuid, None)
+        if pending != None:
+            (values, done) = pending
+            values.update(kwargs)
+            return done.wait()
+
+        try:
+            return self.db.instance_update(context, instance_uuid, kwargs)
+        except:
+            LOG.warn(_("Failed to update instance %s, retrying."), instance_uuid)
+
+        values = dict(kwargs)
+        done = event.Event()
+        self.pending_updates[instance_uuid] = (values, done)
+        try:
+            result = self._retry_instance_update(context, instance_uuid, values)
+        except Exception, e:
+            del self.pending_updates[instance_uuid]
+            done.send_exception(e)
+            raise e
+        del self.pending_updates[instance_uuid]
+        done.send(result)
+        return result
+
+    def _retry_instance_update(self, context, instance_uuid, values):
         retries = 0
         while True:
+            # Database updates are idempotent, so we can retry this when we encounter transient
+            # failures. This gives us a decent window for avoiding database restarts, etc.
+            retries += 1
+            delay = min(CONF.gridcentric_db_retry_max_delay,
+                        CONF.gridcentric_db_retry_delay * (2 ** (retries - 1)))
+            greenthread.sleep(random.uniform(0, delay))
+
+            metrics.INSTANCE_UPDATE_RETRIES.inc()
+            self.db_retry_semaphore.acquire()
             try:
-                # Database updates are idempotent, so we can retry this when
-                # we encounter transient failures. We retry up to 10 seconds.
-                return self.db.instance_update(context, instance_uuid, kwargs)
+                while True:
+                    written = dict(values)
+                    result = self.db.instance_update(context, instance_uuid, written)
+                    if written == values:
+                        return result
+                    # More updates were merged in while this one was being written.
             except:
-                # We retry the database update up to 60 seconds. This gives
-                # us a decent window for avoiding database restarts, etc.
-                if retries < 12:
-                    retries += 1
-                    time.sleep(5.0)
-                else:
+                if retries >= CONF.gridcentric_db_retries:
                     raise
+            finally:
+                self.db_retry_semaphore.release()
 
     def _instance_metadata(self, context, instance_uuid):
         """ Looks up and returns the instance metadata """
@@ -224,9 +501,196 @@ class GridCentricManager(manager.SchedulerDependentManager):
         """ Updates the instance metadata """
         return self.db.instance_metadata_update(context, instance_uuid, metadata, True)
 
+    def _reconcile_instance(self, context, instance, is_local):
+        """
+        Checks the instance for a stalled migration and fixes up the database to reflect where
+        the instance actually is. is_local is whether the instance is running on this host. The
+        caller must hold self.cond.
+        """
+
+        # If the instance is locked, then there is some active
+        # tasks working with this instance (and the BUILDING state
+        # and/or MIGRATING state) is completely fine.
+        if instance['uuid'] in self.locked_instances:
+            return
+
+        if instance['task_state'] == task_states.MIGRATING:
+
+            # Set defaults.
+            state = None
+            host = self.host
+
+            # Grab metadata.
+            metadata = self._instance_metadata(context, instance['uuid'])
+            src_host = metadata.get('gc_src_host', None)
+            dst_host = metadata.get('gc_dst_host', None)
+
+            if is_local:
+                if self.host == src_host:
+                    # This is a rollback, it's here and no migration is
+                    # going on.  We simply update the database to
+                    # reflect this reality.
+                    state = vm_states.ACTIVE
+                    task = None
+
+                elif self.host == dst_host:
+                    # This shouldn't really happen. The only case in which
+                    # it could happen is below, where we've been punted this
+                    # VM from the source host.
+                    state = vm_states.ACTIVE
+                    task = None
+
+                    # Try to ensure the networks are configured correctly.
+                    self.network_api.setup_networks_on_host(context, instance)
+            else:
+                if self.host == src_host:
+                    # The VM may have been moved, but the host did not change.
+                    # We update the host and let the destination take care of
+                    # the status.
+                    state = instance['vm_state']
+                    task = instance['task_state']
+                    host = dst_host
+
+
+                elif self.host == dst_host:
+                    # This VM is not here, and there's no way it could be back
+                    # at its origin. We must mark this as an error.
+                    state = vm_states.ERROR
+                    task = None
+
+            if state:
+                self._instance_update(context, instance['uuid'], vm_state=state,
+                                      task_state=task, host=host)
+
+    def _recover_journal(self, context):
+        """
+        Resumes or rolls back each of the operations that were interrupted by the restart of the
+        service, from the phases they recorded in the journal.
+        """
+        recoveries = {'bless_instance': self._recover_bless,
+                      'launch_instance': self._recover_launch,
+                      'migrate_instance': self._recover_migration,
+                      'discard_instance': self._recover_discard}
+        for entry in self.journal.load():
+            try:
+                if entry.operation in recoveries and 'start' in entry.phases:
+                    LOG.info(_("Recovering %s of instance %s (phases: %s)."), entry.operation,
+                             entry.instance_uuid, ", ".join(entry.phases.keys()))
+                    recoveries[entry.operation](context, entry)
+            except:
+                _log_error("recovery of %s" % entry.operation)
+            entry.close()
+
+    def _recover_bless(self, context, entry):
+        if entry.phases['start']['migration']:
+            # Migration blesses are recovered along with their migration.
+            return
+
+        instance_uuid = entry.instance_uuid
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        blessed_files = entry.phases.get('blessed', {}).get('blessed_files', [])
+        if 'uploaded' in entry.phases:
+            # Only the database updates were left, finish them.
+            metadata = self._instance_metadata(context, instance_uuid)
+            metadata['images'] = ','.join(entry.phases['uploaded']['image_refs'])
+            metadata['blessed'] = True
+            self._instance_metadata_update(context, instance_uuid, metadata)
+            self._instance_update(context, instance_uuid,
+                                  vm_state="blessed", task_state=None,
+                                  launched_at=timeutils.utcnow(),
+                                  disable_terminate=True)
+        else:
+            # Roll back, as for a failed bless.
+            self.vms_conn.discard(context, instance_ref['name'], image_refs=[])
+            self._instance_update(context, instance_uuid,
+                                  vm_state=vm_states.ERROR, task_state=None)
+        self.vms_conn.bless_cleanup(blessed_files)
+
+    def _recover_launch(self, context, entry):
+        if entry.phases['start']['migration']:
+            # Migration launches are recovered by the source host of the migration.
+            return
+
+        instance_uuid = entry.instance_uuid
+        if 'launched' in entry.phases:
+            # The instance is running, only the database updates were left.
+            instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+            self._instance_update(context, instance_uuid,
+                                  power_state=self.compute_manager._get_power_state(
+                                                context, instance_ref),
+                                  vm_state=vm_states.ACTIVE,
+                                  host=self.host,
+                                  task_state=None,
+                                  launched_at=timeutils.utcnow())
+        else:
+            self._instance_update(context, instance_uuid,
+                                  vm_state=vm_states.ERROR,
+                                  host=self.host,
+                                  task_state=None)
+
+    def _recover_migration(self, context, entry):
+        instance_uuid = entry.instance_uuid
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        if 'blessed' not in entry.phases:
+            # The instance never left this host.
+            self._instance_update(context, instance_uuid, vm_state=vm_states.ACTIVE,
+                                  task_state=None, host=self.host)
+            return
+
+        blessed = entry.phases['blessed']
+        dest = entry.phases['start']['dest']
+        if 'launched' not in entry.phases and instance_ref['host'] != dest and \
+           not(self._migration_launched(context, instance_ref, dest)):
+            # The destination did not take the instance over. Relaunch it here from the memory
+            # server, as migrate_instance does when the remote launch fails.
+            self.launch_instance(context,
+                                 instance_ref=instance_ref,
+                                 migration_url=blessed['migration_url'],
+                                 migration_network_info=blessed['network_info'])
+            self._release_migration_destination(context, instance_ref, dest)
+
+        # Discard the migration artifacts.
+        metadata = self._instance_metadata(context, instance_uuid)
+        self.vms_conn.discard(context, instance_ref['name'],
+                              image_refs=self._extract_image_refs(metadata))
+
+    def _migration_launched(self, context, instance_ref, dest):
+        """
+        Returns whether the destination of an interrupted migration took the instance over. The
+        destination may still be launching it, in which case this waits for the launch to end.
+        """
+        try:
+            return rpc.call(context,
+                            rpc.queue_get_for(context, CONF.gridcentric_topic, dest),
+                            {"method": "migration_launch_status",
+                             "args": {"instance_uuid": instance_ref['uuid']}})
+        except:
+            # Without an answer, the instance may be running over there. Better to leave it in
+            # error than to end up with two copies of it.
+            self._instance_update(context, instance_ref['uuid'], vm_state=vm_states.ERROR,
+                                  task_state=None)
+            raise
+
+    def _recover_discard(self, context, entry):
+        try:
+            self.db.instance_get_by_uuid(context, entry.instance_uuid)
+        except exception.InstanceNotFound:
+            # The discard got as far as removing the instance.
+            return
+        # Discarding again is harmless.
+        self.discard_instance(context, instance_uuid=entry.instance_uuid)
+
     @manager.periodic_task
     def _refresh_host(self, context):
 
+        if self.lifecycle_events:
+            # Lifecycle events take care of reconciling instances as things happen, so the
+            # full scan is only a safety net for events that were missed.
+            self.refresh_ticks += 1
+            if self.refresh_ticks < CONF.gridcentric_refresh_host_ticks:
+                return
+            self.refresh_ticks = 0
+
         # Grab the global lock and fetch all instances.
         self.cond.acquire()
 
@@ -235,71 +699,76 @@ class GridCentricManager(manager.SchedulerDependentManager):
             db_instances = self.db.instance_get_all_by_host(context, self.host)
             local_instances = self.compute_manager.driver.list_instances()
             for instance in db_instances:
+                self._reconcile_instance(context, instance, instance['name'] in local_instances)
 
-                # If the instance is locked, then there is some active
-                # tasks working with this instance (and the BUILDING state
-                # and/or MIGRATING state) is completely fine.
-                if instance['uuid'] in self.locked_instances:
-                    continue
+        finally:
+            self.cond.release()
+
+    def _register_lifecycle_events(self):
+        """
+        Subscribes to the lifecycle events of the hypervisor. Every compute driver accepts event
+        listeners, but only the libvirt driver actually emits events.
+        """
+        if CONF.connection_type != 'libvirt':
+            LOG.info(_("The %s compute driver does not emit lifecycle events, falling back "
+                       "to polling."), CONF.connection_type)
+            return
+
+        import libvirt
+
+        driver = self.compute_manager.driver
+        driver.register_event_listener(self._handle_lifecycle_event)
+        # Start the event loop of the driver, as its init_host() does. The rest of the host
+        # initialization is left to nova-compute.
+        libvirt.virEventRegisterDefaultImpl()
+        driver._init_events()
+        self.lifecycle_events = True
+
+    def _handle_lifecycle_event(self, event):
+        """ Reconciles the instance named in the lifecycle event right away. """
+        context = nova_context.get_admin_context()
+        try:
+            instance = self.db.instance_get_by_uuid(context, event.get_instance_uuid())
+        except exception.InstanceNotFound:
+            return
 
-                if instance['task_state'] == task_states.MIGRATING:
-
-                    # Set defaults.
-                    state = None
-                    host = self.host
-
-                    # Grab metadata.
-                    metadata = self._instance_metadata(context, instance['uuid'])
-                    src_host = metadata.get('gc_src_host', None)
-                    dst_host = metadata.get('gc_dst_host', None)
-
-                    if instance['name'] in local_instances:
-                        if self.host == src_host:
-                            # This is a rollback, it's here and no migration is
-                            # going on.  We simply update the database to
-                            # reflect this reality.
-                            state = vm_states.ACTIVE
-                            task = None
-
-                        elif self.host == dst_host:
-                            # This shouldn't really happen. The only case in which
-                            # it could happen is below, where we've been punted this
-                            # VM from the source host.
-                            state = vm_states.ACTIVE
-                            task = None
-
-                            # Try to ensure the networks are configured correctly.
-                            self.network_api.setup_networks_on_host(context, instance)
-                    else:
-                        if self.host == src_host:
-                            # The VM may have been moved, but the host did not change.
-                            # We update the host and let the destination take care of
-                            # the status.
-                            state = instance['vm_state']
-                            task = instance['task_state']
-                            host = dst_host
-
-
-                        elif self.host == dst_host:
-                            # This VM is not here, and there's no way it could be back
-                            # at its origin. We must mark this as an error.
-                            state = vm_states.ERROR
-                            task = None
-
-                    if state:
-                        self._instance_update(context, instance['uuid'], vm_state=state,
-                                              task_state=task, host=host)
+        # A domain is running on this host unless it has just stopped.
+        is_local = event.get_transition() != virtevent.EVENT_LIFECYCLE_STOPPED
 
+        self.cond.acquire()
+        try:
+            LOG.debug(_("Lifecycle event %s for instance %s"),
+                      event.get_transition(), instance['uuid'])
+            self._reconcile_instance(context, instance, is_local)
+        except:
+            _log_error("lifecycle event")
         finally:
             self.cond.release()
 
     def _get_migration_address(self, dest):
         if CONF.gridcentric_outgoing_migration_address != None:
             return CONF.gridcentric_outgoing_migration_address
+        return self.route_cache.lookup(dest, self._resolve_migration_address)
 
+    def _resolve_migration_address(self, dest):
         # Figure out the interface to reach 'dest'.
         # This is used to construct our out-of-band network parameter below.
         dest_ip = socket.gethostbyname(dest)
+        try:
+            (devname, is_local) = routes.route_device(dest_ip)
+        except:
+            _log_error("netlink route lookup")
+            devname = self._ip_route_device(dest_ip)
+            is_local = False
+
+        # Check that this is not local.
+        if is_local or devname == "lo":
+            raise exception.NovaException(_("Can't migrate to the same host."))
+
+        # Return the device name.
+        return devname
+
+    def _ip_route_device(self, dest_ip):
         iproute = subprocess.Popen(["ip", "route", "get", dest_ip], stdout=subprocess.PIPE)
         (stdout, stderr) = iproute.communicate()
         lines = stdout.split("\n")
@@ -313,11 +782,6 @@ class GridCentricManager(manager.SchedulerDependentManager):
             _log_error("garbled route output: %s" % lines[0])
             raise
 
-        # Check that this is not local.
-        if devname == "lo":
-            raise exception.NovaException(_("Can't migrate to the same host."))
-
-        # Return the device name.
         return devname
 
     def _extract_image_refs(self, metadata):
@@ -331,11 +795,14 @@ class GridCentricManager(manager.SchedulerDependentManager):
         Returns a the instance reference for the source instance of instance_id. In other words:
         if instance_id is a BLESSED instance, it returns the instance that was blessed
         if instance_id is a LAUNCH instance, it returns the blessed instance.
+        if instance_id is a POOLED instance, it returns the blessed instance.
         if instance_id is neither, it returns NONE.
         """
         metadata = self._instance_metadata(context, instance_uuid)
         if "launched_from" in metadata:
             source_instance_uuid = metadata["launched_from"]
+        elif "pooled_from" in metadata:
+            source_instance_uuid = metadata["pooled_from"]
         elif "blessed_from" in metadata:
             source_instance_uuid = metadata["blessed_from"]
         else:
@@ -345,11 +812,15 @@ class GridCentricManager(manager.SchedulerDependentManager):
             return self.db.instance_get_by_uuid(context, source_instance_uuid)
         return None
 
-    def _notify(self, context, instance_ref, operation, network_info=None):
+    def _notify(self, context, instance_ref, operation, network_info=None, extra_info=None):
         try:
             usage_info = notifications.info_from_instance(context, instance_ref,
                                                           network_info=network_info,
                                                           system_metadata=None)
+            if extra_info:
+                usage_info.update(extra_info)
+            if tracing.current():
+                usage_info['trace_id'] = tracing.current()
             notifier.notify(context, 'gridcentric.%s' % self.host,
                             'gridcentric.instance.%s' % operation,
                             notifier.INFO, usage_info)
@@ -370,6 +841,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
         bless will ensure a memory server is available at the given migration url.
         """
 
+        self.journal.record("start", migration=migration_url != None)
         if migration_url:
             # Tweak only this instance directly.
             source_instance_ref = instance_ref
@@ -389,6 +861,8 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                                 source_instance_ref['name'],
                                                 instance_ref,
                                                 migration_url=migration_url)
+            self.recorder.phase("vms bless")
+            self.journal.record("blessed", blessed_files=blessed_files)
         except Exception, e:
             _log_error("bless")
 
@@ -403,6 +877,8 @@ class GridCentricManager(manager.SchedulerDependentManager):
             # post_bless() fails and we need to cleanup artifacts.
             image_refs = []
             image_refs = self.vms_conn.post_bless(context, instance_ref, blessed_files)
+            self.recorder.phase("post bless")
+            self.journal.record("uploaded", image_refs=image_refs)
 
             # Mark this new instance as being 'blessed'. If this fails,
             # we simply clean up all metadata and attempt to mark the VM
@@ -453,9 +929,17 @@ class GridCentricManager(manager.SchedulerDependentManager):
     @_lock_call
     def migrate_instance(self, context, instance_uuid=None, instance_ref=None, dest=None):
         """
-        Migrates an instance, dealing with special streaming cases as necessary.
+        Migrates an instance, dealing with special streaming cases as necessary. The migration
+        can be cancelled with cancel_migration() until the instance runs on the destination.
         """
+        migration = {'dest': dest, 'launching': False, 'cancelled': False}
+        self.migrations[instance_uuid] = migration
+        try:
+            self._migrate_instance(context, instance_uuid, instance_ref, dest, migration)
+        finally:
+            del self.migrations[instance_uuid]
 
+    def _migrate_instance(self, context, instance_uuid, instance_ref, dest, migration):
         # FIXME: This live migration code does not currently support volumes,
         # nor floating IPs. Both of these would be fairly straight-forward to
         # add but probably cry out for a better factoring of this class as much
@@ -488,6 +972,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
         metadata['gc_src_host'] = self.host
         metadata['gc_dst_host'] = dest
         self._instance_metadata_update(context, instance_uuid, metadata)
+        self.journal.record("start", dest=dest)
 
         # Prepare the destination for live migration.
         rpc.call(context, compute_dest_queue,
@@ -496,12 +981,21 @@ class GridCentricManager(manager.SchedulerDependentManager):
                   "args": {'instance': instance_ref,
                            'block_migration': False,
                            'disk': None}})
+        self.recorder.phase("prepare destination")
+
+        if migration['cancelled']:
+            # Nothing has happened to the instance yet.
+            self._release_migration_destination(context, instance_ref, dest)
+            self._instance_update(context, instance_uuid, task_state=None)
+            LOG.info(_("Cancelled the migration of %s to %s."), instance_uuid, dest)
+            return
 
         # Bless this instance for migration.
         migration_url = self.bless_instance(context,
                                             instance_ref=instance_ref,
                                             migration_url="mcdist://%s" % migration_address,
                                             migration_network_info=network_info)
+        self.journal.record("blessed", migration_url=migration_url, network_info=network_info)
 
         # Run our premigration hook.
         self.vms_conn.pre_migration(context, instance_ref, network_info, migration_url)
@@ -516,15 +1010,28 @@ class GridCentricManager(manager.SchedulerDependentManager):
             # disk size or some other parameter. But we will get a response if an
             # exception occurs in the remote thread, so the worse case here is
             # really just the machine dying or the service dying unexpectedly.
+            if migration['cancelled']:
+                raise exception.NovaException(_("The migration was cancelled."))
+            migration['launching'] = True
             rpc.call(context, gc_dest_queue,
                     {"method": "launch_instance",
                      "args": {'instance_ref': instance_ref,
                               'migration_url': migration_url,
-                              'migration_network_info': network_info}})
+                              'migration_network_info': network_info,
+                              'trace_id': tracing.current()}})
+            self.recorder.phase("remote launch")
             changed_hosts = True
+            self.journal.record("launched", changed_hosts=True)
+            if migration['cancelled']:
+                LOG.info(_("Instance %s was already running on %s, the migration was not "
+                           "cancelled."), instance_uuid, dest)
 
         except:
-            _log_error("remote launch")
+            if migration['cancelled']:
+                LOG.info(_("Cancelled the migration of %s to %s, relaunching it here."),
+                         instance_uuid, dest)
+            else:
+                _log_error("remote launch")
 
             # Try relaunching on the local host. Everything should still be setup
             # for this to happen smoothly, and the _launch_instance function will
@@ -536,7 +1043,12 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                  instance_ref=instance_ref,
                                  migration_url=migration_url,
                                  migration_network_info=network_info)
+            self.recorder.phase("local relaunch")
             changed_hosts = False
+            self.journal.record("launched", changed_hosts=False)
+
+            # The destination no longer needs what pre_live_migration set up for the instance.
+            self._release_migration_destination(context, instance_ref, dest)
 
         # Teardown any specific migration state on this host.
         # If this does not succeed, we may be left with some
@@ -578,17 +1090,92 @@ class GridCentricManager(manager.SchedulerDependentManager):
 
         self.vms_conn.discard(context, instance_ref["name"], image_refs=image_refs)
 
+    def _release_migration_destination(self, context, instance_ref, dest):
+        """
+        Undoes the preparation of dest for the migration of the instance (its networking, and the
+        domain of a failed launch) once the instance stays on this host.
+        """
+        try:
+            rpc.call(context, rpc.queue_get_for(context, CONF.compute_topic, dest),
+                {"method": "rollback_live_migration_at_destination",
+                 "version": "2.2",
+                 "args": {'instance': instance_ref}})
+        except:
+            _log_error("migration destination cleanup")
+
+    def cancel_migration(self, context, instance_uuid=None, trace_id=None):
+        """
+        Cancels the migration of the instance off this host. If the destination is already
+        launching the instance, that launch is aborted and the instance is relaunched here from
+        its memory server (as for a failed migration). A migration that has completed is left
+        alone.
+        """
+        previous_trace_id = tracing.set_current(trace_id or tracing.for_context(context))
+        try:
+            migration = self.migrations.get(instance_uuid, None)
+            if migration == None:
+                raise exception.NovaException(_("Instance %s is not migrating from this host.") %
+                                              instance_uuid)
+
+            LOG.info(_("Cancelling the migration of %s to %s."), instance_uuid, migration['dest'])
+            migration['cancelled'] = True
+            if migration['launching']:
+                rpc.cast(context,
+                         rpc.queue_get_for(context, CONF.gridcentric_topic, migration['dest']),
+                         {"method": "cancel_launch",
+                          "args": {'instance_uuid': instance_uuid,
+                                   'trace_id': tracing.current()}})
+        finally:
+            tracing.set_current(previous_trace_id)
+
+    def cancel_launch(self, context, instance_uuid=None, trace_id=None):
+        """
+        Aborts the migration launch of the instance on this host, unless the instance is already
+        running here. The failed launch makes the source host take the instance back.
+        """
+        previous_trace_id = tracing.set_current(trace_id or tracing.for_context(context))
+        try:
+            launch = self.incoming_launches.get(instance_uuid, None)
+            if launch == None:
+                LOG.info(_("No migration of %s to abort, it is already over."), instance_uuid)
+                return
+
+            launch['cancelled'] = True
+            if launch['launching']:
+                LOG.info(_("Aborting the migration launch of %s."), instance_uuid)
+                try:
+                    self.vms_conn.abort_launch(context, launch['name'])
+                except:
+                    # E.g. vms has not set up its control yet. The launch sees that it was
+                    # cancelled once vms is done, and tears itself down then.
+                    _log_error("migration launch abort")
+        finally:
+            tracing.set_current(previous_trace_id)
+
+    @_lock_call
+    def migration_launch_status(self, context, instance_uuid=None, instance_ref=None):
+        """
+        Returns whether the instance was migrated onto this host. A migration launch of the
+        instance that is still in progress holds the instance lock, so this answers once the
+        launch is over.
+        """
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        return instance_ref['host'] == self.host and instance_ref['vm_state'] == vm_states.ACTIVE
+
     @_lock_call
     def discard_instance(self, context, instance_uuid=None, instance_ref=None):
         """ Discards an instance so that no further instances maybe be launched from it. """
 
+        self.journal.record("start")
         self._notify(context, instance_ref, "discard.start")
         metadata = self._instance_metadata(context, instance_uuid)
-        image_refs = self._extract_image_refs(metadata)
+        image_refs = self._extract_image_refs(metadata) + \
+            self._prefetch_refs(context, instance_uuid).values()
 
         # Call discard in the backend.
         self.vms_conn.discard(context, instance_ref['name'], image_refs=image_refs)
-
+        self.recorder.phase("vms discard")
+        self._release_prewarmed(context, instance_uuid, image_refs)
 
         # Update the instance metadata (for completeness).
         metadata['blessed'] = False
@@ -603,6 +1190,23 @@ class GridCentricManager(manager.SchedulerDependentManager):
         self.db.instance_destroy(context, instance_uuid)
         self._notify(context, instance_ref, "discard.end")
 
+    def _release_prewarmed(self, context, instance_uuid, image_refs):
+        """
+        Tells the other hosts that pre-warmed the blessed instance to let go of its artifacts,
+        which they would otherwise keep cached (and possibly locked in memory).
+        """
+        system_metadata = self.db.instance_system_metadata_get(context, instance_uuid)
+        for key in system_metadata:
+            if not(key.startswith(PREWARMED_PREFIX)):
+                continue
+            host = key[len(PREWARMED_PREFIX):]
+            if host == self.host:
+                continue
+            rpc.cast(context,
+                     rpc.queue_get_for(context, CONF.gridcentric_topic, host),
+                     {"method": "release_prewarmed",
+                      "args": {"image_refs": image_refs}})
+
     def _instance_network_info(self, context, instance_ref, already_allocated):
         """
         Retrieve the network info for the instance. If the info is already_allocated then
@@ -624,7 +1228,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
             # cast because we are not waiting on any return value.
 
             is_vpn = False
-            requested_networks = None
+            requested_networks = self._claim_reserved_networks(context)
 
             try:
                 self._instance_update(context, instance_ref['uuid'],
@@ -633,52 +1237,120 @@ class GridCentricManager(manager.SchedulerDependentManager):
                 instance_ref['host'] = self.host
                 LOG.debug(_("Making call to network for launching instance=%s"), \
                       instance_ref.name)
-                network_info = self.network_api.allocate_for_instance(context,
-                                            instance_ref, vpn=is_vpn,
-                                            requested_networks=requested_networks)
+                try:
+                    # The network associates a requested address with the instance whether or
+                    # not it is reserved, so the reserved addresses are handed over as they are.
+                    network_info = self.network_api.allocate_for_instance(context,
+                                                instance_ref, vpn=is_vpn,
+                                                requested_networks=requested_networks)
+                except:
+                    if requested_networks == None:
+                        raise
+                    # Fall back to letting the network pick the addresses.
+                    _log_error("reserved network allocation")
+                    self._release_claimed_addresses(context, requested_networks)
+                    network_info = self.network_api.allocate_for_instance(context,
+                                                instance_ref, vpn=is_vpn,
+                                                requested_networks=[(network_uuid, None)
+                                                    for (network_uuid, address)
+                                                    in requested_networks])
+                else:
+                    self._release_claimed_addresses(context, requested_networks)
                 LOG.debug(_("Made call to network for launching instance=%s, network_info=%s"),
                       instance_ref.name, network_info)
             except Exception, e:
-                _log_error("network allocation", e)
+                _log_error("network allocation")
 
         return network_info
 
+    def _setup_compute_networking(self, context, instance_ref):
+        """
+        Has nova-compute on this host setup the networking (and iptables rules) for the instance.
+        """
+        rpc.call(context,
+            rpc.queue_get_for(context, CONF.compute_topic, self.host),
+            {"method": "pre_live_migration",
+             "version": "2.2",
+             "args": {'instance': instance_ref,
+                      'block_migration': False,
+                      'disk': None}},
+            timeout=CONF.gridcentric_compute_timeout)
+
     @_lock_call
     def launch_instance(self, context, instance_uuid=None, instance_ref=None,
-                        params=None, migration_url=None, migration_network_info=None):
+                        params=None, migration_url=None, migration_network_info=None,
+                        memory_url=None):
         """
         Construct the launched instance, with uuid instance_uuid. If migration_url is not none then
-        the instance will be launched using the memory server at the migration_url
+        the instance will be launched using the memory server at the migration_url. If memory_url
+        is not none then the memory of the blessed instance is fetched from the memory server
+        shared by a fan-out launch.
         """
 
         if params == None:
             params = {}
+        launch_start = time.time()
+        self.journal.record("start", migration=migration_url != None)
 
-        # note(dscannell): The target is in pages so we need to convert the value
-        # If target is set as None, or not defined, then we default to "0".
-        target = params.get("target", "0")
-        if target != "0":
-            try:
-                target = str(memory_string_to_pages(target))
-            except ValueError as e:
-                LOG.warn(_('%s -> defaulting to no target'), str(e))
-                target = "0"
-
-        # Extract out the image ids from the source instance's metadata.
         metadata = self._instance_metadata(context, instance_uuid)
-        image_refs = self._extract_image_refs(metadata)
 
         if migration_url:
             # Update the instance state to be migrating. This will be set to
             # active again once it is completed in do_launch() as per all
             # normal launched instances.
             source_instance_ref = instance_ref
+            launch = {'name': instance_ref['name'], 'launching': False, 'cancelled': False}
+            self.incoming_launches[instance_uuid] = launch
+            source_metadata = metadata
 
         else:
             self._notify(context, instance_ref, "launch.start")
 
             # Create a new launched instance.
             source_instance_ref = self._get_source_instance(context, instance_uuid)
+            source_metadata = self._instance_metadata(context, source_instance_ref['uuid'])
+
+        # Extract out the image ids from the source instance's metadata. A migrating
+        # instance is its own source (see bless_instance).
+        image_refs = self._extract_image_refs(source_metadata)
+
+        # note(dscannell): The target is in pages so we need to convert the value
+        # If target is set as None, or not defined, then we default to "0".
+        target = params.get("target", "0")
+        if migration_url:
+            # Keep the target the instance was running with.
+            target = metadata.get('gc:target', "0")
+        elif target == "auto" or (target == "0" and CONF.gridcentric_auto_target):
+            target = self._learned_target(context, source_instance_ref)
+        elif target != "0":
+            try:
+                target = str(memory_string_to_pages(target))
+            except ValueError as e:
+                LOG.warn(_('%s -> defaulting to no target'), str(e))
+                target = "0"
+
+        if migration_url:
+            # Keep the policy the instance was running with.
+            vms_policy_profile = metadata.get('gc:vms_policy', '')
+        else:
+            vms_policy_profile = params.get('vms_policy', None) or \
+                source_metadata.get('gc:vms_policy', CONF.gridcentric_default_vms_policy)
+        profiles = vms_policy_profiles()
+        if vms_policy_profile and vms_policy_profile not in profiles:
+            LOG.warn(_("Unknown vms policy profile %s -> defaulting to no policy"),
+                     vms_policy_profile)
+            vms_policy_profile = ''
+        vms_policy = profiles.get(vms_policy_profile, '')
+
+        prefetch_refs = {}
+        prefetch_ref = None
+        if not(migration_url):
+            prefetch_refs = self._prefetch_refs(context, source_instance_ref['uuid'])
+        if prefetch_refs:
+            # Prefer the hint recorded on this host, it is already in the local image cache.
+            prefetch_ref = prefetch_refs.get(self.host,
+                                             prefetch_refs[sorted(prefetch_refs.keys())[0]])
+            image_refs = image_refs + [prefetch_ref]
 
         if migration_network_info != None:
             # (dscannell): Since this migration_network_info came over the wire we need
@@ -697,6 +1369,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
         # Update the task state to spawning from networking.
         self._instance_update(context, instance_ref['uuid'],
                               task_state=task_states.SPAWNING)
+        self.recorder.phase("network info")
 
         try:
             # The main goal is to have the nova-compute process take ownership of setting up
@@ -714,26 +1387,51 @@ class GridCentricManager(manager.SchedulerDependentManager):
             # NOTE(amscanne): This will happen prior to launching in the migration code, so
             # we don't need to bother with this call in that case.
             if not(migration_url):
-                rpc.call(context,
-                    rpc.queue_get_for(context, CONF.compute_topic, self.host),
-                    {"method": "pre_live_migration",
-                     "version": "2.2",
-                     "args": {'instance': instance_ref,
-                              'block_migration': False,
-                              'disk': None}},
-                    timeout=CONF.gridcentric_compute_timeout)
-
-            self.vms_conn.launch(context,
-                                 source_instance_ref['name'],
-                                 instance_ref,
-                                 network_info,
-                                 target=target,
-                                 migration_url=migration_url,
-                                 image_refs=image_refs,
-                                 params=params)
+                self._setup_compute_networking(context, instance_ref)
+                self.recorder.phase("compute networking")
 
+            try:
+                if migration_url:
+                    if launch['cancelled']:
+                        raise exception.NovaException(_("The migration of %s was cancelled.") %
+                                                      instance_uuid)
+                    launch['launching'] = True
+                self.vms_conn.launch(context,
+                                     source_instance_ref['name'],
+                                     instance_ref,
+                                     network_info,
+                                     target=target,
+                                     migration_url=migration_url,
+                                     image_refs=image_refs,
+                                     params=params,
+                                     vms_policy=vms_policy,
+                                     memory_url=memory_url,
+                                     prefetch_ref=prefetch_ref)
+            finally:
+                if migration_url and self.incoming_launches.get(instance_uuid, None) is launch:
+                    del self.incoming_launches[instance_uuid]
+            if migration_url and launch['cancelled']:
+                # The cancel came in while vms was launching, and either could not kill the
+                # launch yet or killed it just as it succeeded. Either way the source takes the
+                # instance back, so it must not run here. (Nothing yields between the launch
+                # leaving incoming_launches and this check, so no cancel can slip in between.)
+                LOG.info(_("Tearing down the cancelled migration launch of %s."), instance_uuid)
+                try:
+                    self.vms_conn.abort_launch(context, launch['name'])
+                except:
+                    _log_error("cancelled launch teardown")
+                raise exception.NovaException(_("The migration of %s was cancelled.") %
+                                              instance_uuid)
+            self.recorder.phase("vms launch")
+            self.journal.record("launched")
+
+            launch_duration = time.time() - launch_start
+            LOG.info(_("Launched instance %s in %.3fs (vms policy: %s)."),
+                     instance_uuid, launch_duration, vms_policy_profile or 'default')
             if not(migration_url):
-                self._notify(context, instance_ref, "launch.end", network_info=network_info)
+                self._notify(context, instance_ref, "launch.end", network_info=network_info,
+                             extra_info={'launch_duration': launch_duration,
+                                         'vms_policy': vms_policy_profile})
         except Exception, e:
             _log_error("launch")
             if not(migration_url):
@@ -745,6 +1443,16 @@ class GridCentricManager(manager.SchedulerDependentManager):
             raise e
 
         try:
+            if not(migration_url):
+                launch_metadata = {}
+                if target != "0":
+                    launch_metadata['gc:target'] = target
+                if vms_policy_profile:
+                    launch_metadata['gc:vms_policy'] = vms_policy_profile
+                if launch_metadata:
+                    self.db.instance_metadata_update(context, instance_uuid,
+                                                     launch_metadata, False)
+
             # Perform our database update.
             power_state = self.compute_manager._get_power_state(context, instance_ref)
             update_params = {'power_state': power_state,
@@ -757,6 +1465,12 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                   instance_uuid,
                                   **update_params)
 
+            if not(migration_url) and not(prefetch_refs) and \
+               CONF.gridcentric_use_image_service and \
+               CONF.gridcentric_prefetch_capture_delay > 0:
+                self._schedule_prefetch_capture(context, instance_uuid,
+                                                source_instance_ref['uuid'])
+
         except:
             # NOTE(amscanne): In this case, we do not throw an exception.
             # The VM is either in the BUILD state (on a fresh launch) or in
@@ -766,3 +1480,691 @@ class GridCentricManager(manager.SchedulerDependentManager):
             # is updated at some point with the correct state.
             _log_error("post launch update")
 
+
+    @_lock_call
+    def set_target(self, context, instance_uuid=None, instance_ref=None, target=None):
+        """
+        Changes the memory target of the running instance. The target is a memory string (as
+        for launches), "0" removes the target.
+        """
+        if instance_ref['host'] != self.host:
+            raise exception.NovaException(_("Cannot set the target of an instance that is on "
+                                            "another host."))
+        if not(self.vms_conn.supports_target()):
+            raise exception.NovaException(_("The installed version of vms does not support "
+                                            "memory targets."))
+        if target != "0":
+            target = str(memory_string_to_pages(target))
+
+        self._apply_target(context, instance_ref, target)
+        # The user's choice overrides whatever the memory pressure policy did.
+        self.pressure_targets.pop(instance_uuid, None)
+
+    def _apply_target(self, context, instance_ref, target):
+        """ Sets the memory target (in pages, as a string) of the instance and records it. """
+        self.vms_conn.set_target(context, instance_ref, int(target))
+        self.db.instance_metadata_update(context, instance_ref['uuid'],
+                                         {'gc:target': target}, False)
+
+    def _host_memory(self):
+        """ Returns the total and the free memory of this host, in bytes. """
+        meminfo = {}
+        with open('/proc/meminfo') as meminfo_file:
+            for line in meminfo_file:
+                fields = line.split()
+                meminfo[fields[0].rstrip(':')] = long(fields[1]) * 1024
+        free = meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+        return (meminfo['MemTotal'], free)
+
+    @manager.periodic_task
+    def _relieve_memory_pressure(self, context):
+        """
+        Lowers the memory targets of the clones on this host when the host runs short of memory,
+        and restores them once the pressure is gone. Each clone gives up the same fraction of its
+        resident memory, but never goes below the working set learned for its blessed instance.
+        """
+        if CONF.gridcentric_memory_pressure <= 0 or not(self.vms_conn.supports_target()):
+            return
+
+        (total, free) = self._host_memory()
+        wanted = int(total * CONF.gridcentric_memory_pressure)
+
+        if free >= 2 * wanted:
+            for instance_uuid, target in self.pressure_targets.items():
+                try:
+                    instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+                    if instance_ref['host'] == self.host:
+                        self._apply_target(context, instance_ref, target)
+                except exception.NotFound:
+                    pass
+                except:
+                    _log_error("target restore of %s" % instance_uuid)
+                    continue
+                del self.pressure_targets[instance_uuid]
+            return
+        elif free >= wanted:
+            return
+
+        clones = []
+        instances = self.db.instance_get_all_by_filters(context, {'host': self.host,
+                                                                  'vm_state': vm_states.ACTIVE,
+                                                                  'task_state': None,
+                                                                  'deleted': False})
+        for instance in instances:
+            metadata = self._instance_metadata(context, instance['uuid'])
+            if 'launched_from' not in metadata:
+                continue
+            try:
+                resident = self.vms_conn.working_set(context, instance)
+            except:
+                _log_error("working set sampling of %s" % instance['uuid'])
+                continue
+            if resident:
+                clones.append((instance, metadata, resident >> 12))
+
+        total_resident = sum([resident for (instance, metadata, resident) in clones])
+        if total_resident == 0:
+            return
+        shrink = min(1.0, float(wanted - free) / (total_resident << 12))
+        LOG.info(_("Host %s is short of memory (%s bytes free), lowering clone targets by %d%%."),
+                 self.host, free, int(shrink * 100))
+
+        for (instance, metadata, resident) in clones:
+            blessed_ref = self._get_source_instance(context, instance['uuid'])
+            floor = 0
+            if blessed_ref != None:
+                floor = int(self._learned_target(context, blessed_ref))
+            target = max(floor, int(resident * (1.0 - shrink)), 1)
+            current = int(metadata.get('gc:target', "0"))
+            if current != 0 and current <= target:
+                continue
+            try:
+                self._apply_target(context, instance, str(target))
+            except:
+                _log_error("target lowering of %s" % instance['uuid'])
+                continue
+            self.pressure_targets.setdefault(instance['uuid'], str(current))
+
+    def _prefetch_refs(self, context, blessed_uuid):
+        """
+        Returns the prefetch hints recorded for the blessed instance, as a dictionary of host to
+        image ref. Each host records its hint under its own system metadata key, so hosts that
+        capture a hint at the same time never overwrite each other (and every hint is discarded
+        along with the blessed instance).
+        """
+        prefetch_refs = {}
+        system_metadata = self.db.instance_system_metadata_get(context, blessed_uuid)
+        for key, value in system_metadata.iteritems():
+            if key.startswith(PREFETCH_PREFIX):
+                prefetch_refs[key[len(PREFETCH_PREFIX):]] = value
+        return prefetch_refs
+
+    def _schedule_prefetch_capture(self, context, instance_uuid, blessed_uuid):
+        """
+        Arranges for the pages touched by the newly launched instance to be recorded as the
+        prefetch hint of its blessed instance. Only one of the clones on this host does this.
+        """
+        if blessed_uuid in self.prefetch_captures:
+            return
+        self.prefetch_captures.add(blessed_uuid)
+        greenthread.spawn_after(CONF.gridcentric_prefetch_capture_delay,
+                                self._capture_prefetch_profile,
+                                context, instance_uuid, blessed_uuid)
+
+    def _capture_prefetch_profile(self, context, instance_uuid, blessed_uuid):
+        """
+        Records the pages touched by the instance as the prefetch hint of the blessed instance,
+        unless another host has recorded one in the meantime.
+        """
+        try:
+            if self._prefetch_refs(context, blessed_uuid):
+                return
+            instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+            if instance_ref['host'] != self.host or \
+               instance_ref['vm_state'] != vm_states.ACTIVE:
+                raise exception.NovaException(_("Instance %s is no longer running here.") %
+                                              instance_uuid)
+            blessed_ref = self.db.instance_get_by_uuid(context, blessed_uuid)
+            prefetch_refs = self.vms_conn.capture_prefetch_profile(context, instance_ref,
+                                                                   blessed_ref)
+            self.db.instance_system_metadata_update(context, blessed_uuid,
+                                                    {PREFETCH_PREFIX + self.host:
+                                                        prefetch_refs[0]},
+                                                    False)
+            LOG.info(_("Recorded prefetch hint %s for blessed instance %s."),
+                     prefetch_refs[0], blessed_uuid)
+        except:
+            # A later clone on this host will have another go.
+            _log_error("prefetch profile capture")
+        finally:
+            self.prefetch_captures.discard(blessed_uuid)
+
+    def _working_sets(self, context, blessed_uuid):
+        """
+        Returns the working sets learned by each host for the blessed instance, as a dictionary
+        of host to (working set in pages, number of samples). These are kept in the system
+        metadata of the blessed instance (so they do not count against the metadata quota of its
+        owner), under a key per host so that each host only ever writes its own.
+        """
+        working_sets = {}
+        system_metadata = self.db.instance_system_metadata_get(context, blessed_uuid)
+        for key, value in system_metadata.iteritems():
+            if key.startswith(WORKING_SET_PREFIX):
+                (pages, samples) = value.split(',')
+                working_sets[key[len(WORKING_SET_PREFIX):]] = (int(pages), int(samples))
+        return working_sets
+
+    def _learned_target(self, context, blessed_ref):
+        """
+        Returns the memory target (in pages) learned from the working sets of the clones of the
+        blessed instance, or "0" if not enough of them have been seen yet.
+        """
+        working_sets = self._working_sets(context, blessed_ref['uuid']).values()
+        samples = sum([samples for (pages, samples) in working_sets])
+        if samples < CONF.gridcentric_working_set_min_samples:
+            LOG.debug(_("Not enough working set samples for %s (%s), using no target."),
+                      blessed_ref['uuid'], samples)
+            return "0"
+
+        # The hosts that have seen more clones count for more.
+        working_set = sum([pages * samples for (pages, samples) in working_sets]) / samples
+        pages = int(working_set * (1.0 + CONF.gridcentric_working_set_margin))
+        # A target above the memory of the instance is no target at all.
+        max_pages = blessed_ref['memory_mb'] << 8
+        if pages >= max_pages:
+            return "0"
+        return str(max(1, pages))
+
+    def _record_working_set(self, context, blessed_uuid, pages):
+        """ Folds a working set sample (in pages) into the working set learned by this host. """
+        (working_set, samples) = self._working_sets(context, blessed_uuid).get(self.host, (0, 0))
+        if samples == 0:
+            working_set = pages
+        else:
+            working_set += int(CONF.gridcentric_working_set_weight * (pages - working_set))
+        self.db.instance_system_metadata_update(context, blessed_uuid,
+                                    {WORKING_SET_PREFIX + self.host:
+                                        "%s,%s" % (working_set, samples + 1)},
+                                    False)
+
+    @manager.periodic_task
+    def _sample_working_sets(self, context):
+        """
+        Records the resident working set of the clones running on this host against the blessed
+        instances they were launched from. Each blessed instance gets one sample per pass: the
+        largest working set among its clones.
+        """
+        now = time.time()
+        if now - self.working_sets_sampled < CONF.gridcentric_working_set_interval:
+            return
+        self.working_sets_sampled = now
+
+        peaks = {}
+        instances = self.db.instance_get_all_by_filters(context, {'host': self.host,
+                                                                  'vm_state': vm_states.ACTIVE,
+                                                                  'deleted': False})
+        for instance in instances:
+            # The metadata comes along with the instances.
+            metadata = dict([(item['key'], item['value']) for item in instance['metadata']])
+            blessed_uuid = metadata.get('launched_from', None)
+            if blessed_uuid == None:
+                continue
+            try:
+                working_set = self.vms_conn.working_set(context, instance)
+            except:
+                _log_error("working set sampling of %s" % instance['uuid'])
+                continue
+            if working_set:
+                peaks[blessed_uuid] = max(peaks.get(blessed_uuid, 0), working_set >> 12)
+
+        for blessed_uuid, pages in peaks.iteritems():
+            try:
+                self._record_working_set(context, blessed_uuid, pages)
+            except:
+                _log_error("working set recording for %s" % blessed_uuid)
+
+    @manager.periodic_task
+    def _report_capabilities(self, context):
+        """
+        Publishes the vms resources of this host: the number of clones, the memory held back
+        from them by their targets, the pre-warmed artifacts and the memory servers running. They
+        go to the scheduler as service capabilities, and into the stats of the host's compute
+        node, where the gridcentric API reads them for placement. The stats are all written on
+        every pass because nova-compute drops the stats it does not know about whenever it
+        updates the compute node.
+        """
+        clones = 0
+        overcommit_mb = 0
+        migrating = 0
+        for instance in self.db.instance_get_all_by_host(context, self.host):
+            if instance['vm_state'] != vm_states.ACTIVE:
+                continue
+            if instance['task_state'] == task_states.MIGRATING:
+                migrating += 1
+            metadata = dict([(item['key'], item['value']) for item in instance['metadata']])
+            if 'launched_from' not in metadata:
+                continue
+            clones += 1
+            target_mb = int(metadata.get('gc:target', "0")) >> 8
+            if target_mb > 0:
+                overcommit_mb += max(0, instance['memory_mb'] - target_mb)
+
+        capabilities = {'gridcentric_clones': clones,
+                        'gridcentric_overcommit_mb': overcommit_mb,
+                        'gridcentric_cached_images': len(self.vms_conn.prewarmed_artifacts),
+                        'gridcentric_memservers': len(self.memory_servers) + migrating}
+        self.update_service_capabilities(capabilities)
+
+        try:
+            service = self.db.service_get_by_compute_host(context, self.host)
+            self.db.compute_node_update(context, service['compute_node'][0]['id'],
+                                        {'stats': capabilities})
+        except:
+            _log_error("capability reporting")
+
+    @manager.periodic_task
+    def _export_metrics(self, context):
+        if CONF.gridcentric_metrics_file:
+            try:
+                metrics.write(CONF.gridcentric_metrics_file)
+            except:
+                _log_error("metrics export")
+
+    def get_stats(self, context, instance_uuid=None):
+        """
+        Returns the vms runtime counters of the instance. This does not take the instance lock
+        so that polling it does not wait behind (or hold up) other operations.
+        """
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        if instance_ref['host'] != self.host:
+            raise exception.NovaException(_("Instance %s is not running on this host.") %
+                                          instance_uuid)
+        stats = self.vms_conn.stats(context, instance_ref)
+        stats['host'] = self.host
+        return stats
+
+    def prewarm_instance(self, context, instance_uuid=None, mlock=False):
+        """
+        Loads the artifacts of the blessed instance into the page cache of this host, ahead of
+        launches. Returns the fraction of the artifacts that is resident.
+        """
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        metadata = self._instance_metadata(context, instance_uuid)
+        residency = self.vms_conn.prewarm(context, instance_ref,
+                                          self._extract_image_refs(metadata), mlock=mlock)
+        LOG.info(_("Pre-warmed blessed instance %s (%d%% resident)."), instance_uuid,
+                 int(residency * 100))
+        return residency
+
+    def release_prewarmed(self, context, image_refs=None):
+        """ Releases the pre-warmed artifacts of a discarded blessed instance. """
+        self.vms_conn.release_prewarmed(image_refs or [])
+
+    @_lock_call
+    def serve_instance(self, context, instance_uuid=None, instance_ref=None, dest=None):
+        """
+        Starts a memory server for the blessed instance, reachable from dest. The launches of a
+        fan-out batch all fetch their memory from this server. Returns the memory url.
+        """
+        memory_url = "mcdist://%s" % self._get_migration_address(dest)
+        metadata = self._instance_metadata(context, instance_uuid)
+        image_refs = self._extract_image_refs(metadata)
+
+        memory_url = self.vms_conn.serve(context, instance_ref['name'], instance_ref,
+                                         memory_url, image_refs=image_refs) or memory_url
+        self.memory_servers[memory_url] = time.time()
+        return memory_url
+
+    def stop_serving(self, context, memory_url=None):
+        """ Stops the memory server of a fan-out launch. """
+        self.memory_servers.pop(memory_url, None)
+        self.vms_conn.stop_serving(context, memory_url)
+
+    @manager.periodic_task
+    def _reap_memory_servers(self, context):
+        """
+        Stops the memory servers whose fan-out launches should have finished a long time ago.
+        This covers for the API going away before it could stop them.
+        """
+        now = time.time()
+        for memory_url, started in self.memory_servers.items():
+            if now - started > 2 * CONF.gridcentric_fanout_timeout:
+                LOG.warn(_("Stopping the stale memory server at %s."), memory_url)
+                try:
+                    self.stop_serving(context, memory_url=memory_url)
+                except:
+                    _log_error("memory server reaping")
+
+    def _pool_size(self, metadata):
+        """
+        Returns the number of pooled clones this host should keep for the blessed instance with
+        the given metadata. The pool is configured with the gc:pool_size and gc:pool_hosts (a
+        comma separated list of hosts) metadata on the blessed instance.
+        """
+        pool_hosts = [host.strip() for host in metadata.get('gc:pool_hosts', '').split(',')]
+        if self.host not in pool_hosts:
+            return 0
+        try:
+            return max(0, int(metadata.get('gc:pool_size', 0)))
+        except ValueError:
+            LOG.warn(_("Invalid pool size %s, not pooling clones."), metadata['gc:pool_size'])
+            return 0
+
+    @manager.periodic_task
+    def _refill_pools(self, context):
+        """ Tops up the pools of paused clones kept on this host. """
+        if not(self.pool_lock.acquire(False)):
+            # Another refill is already running.
+            return
+
+        try:
+            blessed_instances = self.db.instance_get_all_by_filters(context,
+                                                                    {'vm_state': 'blessed',
+                                                                     'deleted': False})
+            for blessed_ref in blessed_instances:
+                if blessed_ref['task_state'] != None:
+                    # The blessed instance is being discarded.
+                    continue
+                metadata = self._instance_metadata(context, blessed_ref['uuid'])
+                pool_size = self._pool_size(metadata)
+                if pool_size > 0:
+                    self._refill_pool(context, blessed_ref, pool_size)
+        finally:
+            self.pool_lock.release()
+
+    def _refill_pool(self, context, blessed_ref, pool_size):
+        """ Launches and pauses clones until this host's pool for blessed_ref is full. """
+        # NOTE: Pooled clones that ended up in the ERROR state still take up their slot in the
+        # pool. Otherwise a persistent launch failure would create a new instance on every pass.
+        pooled_instances = self.db.instance_get_all_by_filters(context,
+                                        {'metadata': {'pooled_from': blessed_ref['uuid']},
+                                         'host': self.host,
+                                         'deleted': False})
+
+        # The pooled clones belong to the owner of the blessed instance.
+        owner_context = nova_context.RequestContext(blessed_ref['user_id'],
+                                                    blessed_ref['project_id'],
+                                                    is_admin=True)
+        for i in range(pool_size - len(pooled_instances)):
+            try:
+                pooled_ref = self.gridcentric_api.create_pooled_instance(owner_context,
+                                                                         blessed_ref['uuid'])
+                self.launch_instance(owner_context, instance_uuid=pooled_ref['uuid'])
+                self._pause_pooled_instance(owner_context, instance_uuid=pooled_ref['uuid'])
+            except:
+                _log_error("pool refill")
+                break
+
+    @_lock_call
+    def _pause_pooled_instance(self, context, instance_uuid=None, instance_ref=None):
+        if instance_ref['vm_state'] != vm_states.ACTIVE:
+            raise exception.NovaException(_("Pooled instance %s failed to launch.") %
+                                          instance_uuid)
+
+        # Only paused clones can be claimed by the API, so the clone is not handed out
+        # until this has completed.
+        self.compute_manager.driver.pause(instance_ref)
+        self._instance_update(context, instance_uuid,
+                              vm_state=vm_states.PAUSED,
+                              power_state=power_state.PAUSED,
+                              task_state=None)
+
+    @_lock_call
+    def unpool_instance(self, context, instance_uuid=None, instance_ref=None,
+                        refresh_security_groups=False):
+        """
+        Hands out the pooled clone with uuid instance_uuid, which has been claimed by the API.
+        The clone is already running (paused) on this host so it only needs its firewall rules
+        refreshed if its security groups changed before it is resumed.
+        """
+        self._notify(context, instance_ref, "unpool.start")
+        try:
+            if refresh_security_groups:
+                self._setup_compute_networking(context, instance_ref)
+            self.compute_manager.driver.unpause(instance_ref)
+        except Exception, e:
+            _log_error("unpool")
+            self._instance_update(context, instance_uuid,
+                                  vm_state=vm_states.ERROR,
+                                  task_state=None)
+            raise e
+
+        try:
+            self._instance_update(context, instance_uuid,
+                      power_state=self.compute_manager._get_power_state(context, instance_ref),
+                      vm_state=vm_states.ACTIVE,
+                      task_state=None,
+                      launched_at=timeutils.utcnow())
+        except:
+            # NOTE: As with launch_instance() this is not fatal, the instance is running.
+            _log_error("post unpool update")
+
+        self._notify(context, instance_ref, "unpool.end")
+
+        # Top up the pool in the background so that the next launch can be served from it.
+        source_instance_ref = self._get_source_instance(context, instance_uuid)
+        if source_instance_ref != None and \
+           self._pool_size(self._instance_metadata(context, source_instance_ref['uuid'])) > 0:
+            greenthread.spawn_n(self._refill_pools, nova_context.get_admin_context())
+
+    def _reservoir_host(self):
+        """
+        The host the fixed IPs in this host's reservoir are associated with. This keeps them out
+        of the network's pool without looking like the address of a real host.
+        """
+        return "gc-reservoir-%s" % self.host
+
+    def _recover_network_reservoir(self, context):
+        try:
+            fixed_ips = self.db.fixed_ip_get_by_host(context, self._reservoir_host())
+        except exception.NotFound:
+            return
+        for fixed_ip in fixed_ips:
+            if fixed_ip['instance_uuid'] == None:
+                network = self.db.network_get(context, fixed_ip['network_id'])
+                self.network_reservoir.setdefault(network['uuid'], []).append(fixed_ip['address'])
+            else:
+                # The service went away before it could clear the reservation of an address it
+                # had handed to a launch.
+                self._release_fixed_ip(context, fixed_ip['address'])
+
+    def _release_fixed_ip(self, context, address):
+        """
+        Drops the reservation of a fixed IP. This puts the address back in its network's pool,
+        unless it has been allocated to an instance in the meantime.
+        """
+        self.db.fixed_ip_update(context.elevated(), address, {'host': None})
+
+    def _claim_reserved_networks(self, context):
+        """
+        Returns the requested networks for a launch, using the addresses from the network
+        reservoir where available. Returns None if there are no reservoir networks configured.
+        The addresses stay reserved (out of the pool) until the allocation has taken them, see
+        _release_claimed_addresses().
+        """
+        if len(CONF.gridcentric_reservoir_networks) == 0:
+            return None
+
+        requested_networks = []
+        for network_uuid in CONF.gridcentric_reservoir_networks:
+            address = None
+            addresses = self.network_reservoir.get(network_uuid, [])
+            if len(addresses) > 0:
+                address = addresses.pop(0)
+            requested_networks.append((network_uuid, address))
+
+        # Replace the addresses we just used in the background.
+        greenthread.spawn_n(self._refill_network_reservoir, nova_context.get_admin_context())
+        return requested_networks
+
+    def _release_claimed_addresses(self, context, requested_networks):
+        """ Drops the reservations of the addresses claimed for a launch. """
+        for (network_uuid, address) in requested_networks or []:
+            if address != None:
+                try:
+                    self._release_fixed_ip(context, address)
+                except:
+                    _log_error("release reserved address %s" % address)
+
+    @manager.periodic_task
+    def _refill_network_reservoir(self, context):
+        """ Tops up (or trims) the fixed IPs reserved on this host. """
+        if not(self.reservoir_lock.acquire(False)):
+            # Another refill is already running.
+            return
+
+        try:
+            networks = CONF.gridcentric_reservoir_networks
+            reservoir_size = max(0, CONF.gridcentric_reservoir_size)
+
+            # Release the reservations that are no longer wanted.
+            for network_uuid, addresses in self.network_reservoir.items():
+                if network_uuid in networks:
+                    keep = reservoir_size
+                else:
+                    keep = 0
+                while len(addresses) > keep:
+                    address = addresses.pop()
+                    try:
+                        self._release_fixed_ip(context, address)
+                    except:
+                        _log_error("release reserved address %s" % address)
+
+            for network_uuid in networks:
+                addresses = self.network_reservoir.setdefault(network_uuid, [])
+                if len(addresses) >= reservoir_size:
+                    continue
+                network = self.db.network_get_by_uuid(context, network_uuid)
+                while len(addresses) < reservoir_size:
+                    try:
+                        address = self.db.fixed_ip_associate_pool(context.elevated(),
+                                                                  network['id'],
+                                                                  host=self._reservoir_host())
+                    except exception.NoMoreFixedIps:
+                        LOG.warn(_("No more fixed IPs to reserve on network %s."), network_uuid)
+                        break
+                    addresses.append(address)
+        except:
+            _log_error("network reservoir refill")
+        finally:
+            self.reservoir_lock.release()
+
+    def evacuate_host(self, context, parallelism=None):
+        """
+        Migrates every active instance off this host, running at most parallelism migrations at
+        a time. Each migration also waits for room in the cluster-wide
+        gridcentric_migration_budget. The progress is reported by evacuation_status().
+        """
+        if self.evacuation != None and not(self.evacuation['done']):
+            raise exception.NovaException(_("Host %s is already being evacuated.") % self.host)
+
+        if parallelism == None:
+            parallelism = CONF.gridcentric_evacuate_parallelism
+        parallelism = max(1, int(parallelism))
+
+        # Mark this host as being drained so that it is no longer picked as a migration target.
+        self._set_service_disabled(context, True)
+
+        instances = [instance for instance in self.db.instance_get_all_by_host(context, self.host)
+                     if instance['vm_state'] == vm_states.ACTIVE and
+                        instance['task_state'] == None]
+        self.evacuation = {'host': self.host,
+                           'total': len(instances),
+                           'pending': [instance['uuid'] for instance in instances],
+                           'migrating': {},
+                           'completed': [],
+                           'failed': {},
+                           'done': False}
+        LOG.info(_("Evacuating %s instances from host %s."), len(instances), self.host)
+
+        pool = greenpool.GreenPool(parallelism)
+        try:
+            for instance in instances:
+                pool.spawn_n(self._evacuate_instance, context, instance)
+            pool.waitall()
+        finally:
+            self.evacuation['done'] = True
+
+        LOG.info(_("Evacuation of host %s done (%s migrated, %s failed)."), self.host,
+                 len(self.evacuation['completed']), len(self.evacuation['failed']))
+
+        if len(instances) > 0 and len(self.evacuation['completed']) == 0:
+            # Nothing could be moved off this host, so it is not being drained after all. After
+            # a partial evacuation the host stays disabled until an operator enables it again
+            # (nova service-enable <host> nova-gridcentric).
+            LOG.warn(_("No instance could be evacuated, enabling host %s again."), self.host)
+            self._set_service_disabled(context, False)
+
+    def _set_service_disabled(self, context, disabled):
+        try:
+            service = self.db.service_get_by_args(context, self.host, 'nova-gridcentric')
+            self.db.service_update(context, service['id'], {'disabled': disabled})
+        except exception.NotFound:
+            LOG.warn(_("No gridcentric service found for host %s."), self.host)
+
+    def evacuation_status(self, context):
+        """ Returns the progress of the latest evacuation of this host. """
+        if self.evacuation == None:
+            return None
+        status = dict(self.evacuation)
+        status['pending'] = len(self.evacuation['pending'])
+        status['migrating'] = self.evacuation['migrating'].keys()
+        return status
+
+    def _wait_for_migration_budget(self, context, instance_ref):
+        """
+        Picks the migration target for the instance once its migration fits within the
+        gridcentric_migration_budget. Returns the migration target.
+        """
+        while True:
+            dest = self.gridcentric_api.find_migration_target(context, instance_ref, None)
+            cost = self.gridcentric_api.migration_cost(self.host, dest)
+            budget = CONF.gridcentric_migration_budget
+
+            in_flight = {}
+            if budget > 0:
+                # The migrations of this evacuation may not have recorded their destination yet.
+                in_flight.update(self.evacuation['migrating'])
+                incoming = self.gridcentric_api.incoming_migrations(context)
+                for host, instances in incoming.iteritems():
+                    for instance in instances:
+                        in_flight[instance['uuid']] = \
+                            self.gridcentric_api.migration_cost(instance['host'], host)
+
+            # There is always room for a single migration, no matter how large.
+            if budget <= 0 or len(in_flight) == 0 or sum(in_flight.values()) + cost <= budget:
+                self.evacuation['migrating'][instance_ref['uuid']] = cost
+                return dest
+            greenthread.sleep(5.0)
+
+    def _evacuate_instance(self, context, instance_ref):
+        instance_uuid = instance_ref['uuid']
+        try:
+            dest = self._wait_for_migration_budget(context, instance_ref)
+            self.evacuation['pending'].remove(instance_uuid)
+
+            self._instance_update(context, instance_uuid, task_state=task_states.MIGRATING)
+            self.migrate_instance(context, instance_uuid=instance_uuid, dest=dest)
+
+            # A failed remote launch is rolled back by relaunching the instance here.
+            if self.db.instance_get_by_uuid(context, instance_uuid)['host'] != dest:
+                raise exception.NovaException(_("Migration to %s was rolled back.") % dest)
+            self.evacuation['completed'].append(instance_uuid)
+
+        except Exception, e:
+            _log_error("evacuation of %s" % instance_uuid)
+            self.evacuation['failed'][instance_uuid] = unicode(e)
+
+            try:
+                instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+                if instance_ref['task_state'] == task_states.MIGRATING and \
+                   instance_ref['name'] in self.compute_manager.driver.list_instances():
+                    # The migration never got going, the instance is still running here.
+                    self._instance_update(context, instance_uuid, task_state=None)
+            except:
+                _log_error("evacuation cleanup of %s" % instance_uuid)
+
+        finally:
+            if instance_uuid in self.evacuation['pending']:
+                self.evacuation['pending'].remove(instance_uuid)
+            self.evacuation['migrating'].pop(instance_uuid, None)
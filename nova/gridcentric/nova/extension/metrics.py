@@ -0,0 +1,170 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+The counters and histograms of the gridcentric service, rendered in the prometheus text format.
+The manager serves them on a local port and/or writes them to a file (for the textfile collector
+of node_exporter), see gridcentric_metrics_port and gridcentric_metrics_file.
+"""
+
+import os
+import tempfile
+
+import eventlet
+from eventlet import greenthread
+from eventlet import tpool
+from eventlet import wsgi
+
+from nova.openstack.common import log as logging
+
+from gridcentric.nova import tracing
+
+LOG = logging.getLogger('nova.gridcentric.metrics')
+
+# All of the metrics, in the order they are rendered.
+METRICS = []
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                            .replace('"', '\\"')
+                                                            .replace('\n', '\\n'))
+                              for (name, value) in pairs])
+
+class Counter(object):
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, label_values=(), amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s counter" % self.name]
+        for label_values, value in sorted(self.values.items()):
+            lines.append("%s%s %s" % (self.name, _labels(self.labels, label_values), value))
+        return lines
+
+class Gauge(object):
+    """ A value read when the metrics are rendered. """
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        METRICS.append(self)
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help),
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, self.fn())]
+
+class Histograms(object):
+    """ A histogram per combination of label values. """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.histograms = {}
+        METRICS.append(self)
+
+    def observe(self, value, label_values=()):
+        histogram = self.histograms.get(label_values, None)
+        if histogram == None:
+            histogram = self.histograms.setdefault(label_values, tracing.Histogram())
+        histogram.observe(value)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s histogram" % self.name]
+        for label_values, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append("%s_bucket%s %s" % (self.name,
+                             _labels(self.labels, label_values, [('le', bound)]), cumulative))
+            labels = _labels(self.labels, label_values)
+            lines.append("%s_sum%s %s" % (self.name, labels, histogram.sum))
+            lines.append("%s_count%s %s" % (self.name, labels, histogram.count))
+        return lines
+
+def _tpool_queue_depth():
+    # The requests waiting for a tpool worker (the queue only exists once tpool is in use).
+    reqq = getattr(tpool, '_reqq', None)
+    if reqq == None:
+        return 0
+    return reqq.qsize()
+
+OPERATIONS = Histograms('gridcentric_operation_seconds',
+                        'The duration of the operations on instances.',
+                        ('operation', 'outcome'))
+LOCK_WAITS = Histograms('gridcentric_lock_wait_seconds',
+                        'The time operations waited for the lock of their instance.',
+                        ('operation',))
+VMS_CALLS = Histograms('gridcentric_vms_call_seconds',
+                       'The duration of the calls into vms.',
+                       ('method', 'outcome'))
+TPOOL_QUEUE_DEPTH = Gauge('gridcentric_tpool_queue_depth',
+                          'The number of calls waiting for a tpool worker.',
+                          _tpool_queue_depth)
+IMAGE_CACHE = Counter('gridcentric_image_cache_total',
+                      'Blessed artifacts found in (hit) or fetched into (miss) the image cache.',
+                      ('result',))
+TRANSFER_BYTES = Counter('gridcentric_image_transfer_bytes_total',
+                         'The bytes of blessed artifacts moved to or from the image service.',
+                         ('direction',))
+TRANSFER_SECONDS = Counter('gridcentric_image_transfer_seconds_total',
+                           'The time spent moving blessed artifacts to or from the image '
+                           'service.',
+                           ('direction',))
+INSTANCE_UPDATE_RETRIES = Counter('gridcentric_instance_update_retries_total',
+                                  'The instance database updates that were retried.')
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def write(path):
+    """ Writes the metrics to path, atomically so that readers never see a partial file. """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        try:
+            os.write(fd, render())
+        finally:
+            os.close(fd)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def _application(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [render()]
+
+def serve(port):
+    """ Serves the metrics over http on the given local port. """
+    sock = eventlet.listen(('127.0.0.1', port))
+    greenthread.spawn_n(wsgi.server, sock, _application, log=logging.WritableLogger(LOG))
@@ -0,0 +1,97 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Loads files into the page cache and reports how much of them is resident.
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                       ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+
+POSIX_FADV_WILLNEED = 3
+MAP_FAILED = ctypes.c_void_p(-1).value
+READ_CHUNK = 1 << 20
+
+def _check(result):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+class MappedFile(object):
+    """
+    A read-only mapping of a whole file. The mapping is what keeps the file locked in memory
+    after lock(), so it needs to stay open for as long as the file should stay locked.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.addr = None
+        if self.size > 0:
+            addr = _libc.mmap(None, self.size, mmap.PROT_READ, mmap.MAP_SHARED, self.fd, 0)
+            if addr == MAP_FAILED:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, os.strerror(errno))
+            self.addr = addr
+
+    def preload(self):
+        """ Reads the whole file into the page cache. This blocks, so run it in a tpool. """
+        # Kick off the kernel's readahead over the whole file, then read it to make sure that
+        # every page made it in.
+        _libc.posix_fadvise(self.fd, 0, 0, POSIX_FADV_WILLNEED)
+        offset = 0
+        while offset < self.size:
+            data = os.read(self.fd, READ_CHUNK)
+            if not data:
+                break
+            offset += len(data)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+
+    def lock(self):
+        """ Pins the file in memory. """
+        if self.addr != None:
+            _check(_libc.mlock(self.addr, self.size))
+
+    def residency(self):
+        """ Returns the number of bytes of the file that are in the page cache. """
+        if self.addr == None:
+            return 0
+        pages = (self.size + mmap.PAGESIZE - 1) / mmap.PAGESIZE
+        vec = (ctypes.c_ubyte * pages)()
+        _check(_libc.mincore(self.addr, self.size, vec))
+        resident = sum([page & 1 for page in vec])
+        return min(self.size, resident * mmap.PAGESIZE)
+
+    def close(self):
+        """ Drops the mapping, which also unlocks the file. """
+        if self.addr != None:
+            _libc.munmap(self.addr, self.size)
+            self.addr = None
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,152 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A sampling profiler for the gridcentric service. While it runs, a native thread samples the
+stacks of every thread of the process: the greenthread running on the main thread and the tpool
+workers. Samples are grouped by the rpc method (or periodic task) the stack is serving and
+written out as folded stacks, one "group;frame;...;frame count" line per distinct stack, which
+is the input format of flamegraph.pl and speedscope.
+"""
+
+import collections
+import os
+import sys
+import tempfile
+
+from eventlet import patcher
+
+from nova import exception
+from nova.openstack.common import log as logging
+from oslo.config import cfg
+
+# The sampler has to run on a native thread, whatever has been monkey patched.
+threading = patcher.original('threading')
+time = patcher.original('time')
+
+# The greenthreads all run on the thread that loaded the service (and this module).
+MAIN_THREAD = patcher.original('thread').get_ident()
+
+LOG = logging.getLogger('nova.gridcentric.profiler')
+CONF = cfg.CONF
+
+profiler_opts = [
+               cfg.IntOpt('gridcentric_profile_seconds',
+               default=30,
+               help='How long, in seconds, a profile of the gridcentric service runs for when '
+                    'none is given.'),
+
+               cfg.FloatOpt('gridcentric_profile_interval',
+               default=0.01,
+               help='The number of seconds between two samples of a profile.'),
+
+               cfg.StrOpt('gridcentric_profile_dir',
+               default='',
+               help='The directory profiles are written to. Defaults to the temporary '
+                    'directory.')]
+CONF.register_opts(profiler_opts)
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+def stack_key(frame, main_thread):
+    """
+    Returns the folded stack of the frame, led by the group the stack belongs to: the rpc
+    method being served, the periodic task being run, the tpool worker or the hub.
+    """
+    frames = []
+    while frame != None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+
+    group = main_thread and "other" or "thread"
+    for frame in frames:
+        name = frame.f_code.co_name
+        if name == '_process_data' and 'method' in frame.f_locals:
+            group = "rpc:%s" % frame.f_locals['method']
+            break
+        if name == 'periodic_tasks' and 'task_name' in frame.f_locals:
+            group = "periodic:%s" % frame.f_locals['task_name']
+            break
+        if name == 'tworker':
+            group = "tpool"
+            break
+
+    return ";".join([group] + [_frame_name(frame) for frame in frames])
+
+class Profiler(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+
+    def start(self, seconds=None, interval=None):
+        """ Starts a profile in the background and returns the path it will be written to. """
+        if seconds == None:
+            seconds = CONF.gridcentric_profile_seconds
+        if interval == None:
+            interval = CONF.gridcentric_profile_interval
+
+        self.lock.acquire()
+        try:
+            if self.path != None:
+                raise exception.NovaException(_("A profile is already being taken into %s") %
+                                              self.path)
+            path = os.path.join(CONF.gridcentric_profile_dir or tempfile.gettempdir(),
+                                "nova-gc-%s-%d.folded" % (os.getpid(), time.time()))
+            # The name is predictable and the directory may be shared (e.g. /tmp), so the file
+            # must be a new one and not something planted there (such as a symlink).
+            profile = os.fdopen(os.open(path,
+                                        os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                                        0600), 'w')
+            self.path = path
+        finally:
+            self.lock.release()
+
+        try:
+            sampler = threading.Thread(target=self._run,
+                                       args=(float(seconds), interval, path, profile))
+            sampler.daemon = True
+            sampler.start()
+        except:
+            profile.close()
+            self.path = None
+            raise
+        return path
+
+    def _run(self, seconds, interval, path, profile):
+        try:
+            counts = collections.defaultdict(int)
+            me = threading.current_thread().ident
+            deadline = time.time() + seconds
+            while time.time() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != me:
+                        counts[stack_key(frame, thread_id == MAIN_THREAD)] += 1
+                time.sleep(interval)
+
+            for stack, count in sorted(counts.items()):
+                profile.write("%s %d\n" % (stack, count))
+            LOG.info(_("Wrote a %ds profile to %s"), seconds, path)
+        except:
+            LOG.exception(_("Error during profiling"))
+        finally:
+            profile.close()
+            self.path = None
+
+# The profiler of this process.
+PROFILER = Profiler()
@@ -0,0 +1,141 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Finds the network device that leads to an address by asking the kernel's routing table over
+netlink (the same thing `ip route get` does, without the fork), and caches what it finds.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import time
+
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 1
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+RTA_DST = 1
+RTA_OIF = 4
+RTN_LOCAL = 2
+RTMGRP_IPV4_ROUTE = 0x40
+IF_NAMESIZE = 16
+
+NLMSGHDR = "=IHHII"
+NLMSGHDR_LEN = struct.calcsize(NLMSGHDR)
+RTMSG = "=BBBBBBBBI"
+RTMSG_LEN = struct.calcsize(RTMSG)
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.if_indextoname.restype = ctypes.c_char_p
+_libc.if_indextoname.argtypes = [ctypes.c_uint, ctypes.c_char_p]
+
+def _interface_name(index):
+    name = ctypes.create_string_buffer(IF_NAMESIZE)
+    if _libc.if_indextoname(index, name) == None:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return name.value
+
+def route_device(ip):
+    """
+    Returns the name of the device that the route to the IPv4 address ip goes out of, and
+    whether ip is an address of this host.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        rtmsg = struct.pack(RTMSG, socket.AF_INET, 32, 0, 0, 0, 0, 0, 0, 0)
+        dst = struct.pack("=HH", 8, RTA_DST) + socket.inet_aton(ip)
+        header = struct.pack(NLMSGHDR, NLMSGHDR_LEN + len(rtmsg) + len(dst),
+                             RTM_GETROUTE, NLM_F_REQUEST, 1, 0)
+        sock.send(header + rtmsg + dst)
+        reply = sock.recv(65536)
+    finally:
+        sock.close()
+
+    (length, msg_type, flags, seq, pid) = struct.unpack(NLMSGHDR, reply[:NLMSGHDR_LEN])
+    if msg_type == NLMSG_ERROR:
+        error = -struct.unpack("=i", reply[NLMSGHDR_LEN:NLMSGHDR_LEN + 4])[0]
+        raise OSError(error, os.strerror(error))
+    if msg_type != RTM_NEWROUTE:
+        raise OSError(errno.EPROTO, "Unexpected netlink message type %s" % msg_type)
+
+    rtm_type = struct.unpack(RTMSG, reply[NLMSGHDR_LEN:NLMSGHDR_LEN + RTMSG_LEN])[7]
+    oif = None
+    offset = NLMSGHDR_LEN + RTMSG_LEN
+    while offset + 4 <= length:
+        (attr_len, attr_type) = struct.unpack("=HH", reply[offset:offset + 4])
+        if attr_len < 4:
+            break
+        if attr_type == RTA_OIF:
+            oif = struct.unpack("=I", reply[offset + 4:offset + 8])[0]
+        # Attributes are padded to 4 bytes.
+        offset += (attr_len + 3) & ~3
+    if oif == None:
+        raise OSError(errno.ENETUNREACH, "No route to %s" % ip)
+
+    return (_interface_name(oif), rtm_type == RTN_LOCAL)
+
+class RouteCache(object):
+    """
+    Caches what is looked up for a destination for ttl seconds, or until the IPv4 routes of this
+    host change (which the kernel tells us about over netlink). Link changes are left out: every
+    instance started or stopped brings a tap device up or down, and the links that carry routes
+    take their routes with them when they go down anyway.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        try:
+            self.monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.monitor.bind((0, RTMGRP_IPV4_ROUTE))
+            self.monitor.setblocking(0)
+        except (AttributeError, socket.error):
+            # Without netlink the entries just live out their ttl.
+            self.monitor = None
+
+    def _routes_changed(self):
+        changed = False
+        while True:
+            try:
+                self.monitor.recv(65536)
+                changed = True
+            except socket.error, e:
+                if e.errno == errno.ENOBUFS:
+                    # We missed some of the changes, but we know there were some.
+                    changed = True
+                    continue
+                break
+        return changed
+
+    def lookup(self, dest, resolve):
+        """ Returns what resolve(dest) returned, from the cache if it is still valid. """
+        if self.monitor != None and self._routes_changed():
+            self.entries.clear()
+
+        now = time.time()
+        (expiry, value) = self.entries.get(dest, (0, None))
+        if expiry > now:
+            return value
+
+        value = resolve(dest)
+        self.entries[dest] = (now + self.ttl, value)
+        return value
@@ -30,7 +30,18 @@ import vms.logger as logger
 import vms.virt as virt
 import vms.vmsrun as vmsrun
 
+from gridcentric.nova import tracing
+
 LOG = logging.getLogger('nova.gridcentric.vmsapi')
+tracing.trace_log(LOG)
+
+# The runtime counters reported for instances, and the vms control keys they are read from.
+STATS_KEYS = {'faults': 'memory.faults',
+              'resident_pages': 'memory.resident',
+              'target_pages': 'memory.target',
+              'shared_pages': 'memory.shared',
+              'memserver_bytes': 'memory.server.bytes',
+              'memserver_throughput': 'memory.server.throughput'}
 
 class VmsApi(object):
     """
@@ -40,6 +51,9 @@ class VmsApi(object):
 
     def __init__(self, version='2.5'):
         self.version = version
+        # The vms controls of the instances, by instance name. Probing for the controls is much
+        # more expensive than talking to one, so they are kept around between lookups.
+        self.controls = {}
 
     def configure_logger(self):
         logger.setup_for_library()
@@ -62,17 +76,22 @@ class VmsApi(object):
             mem_url=mem_url,
             migration=migration)
 
-    def create_vmsargs(self, guest_params):
+    def create_vmsargs(self, guest_params, vms_options=None):
         vms_args = None
-        if guest_params != None:
+        if guest_params or vms_options:
             vms_args = vmsrun.Arguments()
-            for key, value in guest_params.iteritems():
+            for key, value in (guest_params or {}).iteritems():
                 vms_args.add_param(key, value)
+            for key, value in (vms_options or {}).iteritems():
+                # Options without a value are left to the vms defaults.
+                if value:
+                    vms_args.add_option(key, value)
+        return vms_args
 
+    def launch(self, instance_name, new_name, target, path, mem_url=None, migration=False,
+               guest_params=None, vms_options=None, **kwargs):
 
-    def launch(self, instance_name, new_name, target, path, mem_url=None, migration=False, guest_params=None, **kwargs):
-
-        vms_args = self.create_vmsargs(guest_params)
+        vms_args = self.create_vmsargs(guest_params, vms_options)
         return tpool.execute(commands.launch,
             instance_name,
             new_name,
@@ -86,6 +105,57 @@ class VmsApi(object):
 
         return tpool.execute(commands.discard, instance_name, mem_url=mem_url)
 
+    def serve(self, instance_name, path, mem_url):
+        if not(hasattr(commands, 'serve')):
+            raise exception.NovaException(_("This version of vms cannot serve blessed memory."))
+        return tpool.execute(commands.serve, instance_name, path=path, mem_url=mem_url)
+
+    def _find_control(self, instance_name):
+        ctrl = self.controls.get(instance_name, None)
+        try:
+            if ctrl != None and ctrl.get("name") == instance_name:
+                return ctrl
+        except control.ControlException:
+            pass
+
+        # The cached control is gone (e.g. the instance was relaunched), probe again. The
+        # controls of the instances that are gone are dropped along the way.
+        controls = {}
+        for ctrl in control.probe():
+            try:
+                controls[ctrl.get("name")] = ctrl
+            except control.ControlException:
+                continue
+        self.controls = controls
+        if instance_name in controls:
+            return controls[instance_name]
+        raise exception.NovaException(_("No vms control found for %s.") % instance_name)
+
+    def stats(self, instance_name):
+        """ Returns the runtime counters of the instance (see STATS_KEYS). """
+        ctrl = self._find_control(instance_name)
+        stats = {}
+        for (name, key) in STATS_KEYS.iteritems():
+            try:
+                stats[name] = ctrl.get(key)
+            except control.ControlException:
+                # Not every version of vms keeps every counter.
+                stats[name] = None
+        return stats
+
+    def supports_target(self):
+        return True
+
+    def set_target(self, instance_name, target):
+        self._find_control(instance_name).set("memory.target", str(target))
+
+    def prefetch_profile(self, instance_name):
+        """ Returns the pages touched by the instance so far, as recorded by vms. """
+        return self._find_control(instance_name).get("memory.profile")
+
+    def kill(self, instance_name):
+        self._find_control(instance_name).kill(timeout=1.0)
+
     def kill_memservers(self, mem_url):
         for ctrl in control.probe():
             try:
@@ -103,8 +173,16 @@ class VmsApi26(VmsApi):
 
         return config.CONFIG
 
-    def launch(self, instance_name, new_name, target, path, mem_url=None, migration=False, guest_params=None, **kwargs):
-        vms_args = self.create_vmsargs(guest_params)
+    def supports_target(self):
+        # Memory targets are no longer supported by vms.
+        return False
+
+    def set_target(self, instance_name, target):
+        raise exception.NovaException(_("This version of vms does not support memory targets."))
+
+    def launch(self, instance_name, new_name, target, path, mem_url=None, migration=False,
+               guest_params=None, vms_options=None, **kwargs):
+        vms_args = self.create_vmsargs(guest_params, vms_options)
         if target != 0:
             # The target parameter is no longer supported by VMS. Log a warning if the user is attempting
             # to specify it.
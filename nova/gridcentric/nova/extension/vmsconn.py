@@ -19,7 +19,13 @@ Interfaces that configure vms and perform hypervisor specific operations.
 
 import os
 import pwd
+import shutil
 import tempfile
+import time
+
+from eventlet import event
+from eventlet import greenthread
+from eventlet import tpool
 
 import nova
 from nova import exception
@@ -29,7 +35,11 @@ from nova.virt import images
 from nova.compute import utils as compute_utils
 from nova.openstack.common import log as logging
 from oslo.config import cfg
+
+from gridcentric.nova import tracing
+
 LOG = logging.getLogger('nova.gridcentric.vmsconn')
+tracing.trace_log(LOG)
 CONF = cfg.CONF
 
 vmsconn_opts = [
@@ -39,10 +49,30 @@ vmsconn_opts = [
 
                cfg.StrOpt('openstack_user',
                default='',
-               help='The openstack user')]
+               help='The openstack user'),
+
+               cfg.FloatOpt('gridcentric_firewall_batch_window',
+               default=0.0,
+               help='The number of seconds to collect the firewall setup of launched instances '
+                    'before applying it. Launches that land within the same window are applied '
+                    'in a single iptables transaction. A value of 0 applies the firewall setup '
+                    'of each launch immediately.'),
+
+               cfg.IntOpt('gridcentric_prewarm_mlock_budget',
+               default=0,
+               help='The amount of memory, in MB, that pre-warmed blessed artifacts may keep '
+                    'locked in memory on a host.'),
+
+               cfg.FloatOpt('gridcentric_vms_call_sample_rate',
+               default=1.0,
+               help='The fraction of the calls into vms that are logged with their arguments '
+                    'when debug logging is on. The duration and outcome of every call is '
+                    'recorded regardless.')]
 CONF.register_opts(vmsconn_opts)
 
 import vms.utilities as utilities
+from . import metrics
+from . import pagecache
 from . import vmsapi as vms_api
 
 def mkdir_as(path, uid):
@@ -70,25 +100,109 @@ def get_vms_connection(connection_type):
     else:
         raise exception.Error(_('Unsupported connection type "%s"' % connection_type))
 
-def _log_call(fn):
+def _trace_call(fn):
+    """
+    Records the duration and outcome of every call into the vms call metrics. A sample of the calls is
+    also logged along with their arguments, which are only formatted for the sampled calls.
+    """
+    name = fn.__name__
+
     def wrapped_fn(self, *args, **kwargs):
+        start = time.time()
+        outcome = 'error'
         try:
-            LOG.debug(_("Calling %s with args=%s kwargs=%s") % \
-                       (fn.__name__, str(args), str(kwargs)))
-            return fn(self, *args, **kwargs)
+            result = fn(self, *args, **kwargs)
+            outcome = 'ok'
+            return result
         finally:
-            LOG.debug(_("Called %s with args=%s kwargs=%s") % \
-                       (fn.__name__, str(args), str(kwargs)))
+            duration = time.time() - start
+            metrics.VMS_CALLS.observe(duration, (name, outcome))
+            if tracing.sampled(LOG, CONF.gridcentric_vms_call_sample_rate):
+                LOG.debug(_("Called %s (%s in %.3fs) with args=%s kwargs=%s"),
+                          name, outcome, duration, args, kwargs)
 
     wrapped_fn.__name__ = fn.__name__
     wrapped_fn.__doc__ = fn.__doc__
     return wrapped_fn
 
 
+class FirewallBatcher(object):
+    """
+    Collects the firewall setup for instances launched within a short window of each other and
+    applies it all at once. When the firewall driver is able to defer applying its rules, the
+    whole batch results in a single iptables transaction instead of one per instance.
+    """
+
+    def __init__(self, firewall_driver, window):
+        self.firewall_driver = firewall_driver
+        self.window = window
+        self.pending = []
+        self.flusher = None
+
+    def apply_instance_filter(self, instance_ref, network_info):
+        """
+        Applies the instance filter as part of the current batch. This blocks until the batch has
+        been applied and raises the same error that applying this instance's filter did.
+        """
+        if self.window <= 0:
+            self.firewall_driver.apply_instance_filter(instance_ref, network_info)
+            return
+
+        done = event.Event()
+        self.pending.append((instance_ref, network_info, done))
+        if self.flusher == None:
+            self.flusher = greenthread.spawn_after(self.window, self._flush)
+        done.wait()
+
+    def _flush(self):
+        batch = self.pending
+        self.pending = []
+        self.flusher = None
+
+        defer_on = getattr(self.firewall_driver, 'filter_defer_apply_on', None)
+        defer_off = getattr(self.firewall_driver, 'filter_defer_apply_off', None)
+        LOG.debug(_("Applying the firewall setup for %s instances"), len(batch))
+
+        errors = {}
+        batch_error = None
+        try:
+            if defer_on:
+                defer_on()
+            for i, (instance_ref, network_info, done) in enumerate(batch):
+                try:
+                    self.firewall_driver.apply_instance_filter(instance_ref, network_info)
+                except Exception, e:
+                    LOG.exception(_("Error applying the firewall setup for %s"),
+                                  instance_ref['name'])
+                    errors[i] = e
+        except Exception, e:
+            LOG.exception(_("Error preparing the batched firewall setup"))
+            batch_error = e
+
+        try:
+            if defer_off:
+                defer_off()
+        except Exception, e:
+            # The rules were never applied, so the whole batch has failed.
+            LOG.exception(_("Error applying the batched firewall setup"))
+            batch_error = batch_error or e
+
+        for i, (instance_ref, network_info, done) in enumerate(batch):
+            error = errors.get(i, batch_error)
+            if error != None:
+                done.send_exception(error)
+            else:
+                done.send(None)
+
+
 class VmsConnection:
 
     def __init__(self, vmsapi):
         self.vmsapi = vmsapi
+        # The pre-warmed artifacts that are locked in memory, by image ref.
+        self.locked_artifacts = {}
+        # All of the artifacts that have been pre-warmed on this host.
+        self.prewarmed_artifacts = set()
 
     def configure(self):
         """
@@ -96,7 +210,7 @@ class VmsConnection:
         """
         pass
 
-    @_log_call
+    @_trace_call
     def bless(self, context, instance_name, new_instance_ref, migration_url=None):
         """
         Create a new blessed VM from the instance with name instance_name and gives the blessed
@@ -114,35 +228,36 @@ class VmsConnection:
         """ Change the permission on the blessed files """
         pass
 
-    @_log_call
+    @_trace_call
     def post_bless(self, context, new_instance_ref, blessed_files):
         if CONF.gridcentric_use_image_service:
             return self._upload_files(context, new_instance_ref, blessed_files)
         else:
             return blessed_files
 
-    @_log_call
+    @_trace_call
     def bless_cleanup(self, blessed_files):
         if CONF.gridcentric_use_image_service:
             for blessed_file in blessed_files:
                 if os.path.exists(blessed_file):
                     os.unlink(blessed_file)
 
-    @_log_call
+    @_trace_call
     def _upload_files(self, context, instance_ref, blessed_files):
         """ Upload the bless files into nova's image service (e.g. glance). """
         raise Exception("Uploading files to the image service is not supported.")
 
-    @_log_call
+    @_trace_call
     def discard(self, context, instance_name, migration_url=None, image_refs=[]):
         """
         Discard all of the vms artifacts associated with a blessed instance
         """
         result =  self.vmsapi.discard(instance_name, mem_url=migration_url)
+        self.release_prewarmed(image_refs)
         if CONF.gridcentric_use_image_service:
             self._delete_images(context, image_refs)
 
-    @_log_call
+    @_trace_call
     def _delete_images(self, context, image_refs):
         pass
 
@@ -160,12 +275,15 @@ class VmsConnection:
         return mac_addresses
 
 
-    @_log_call
+    @_trace_call
     def launch(self, context, instance_name, new_instance_ref,
                network_info, skip_image_service=False, target=0,
-               migration_url=None, image_refs=[], params={}, vms_policy=''):
+               migration_url=None, image_refs=[], params={}, vms_policy='',
+               memory_url=None, prefetch_ref=None):
         """
-        Launch a blessed instance
+        Launch a blessed instance. If memory_url is given, the memory of the blessed instance
+        is fetched from the memory server at that url (see serve()). The prefetch_ref is the
+        artifact recorded by capture_prefetch_profile(), if any.
         """
         new_name, path = self.pre_launch(context, new_instance_ref, network_info,
                                         migration=(migration_url and True),
@@ -175,8 +293,11 @@ class VmsConnection:
 
         # Launch the new VM.
         vms_options = {'memory.policy':vms_policy}
+        if prefetch_ref:
+            vms_options['memory.prefetch'] = self._artifact_path(context, path, prefetch_ref)
         result = self.vmsapi.launch(instance_name, new_name, target, path,
-                                    mem_url=migration_url, migration=(migration_url and True),
+                                    mem_url=(migration_url or memory_url),
+                                    migration=(migration_url and True),
                                     guest_params=params.get('guest',{}),
                                     vms_options=vms_options)
 
@@ -187,7 +308,105 @@ class VmsConnection:
                          migration=(migration_url and True))
         return result
 
-    @_log_call
+    @_trace_call
+    def abort_launch(self, context, instance_name):
+        """ Kills the vms of an instance that is being launched, which fails the launch. """
+        self.vmsapi.kill(instance_name)
+
+    @_trace_call
+    def serve(self, context, instance_name, instance_ref, memory_url, image_refs=[]):
+        """
+        Starts a memory server for the blessed instance at memory_url. Any number of launches
+        given the same memory_url share the memory sent out by this server.
+        """
+        path = self._fetch_images(context, instance_ref, image_refs)
+        return self.vmsapi.serve(instance_name, path, memory_url)
+
+    @_trace_call
+    def stop_serving(self, context, memory_url):
+        self.vmsapi.kill_memservers(memory_url)
+
+    @_trace_call
+    def capture_prefetch_profile(self, context, instance_ref, blessed_ref):
+        """
+        Records the pages touched by the running instance so far as an artifact of the blessed
+        instance, in the image service. Returns the references to the artifact (as post_bless()
+        does).
+        """
+        if not(CONF.gridcentric_use_image_service):
+            raise exception.NovaException(_("Prefetch hints can only be shared through the "
+                                            "image service."))
+        profile = self.vmsapi.prefetch_profile(instance_ref['name'])
+
+        # The artifact is named after the blessed instance (see _artifact_path()), and only
+        # lives here until it is uploaded.
+        profile_dir = tempfile.mkdtemp()
+        try:
+            profile_file = os.path.join(profile_dir, '%s.prefetch' % blessed_ref['name'])
+            with open(profile_file, 'w') as profile_out:
+                profile_out.write(profile)
+            return self._upload_files(context, blessed_ref, [profile_file])
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def _artifact_path(self, context, image_base_path, image_ref):
+        """ Returns the local path of a blessed artifact fetched by pre_launch(). """
+        return image_ref
+
+    @_trace_call
+    def prewarm(self, context, blessed_ref, image_refs, mlock=False):
+        """
+        Fetches the artifacts of the blessed instance and loads them into the page cache. With
+        mlock, the artifacts are also locked in memory as long as they fit in the
+        gridcentric_prewarm_mlock_budget. Returns the fraction of the artifacts that is resident.
+        """
+        image_base_path = self._fetch_images(context, blessed_ref, image_refs)
+        budget = CONF.gridcentric_prewarm_mlock_budget << 20
+        locked = sum([artifact.size for artifact in self.locked_artifacts.values()])
+
+        resident = 0
+        total = 0
+        for image_ref in image_refs:
+            if image_ref in self.locked_artifacts:
+                artifact = self.locked_artifacts[image_ref]
+                resident += artifact.residency()
+                total += artifact.size
+                continue
+
+            artifact = pagecache.MappedFile(self._artifact_path(context, image_base_path,
+                                                                image_ref))
+            try:
+                tpool.execute(artifact.preload)
+                if mlock and locked + artifact.size <= budget:
+                    artifact.lock()
+                    self.locked_artifacts[image_ref] = artifact
+                    locked += artifact.size
+                resident += artifact.residency()
+                total += artifact.size
+            finally:
+                if image_ref not in self.locked_artifacts:
+                    artifact.close()
+
+        self.prewarmed_artifacts.update(image_refs)
+        if total == 0:
+            return 1.0
+        return float(resident) / total
+
+    @_trace_call
+    def release_prewarmed(self, image_refs):
+        """ Forgets the pre-warmed artifacts, unlocking those that are locked in memory. """
+        for image_ref in image_refs:
+            self.prewarmed_artifacts.discard(image_ref)
+            if image_ref in self.locked_artifacts:
+                self.locked_artifacts.pop(image_ref).close()
+
+    def _fetch_images(self, context, instance_ref, image_refs, refetch=False):
+        """
+        Makes the blessed artifacts available locally. Returns the directory that holds them.
+        """
+        return None
+
+    @_trace_call
     def pre_launch(self, context,
                    new_instance_ref,
                    network_info=None,
@@ -197,7 +416,29 @@ class VmsConnection:
                    image_refs=[]):
         return (new_instance_ref.name, None)
 
-    @_log_call
+    @_trace_call
+    def set_target(self, context, instance_ref, target):
+        """
+        Changes the memory target (in pages) of the running instance. A target of 0 removes it.
+        """
+        self.vmsapi.set_target(instance_ref['name'], target)
+
+    def supports_target(self):
+        """ Returns whether the memory target of running instances can be changed. """
+        return self.vmsapi.supports_target()
+
+    def stats(self, context, instance_ref):
+        """ Returns the vms runtime counters of the running instance. """
+        return self.vmsapi.stats(instance_ref['name'])
+
+    def working_set(self, context, instance_ref):
+        """
+        Returns the resident memory of the running instance in bytes, or None if the hypervisor
+        does not report it.
+        """
+        return None
+
+    @_trace_call
     def post_launch(self, context,
                     new_instance_ref,
                     network_info=None,
@@ -205,11 +446,11 @@ class VmsConnection:
                     migration=False):
         pass
 
-    @_log_call
+    @_trace_call
     def pre_migration(self, context, instance_ref, network_info, migration_url):
         pass
 
-    @_log_call
+    @_trace_call
     def post_migration(self, context, instance_ref, network_info, migration_url):
         pass
 
@@ -249,11 +490,13 @@ class LibvirtConnection(VmsConnection):
         self.determine_openstack_user()
 
         self.libvirt_conn = LibvirtDriver(False)
+        self.firewall_batcher = FirewallBatcher(self.libvirt_conn.firewall_driver,
+                                                CONF.gridcentric_firewall_batch_window)
         vms_config = self.vmsapi.config()
         vms_config.MANAGEMENT['connection_url'] = self.libvirt_conn.uri
         self.vmsapi.select_hypervisor('libvirt')
 
-    @_log_call
+    @_trace_call
     def determine_openstack_user(self):
         """
         Determines the openstack user's uid and gid
@@ -284,7 +527,7 @@ class LibvirtConnection(VmsConnection):
             raise e
 
 
-    @_log_call
+    @_trace_call
     def pre_launch(self, context,
                    new_instance_ref,
                    network_info=None,
@@ -294,40 +537,13 @@ class LibvirtConnection(VmsConnection):
                    image_refs=[]):
 
         image_base_path = None
-        if not(skip_image_service) and CONF.gridcentric_use_image_service:
-            # We need to first download the descriptor and the disk files
-            # from the image service.
-            LOG.debug("Downloading images %s from the image service." % (image_refs))
-            image_base_path = os.path.join(CONF.instances_path, '_base')
-            if not os.path.exists(image_base_path):
-                LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
-                mkdir_as(image_base_path, self.openstack_uid)
-            image_service = glance.get_default_image_service()
-            for image_ref in image_refs:
-                image = image_service.show(context, image_ref)
-                target = os.path.join(image_base_path, image['name'])
-                if migration or not os.path.exists(target):
-                    # If the path does not exist fetch the data from the image
-                    # service.  NOTE: We always fetch in the case of a
-                    # migration, as the descriptor may have changed from its
-                    # previous state. Migrating VMs are the only case where a
-                    # descriptor for an instance will not be a fixed constant.
-                    # We download to a temporary location so we can make the
-                    # file appear atomically from the right user.
-                    fd, temp_target = tempfile.mkstemp(dir=image_base_path)
-                    try:
-                        os.close(fd)
-                        images.fetch(context,
-                                     image_ref,
-                                     temp_target,
-                                     new_instance_ref['user_id'],
-                                     new_instance_ref['project_id'])
-                        os.chown(temp_target, self.openstack_uid, self.openstack_gid)
-                        os.chmod(temp_target, 0644)
-                        os.rename(temp_target, target)
-                    except:
-                        os.unlink(temp_target)
-                        raise
+        if not(skip_image_service):
+            # NOTE: We always fetch in the case of a migration, as the
+            # descriptor may have changed from its previous state. Migrating
+            # VMs are the only case where a descriptor for an instance will
+            # not be a fixed constant.
+            image_base_path = self._fetch_images(context, new_instance_ref, image_refs,
+                                                 refetch=migration)
 
         # (dscannell) Check to see if we need to convert the network_info
         # object into the legacy format.
@@ -390,23 +606,78 @@ class LibvirtConnection(VmsConnection):
         # special case.
         return (libvirt_file, image_base_path)
 
-    @_log_call
+    def _artifact_path(self, context, image_base_path, image_ref):
+        if image_base_path == None:
+            return image_ref
+        image = glance.get_default_image_service().show(context, image_ref)
+        return os.path.join(image_base_path, image['name'])
+
+    def working_set(self, context, instance_ref):
+        domain = self.libvirt_conn._lookup_by_name(instance_ref['name'])
+        stats = domain.memoryStats()
+        if 'rss' in stats:
+            # Libvirt reports the memory statistics in KiB.
+            return stats['rss'] * 1024
+        return None
+
+    def _fetch_images(self, context, instance_ref, image_refs, refetch=False):
+        if not(CONF.gridcentric_use_image_service):
+            return None
+
+        # We need to first download the descriptor and the disk files
+        # from the image service.
+        LOG.debug("Downloading images %s from the image service." % (image_refs))
+        image_base_path = os.path.join(CONF.instances_path, '_base')
+        if not os.path.exists(image_base_path):
+            LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
+            mkdir_as(image_base_path, self.openstack_uid)
+        image_service = glance.get_default_image_service()
+        for image_ref in image_refs:
+            image = image_service.show(context, image_ref)
+            target = os.path.join(image_base_path, image['name'])
+            if refetch or not os.path.exists(target):
+                metrics.IMAGE_CACHE.inc(('miss',))
+                # If the path does not exist fetch the data from the image
+                # service. We download to a temporary location so we can make
+                # the file appear atomically from the right user.
+                fd, temp_target = tempfile.mkstemp(dir=image_base_path)
+                try:
+                    os.close(fd)
+                    fetch_start = time.time()
+                    images.fetch(context,
+                                 image_ref,
+                                 temp_target,
+                                 instance_ref['user_id'],
+                                 instance_ref['project_id'])
+                    metrics.TRANSFER_SECONDS.inc(('download',), time.time() - fetch_start)
+                    metrics.TRANSFER_BYTES.inc(('download',), os.path.getsize(temp_target))
+                    os.chown(temp_target, self.openstack_uid, self.openstack_gid)
+                    os.chmod(temp_target, 0644)
+                    os.rename(temp_target, target)
+                except:
+                    os.unlink(temp_target)
+                    raise
+            else:
+                metrics.IMAGE_CACHE.inc(('hit',))
+        return image_base_path
+
+    @_trace_call
     def post_launch(self, context,
                     new_instance_ref,
                     network_info=None,
                     block_device_info=None,
                     migration=False):
         self.libvirt_conn._enable_hairpin(new_instance_ref)
-        self.libvirt_conn.firewall_driver.apply_instance_filter(new_instance_ref, network_info)
+        self.firewall_batcher.apply_instance_filter(new_instance_ref, network_info)
 
-    @_log_call
+    @_trace_call
     def pre_migration(self, context, instance_ref, network_info, migration_url):
         # Make sure that the disk reflects all current state for this VM.
         # It's times like these that I wish there was a way to do this on a
         # per-file basis, but we have no choice here but to sync() globally.
         utilities.call_command(["sync"])
 
-    @_log_call
+    @_trace_call
     def post_migration(self, context, instance_ref, network_info, migration_url):
         # We make sure that all the memory servers are gone that need it.
         # This looks for any servers that are providing the migration_url we
@@ -456,15 +727,18 @@ class LibvirtConnection(VmsConnection):
             metadata['container_format'] = "bare"
 
             # Upload that image to the image service
+            upload_start = time.time()
             with open(blessed_file) as image_file:
                 image_service.update(context,
                                      image_ref,
                                      metadata,
                                      image_file)
+            metrics.TRANSFER_SECONDS.inc(('upload',), time.time() - upload_start)
+            metrics.TRANSFER_BYTES.inc(('upload',), os.path.getsize(blessed_file))
 
         return blessed_image_refs
 
-    @_log_call
+    @_trace_call
     def _delete_images(self, context, image_refs):
         image_service = glance.get_default_image_service()
         for image_ref in image_refs:
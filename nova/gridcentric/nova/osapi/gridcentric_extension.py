@@ -54,6 +54,8 @@ class GridcentricServerControllerExtension(wsgi.Controller):
         * Launch new virtual machines from a blessed copy above.
 
         * Discard blessed VMs.
+
+        * Change the memory target of launched VMs.
     """
 
     _view_builder_class = views_servers.ViewBuilder
@@ -68,7 +70,9 @@ class GridcentricServerControllerExtension(wsgi.Controller):
     @convert_exception
     def _bless_instance(self, req, id, body):
         context = req.environ["nova.context"]
-        result = self.gridcentric_api.bless_instance(context, id)
+        params = body.get('gc_bless', {}) or {}
+        result = self.gridcentric_api.bless_instance(context, id,
+                        idempotency_key=params.get('idempotency_key', None))
         return self._build_instance_list(req, [result])
 
     @wsgi.action('gc_discard')
@@ -84,8 +88,16 @@ class GridcentricServerControllerExtension(wsgi.Controller):
         context = req.environ["nova.context"]
         try:
             params = body.get('gc_launch', {})
+            hosts = params.pop('hosts', None)
+            idempotency_key = params.pop('idempotency_key', None)
+            if hosts:
+                result = self.gridcentric_api.launch_instances(context, id, hosts,
+                                                               params=params,
+                                                               idempotency_key=idempotency_key)
+                return self._build_instance_list(req, result)
             result = self.gridcentric_api.launch_instance(context, id,
-                                                          params=params)
+                                                          params=params,
+                                                          idempotency_key=idempotency_key)
             return self._build_instance_list(req, [result])
         except novaexc.QuotaError as error:
             self._handle_quota_error(error)
@@ -101,6 +113,39 @@ class GridcentricServerControllerExtension(wsgi.Controller):
         except novaexc.QuotaError as error:
             self._handle_quota_error(error)
 
+    @wsgi.action('gc_migrate_cancel')
+    @convert_exception
+    def _cancel_migration(self, req, id, body):
+        context = req.environ["nova.context"]
+        self.gridcentric_api.cancel_migration(context, id)
+        return webob.Response(status_int=202)
+
+    @wsgi.action('gc_stats')
+    @convert_exception
+    def _get_stats(self, req, id, body):
+        context = req.environ["nova.context"]
+        result = self.gridcentric_api.get_stats(context, id)
+        return webob.Response(status_int=200, body=json.dumps(result))
+
+    @wsgi.action('gc_prewarm')
+    @convert_exception
+    def _prewarm_instance(self, req, id, body):
+        context = req.environ["nova.context"]
+        params = body.get('gc_prewarm', {}) or {}
+        self.gridcentric_api.prewarm_instance(context, id, hosts=params.get('hosts', None),
+                                              mlock=params.get('mlock', False))
+        return webob.Response(status_int=202)
+
+    @wsgi.action('gc_set_target')
+    @convert_exception
+    def _set_target(self, req, id, body):
+        context = req.environ["nova.context"]
+        target = body['gc_set_target'].get('target', None)
+        if target == None:
+            raise exc.HTTPBadRequest(explanation=_("A memory target is required."))
+        self.gridcentric_api.set_target(context, id, str(target))
+        return webob.Response(status_int=200)
+
     @wsgi.action('gc_list_launched')
     @convert_exception
     def _list_launched_instances(self, req, id, body):
@@ -173,6 +218,25 @@ class GridcentricTargetBootController(object):
     def create(self, req, body):
         return self.nova_servers.create(req, body)
 
+class GridcentricHostController(object):
+    """ Host level gridcentric operations. """
+
+    def __init__(self):
+        self.gridcentric_api = API()
+
+    @convert_exception
+    def evacuate(self, req, id, body):
+        context = req.environ["nova.context"]
+        parallelism = (body or {}).get('evacuate', {}).get('parallelism', None)
+        self.gridcentric_api.evacuate_host(context, id, parallelism=parallelism)
+        return webob.Response(status_int=202)
+
+    @convert_exception
+    def show(self, req, id):
+        context = req.environ["nova.context"]
+        result = self.gridcentric_api.evacuation_status(context, id)
+        return webob.Response(status_int=200, body=json.dumps({'evacuation': result}))
+
 class Gridcentric_extension(object):
     """ 
     The OpenStack Extension definition for the Gridcentric capabilities. Currently this includes:
@@ -186,6 +250,8 @@ class Gridcentric_extension(object):
         * Discard blessed VMs.
 
         * List launched VMs (per blessed VM).
+
+        * Evacuate hosts.
     """
 
     name = "Gridcentric"
@@ -201,6 +267,10 @@ class Gridcentric_extension(object):
         resource = extensions.ResourceExtension('gcservers',
                                                GridcentricTargetBootController())
         resources.append(resource)
+        resource = extensions.ResourceExtension('gchosts',
+                                               GridcentricHostController(),
+                                               member_actions={'evacuate': 'POST'})
+        resources.append(resource)
         return resources
 
     def get_controller_extensions(self):
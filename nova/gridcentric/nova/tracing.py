@@ -0,0 +1,83 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Trace IDs tie together the steps that one gridcentric operation takes across the API, the
+gridcentric services and vms. The API picks the trace ID of an operation (the request ID of the
+API request, unless it is already part of a traced operation) and passes it in the rpc args of
+the messages it sends for the operation. The services make it the current trace ID of the
+greenthread running the operation, which tags their log lines and notifications.
+"""
+
+import bisect
+import logging
+import random
+
+from eventlet import corolocal
+
+_local = corolocal.local()
+
+def current():
+    """ Returns the trace ID of the operation running in this greenthread, if any. """
+    return getattr(_local, 'trace_id', None)
+
+def set_current(trace_id):
+    """ Makes trace_id the current trace ID of this greenthread and returns the previous one. """
+    previous = current()
+    _local.trace_id = trace_id
+    return previous
+
+def for_context(context):
+    """ Returns the trace ID for an operation started with the given request context. """
+    return current() or getattr(context, 'request_id', None)
+
+class TraceFilter(logging.Filter):
+    """
+    Sets the trace_id attribute of log records to the current trace ID ("-" outside of traced
+    operations), for log formats that include %(trace_id)s. The message is left alone since the
+    trace ID is usually the request ID that nova logs already.
+    """
+
+    def filter(self, record):
+        record.trace_id = current() or '-'
+        return True
+
+def trace_log(log):
+    """ Tags the records of the given logger (or log adapter) with the current trace ID. """
+    getattr(log, 'logger', log).addFilter(TraceFilter())
+
+def sampled(log, rate):
+    """ Returns whether to log the details of an event, given the fraction of them to log. """
+    return log.isEnabledFor(logging.DEBUG) and random.random() < rate
+
+# The upper bounds, in seconds, of the buckets of duration histograms.
+DURATION_BUCKETS = [0.001, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0]
+
+class Histogram(object):
+    """
+    Counts observed values into buckets by upper bound. Values above the last bound go into an
+    overflow bucket.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
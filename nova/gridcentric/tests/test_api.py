@@ -17,12 +17,17 @@ import unittest
 import os
 import shutil
 
+from datetime import timedelta
+
+from eventlet import greenthread
+
 from nova import db
 from nova import context as nova_context
 from nova import exception
 
 from nova.compute import vm_states, task_states
 from nova.db.sqlalchemy import api as sqlalchemy_db
+from nova.openstack.common import timeutils
 
 from oslo.config import cfg
 
@@ -267,6 +272,251 @@ class GridCentricApiTestCase(unittest.TestCase):
             "The instance should have the 'launched from' metadata set to blessed instanced id after being launched. " \
           + "(value=%s)" % (metadata['launched_from']))
 
+    def test_bless_instance_idempotency_key(self):
+        instance_uuid = utils.create_instance(self.context)
+
+        blessed_instance = self.gridcentric_api.bless_instance(self.context, instance_uuid,
+                                                               idempotency_key='bless-1')
+        num_instance_before = len(db.instance_get_all(self.context))
+
+        # A retry of the same request gets the original blessed instance.
+        repeated_instance = self.gridcentric_api.bless_instance(self.context, instance_uuid,
+                                                                idempotency_key='bless-1')
+        self.assertEquals(blessed_instance['uuid'], repeated_instance['uuid'])
+        self.assertEquals(num_instance_before, len(db.instance_get_all(self.context)))
+
+    def test_launch_instance_idempotency_key(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+
+        launched_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                                 idempotency_key='launch-1')
+        repeated_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                                 idempotency_key='launch-1')
+        self.assertEquals(launched_instance['uuid'], repeated_instance['uuid'])
+
+        # Other keys launch other instances.
+        other_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                              idempotency_key='launch-2')
+        self.assertNotEquals(launched_instance['uuid'], other_instance['uuid'])
+
+        # And keys are forgotten after the window.
+        CONF.set_override('gridcentric_idempotency_window', -1)
+        try:
+            late_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                                 idempotency_key='launch-1')
+            self.assertNotEquals(launched_instance['uuid'], late_instance['uuid'])
+        finally:
+            CONF.clear_override('gridcentric_idempotency_window')
+
+    def test_launch_instance_from_pool(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pooled_instance(self.context, source_uuid=blessed_uuid)
+
+        num_instance_before = len(db.instance_get_all(self.context))
+        launched_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                                 params={'name': 'pooled clone'})
+
+        self.assertEquals(pooled_uuid, launched_instance['uuid'])
+        self.assertEquals(num_instance_before, len(db.instance_get_all(self.context)))
+        self.assertEquals('pooled clone', launched_instance['display_name'])
+        self.assertEquals(task_states.UNPAUSING, launched_instance['task_state'])
+        metadata = db.instance_metadata_get(self.context, pooled_uuid)
+        self.assertEquals(blessed_uuid, metadata['launched_from'])
+        self.assertFalse('pooled_from' in metadata)
+
+    def test_claim_pooled_instance_once(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pooled_instance(self.context, source_uuid=blessed_uuid)
+
+        claimed_instance = self.gridcentric_api._claim_pooled_instance(self.context, blessed_uuid)
+        self.assertEquals(pooled_uuid, claimed_instance['uuid'])
+        self.assertEquals(task_states.UNPAUSING, claimed_instance['task_state'])
+
+        # The clone was taken, even though it is still paused.
+        self.assertEquals(None,
+                          self.gridcentric_api._claim_pooled_instance(self.context, blessed_uuid))
+
+    def test_launch_instance_with_target_skips_pool(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pooled_instance(self.context, source_uuid=blessed_uuid)
+
+        launched_instance = self.gridcentric_api.launch_instance(self.context, blessed_uuid,
+                                                                 params={'target': '512MB'})
+
+        self.assertNotEquals(pooled_uuid, launched_instance['uuid'])
+        pooled_instance = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(vm_states.PAUSED, pooled_instance['vm_state'])
+
+    def test_launch_instance_prewarmed_host(self):
+
+        utils.create_gridcentric_service(self.context, 'warm-host')
+        utils.create_gridcentric_service(self.context, 'cold-host')
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        now = timeutils.strtime()
+        db.instance_system_metadata_update(self.context, blessed_uuid,
+                                           {'gc_prewarmed_warm-host': '1.0,%s' % now,
+                                            'gc_prewarmed_cold-host': '0.1,%s' % now},
+                                           False)
+
+        self.gridcentric_api.launch_instance(self.context, blessed_uuid)
+
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.warm-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('launch_instance', method['method'])
+
+    def test_prewarmed_hosts_stale(self):
+
+        utils.create_gridcentric_service(self.context, 'warm-host')
+        utils.create_gridcentric_service(self.context, 'stale-host')
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        stale = timeutils.utcnow() - timedelta(seconds=CONF.gridcentric_prewarm_max_age + 60)
+        db.instance_system_metadata_update(self.context, blessed_uuid,
+                                           {'gc_prewarmed_warm-host':
+                                                '1.0,%s' % timeutils.strtime(),
+                                            'gc_prewarmed_stale-host':
+                                                '1.0,%s' % timeutils.strtime(stale)},
+                                           False)
+
+        self.assertEquals(['warm-host'],
+                          self.gridcentric_api._prewarmed_hosts(self.context, blessed_uuid))
+
+    def test_launch_instance_available_memory(self):
+
+        utils.create_gridcentric_service(self.context, 'small-host')
+        utils.create_gridcentric_service(self.context, 'big-host')
+        utils.create_compute_node(self.context, 'small-host', 512)
+        compute_node = utils.create_compute_node(self.context, 'big-host', 256)
+        # The clones on big-host are held to a target well below their memory.
+        db.compute_node_update(self.context, compute_node['id'],
+                               {'stats': {'gridcentric_overcommit_mb': 1024}})
+        blessed_uuid = utils.create_blessed_instance(self.context)
+
+        self.gridcentric_api.launch_instance(self.context, blessed_uuid)
+
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.big-host' % CONF.gridcentric_topic, queue)
+
+    def test_pick_launch_host_spread(self):
+
+        for host in ['host-1', 'host-2', 'small-host']:
+            utils.create_gridcentric_service(self.context, host)
+        utils.create_compute_node(self.context, 'host-1', 1024)
+        utils.create_compute_node(self.context, 'host-2', 768)
+        utils.create_compute_node(self.context, 'small-host', 256)
+
+        # The launches are spread over the hosts with about as much memory as the best one.
+        picked = set([self.gridcentric_api._pick_launch_host(self.context,
+                                                             ['host-1', 'host-2', 'small-host'])
+                      for i in range(32)])
+        self.assertEquals(set(['host-1', 'host-2']), picked)
+
+    def test_launch_instances_fanout(self):
+
+        for host in ['source-host', 'dest-host1', 'dest-host2']:
+            utils.create_gridcentric_service(self.context, host)
+        blessed_uuid = utils.create_blessed_instance(self.context, {'host': 'source-host'})
+
+        self.mock_rpc.call_log = []
+        launched_instances = self.gridcentric_api.launch_instances(self.context, blessed_uuid,
+                                        ['dest-host1', 'dest-host2', 'dest-host2'])
+        self.assertEquals(3, len(launched_instances))
+        for launched_instance in launched_instances:
+            metadata = db.instance_metadata_get(self.context, launched_instance['uuid'])
+            self.assertEquals(blessed_uuid, metadata['launched_from'])
+
+        # Let the batch run.
+        greenthread.sleep(0)
+
+        (queue, method, timeout, kwargs) = self.mock_rpc.call_log[0]
+        self.assertEquals('%s.source-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('serve_instance', method['method'])
+        launches = [(queue, method['args']['instance_uuid'])
+                    for (queue, method, timeout, kwargs) in self.mock_rpc.call_log[1:]]
+        self.assertEquals(sorted([('%s.dest-host1' % CONF.gridcentric_topic,
+                                   launched_instances[0]['uuid']),
+                                  ('%s.dest-host2' % CONF.gridcentric_topic,
+                                   launched_instances[1]['uuid']),
+                                  ('%s.dest-host2' % CONF.gridcentric_topic,
+                                   launched_instances[2]['uuid'])]),
+                          sorted(launches))
+
+    def test_launch_instances_partial_failure(self):
+
+        for host in ['dest-host1', 'dest-host2']:
+            utils.create_gridcentric_service(self.context, host)
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        num_instance_before = len(db.instance_get_all(self.context))
+
+        copy_instance = self.gridcentric_api._copy_instance
+        copies = []
+        def failing_copy_instance(*args, **kwargs):
+            copies.append(True)
+            if len(copies) == 2:
+                raise utils.TestInducedException()
+            return copy_instance(*args, **kwargs)
+        self.gridcentric_api._copy_instance = failing_copy_instance
+
+        self.mock_rpc.call_log = []
+        self.assertRaises(utils.TestInducedException, self.gridcentric_api.launch_instances,
+                          self.context, blessed_uuid, ['dest-host1', 'dest-host2'])
+
+        # The clone created before the failure is gone, and nothing was launched.
+        self.assertEquals(num_instance_before, len(db.instance_get_all(self.context)))
+        greenthread.sleep(0)
+        self.assertEquals([], self.mock_rpc.call_log)
+
+    def test_launch_instances_idempotency_key(self):
+
+        for host in ['dest-host1', 'dest-host2']:
+            utils.create_gridcentric_service(self.context, host)
+        blessed_uuid = utils.create_blessed_instance(self.context)
+
+        # A retry that comes in while the batch is still creating its clones.
+        copy_instance = self.gridcentric_api._copy_instance
+        retries = []
+        def retrying_copy_instance(*args, **kwargs):
+            new_instance_ref = copy_instance(*args, **kwargs)
+            if len(retries) == 0:
+                self.assertRaises(exception.NovaException,
+                                  self.gridcentric_api.launch_instances,
+                                  self.context, blessed_uuid, ['dest-host1', 'dest-host2'],
+                                  idempotency_key='batch-1')
+                retries.append(True)
+            return new_instance_ref
+        self.gridcentric_api._copy_instance = retrying_copy_instance
+
+        launched_instances = self.gridcentric_api.launch_instances(self.context, blessed_uuid,
+                                        ['dest-host1', 'dest-host2'], idempotency_key='batch-1')
+        self.assertEquals([True], retries)
+
+        # Once the batch is complete, a retry gets all of it.
+        repeated_instances = self.gridcentric_api.launch_instances(self.context, blessed_uuid,
+                                        ['dest-host1', 'dest-host2'], idempotency_key='batch-1')
+        self.assertEquals(sorted([instance['uuid'] for instance in launched_instances]),
+                          sorted([instance['uuid'] for instance in repeated_instances]))
+
+        # Unless some of it failed.
+        db.instance_update(self.context, launched_instances[0]['uuid'],
+                           {'vm_state': vm_states.ERROR})
+        self.assertRaises(exception.NovaException, self.gridcentric_api.launch_instances,
+                          self.context, blessed_uuid, ['dest-host1', 'dest-host2'],
+                          idempotency_key='batch-1')
+
+    def test_launch_instances_unknown_host(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        self.assertRaises(exception.NovaException, self.gridcentric_api.launch_instances,
+                          self.context, blessed_uuid, ['no-such-host'])
+
+    def test_launch_unknown_vms_policy(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        self.assertRaises(exception.NovaException, self.gridcentric_api.launch_instance,
+                          self.context, blessed_uuid, params={'vms_policy': 'no-such-policy'})
+
     def test_launch_not_blessed_image(self):
 
         instance_uuid = utils.create_instance(self.context)
@@ -376,6 +626,88 @@ class GridCentricApiTestCase(unittest.TestCase):
         self.assertEquals(vm_states.ACTIVE, instance_ref['vm_state'])
 
 
+    def test_migrate_instance_picks_free_host(self):
+        instance_uuid = utils.create_instance(self.context, {"vm_state":vm_states.ACTIVE})
+        busy_host = utils.create_gridcentric_service(self.context)['host']
+        free_host = utils.create_gridcentric_service(self.context)['host']
+        utils.create_compute_node(self.context, busy_host, 256)
+        utils.create_compute_node(self.context, free_host, 4096)
+
+        self.gridcentric_api.migrate_instance(self.context, instance_uuid, None)
+
+        queue, message, kwargs = self.mock_rpc.cast_log[-1]
+        self.assertEquals('migrate_instance', message['method'])
+        self.assertEquals(free_host, message['args']['dest'])
+
+    def test_migrate_instance_skips_disabled_host(self):
+        instance_uuid = utils.create_instance(self.context, {"vm_state":vm_states.ACTIVE})
+        drained_service = utils.create_gridcentric_service(self.context)
+        enabled_host = utils.create_gridcentric_service(self.context)['host']
+        db.service_update(self.context, drained_service['id'], {'disabled': True})
+        utils.create_compute_node(self.context, drained_service['host'], 4096)
+        utils.create_compute_node(self.context, enabled_host, 256)
+
+        self.gridcentric_api.migrate_instance(self.context, instance_uuid, None)
+
+        queue, message, kwargs = self.mock_rpc.cast_log[-1]
+        self.assertEquals(enabled_host, message['args']['dest'])
+
+    def test_cancel_migration(self):
+        instance_uuid = utils.create_instance(self.context, {"vm_state": vm_states.ACTIVE,
+                                                             "host": "source-host"})
+        self.assertRaises(exception.NovaException, self.gridcentric_api.cancel_migration,
+                          self.context, instance_uuid)
+
+        db.instance_update(self.context, instance_uuid, {'task_state': task_states.MIGRATING})
+        self.gridcentric_api.cancel_migration(self.context, instance_uuid)
+
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.source-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('cancel_migration', method['method'])
+        self.assertEquals(instance_uuid, method['args']['instance_uuid'])
+
+    def test_migration_bandwidth(self):
+        CONF.set_override('gridcentric_migration_bandwidth',
+                          ['host-a:host-b:100', 'host-b:1000'])
+        try:
+            self.assertEquals(100.0, self.gridcentric_api._migration_bandwidth('host-a', 'host-b'))
+            self.assertEquals(1000.0, self.gridcentric_api._migration_bandwidth('host-c', 'host-b'))
+            self.assertEquals(None, self.gridcentric_api._migration_bandwidth('host-a', 'host-c'))
+        finally:
+            CONF.clear_override('gridcentric_migration_bandwidth')
+
+    def test_set_target(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': 'launch-host',
+                                               'metadata': {'launched_from': blessed_uuid}})
+
+        self.gridcentric_api.set_target(self.context, launched_uuid, '512MB')
+
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.launch-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('set_target', method['method'])
+        self.assertEquals('512MB', method['args']['target'])
+        self.assertEquals(self.context.request_id, method['args']['trace_id'])
+
+    def test_set_target_invalid(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': 'launch-host',
+                                               'metadata': {'launched_from': blessed_uuid}})
+
+        self.assertRaises(exception.NovaException, self.gridcentric_api.set_target,
+                          self.context, launched_uuid, '512megabytes')
+        self.assertEquals([], self.mock_rpc.cast_log)
+
+    def test_set_target_not_launched(self):
+
+        instance_uuid = utils.create_instance(self.context)
+        self.assertRaises(exception.NovaException, self.gridcentric_api.set_target,
+                          self.context, instance_uuid, '512MB')
+
     def test_migrate_inactive_instance(self):
         instance_uuid = utils.create_instance(self.context, {"vm_state":vm_states.BUILDING})
         # Create a service so that one can be found by the api.
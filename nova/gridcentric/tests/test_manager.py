@@ -14,21 +14,33 @@
 #    under the License.
 
 import unittest
+import errno
 import os
 import shutil
+import socket
+import sys
+import tempfile
 
 from datetime import datetime
 
+from eventlet import greenthread
+
 from nova import db
 from nova import context as nova_context
 from nova import exception
 
 from nova.compute import vm_states
 from nova.compute import task_states
+from nova.openstack.common import timeutils
+from nova.virt import event as virtevent
 
 from oslo.config import cfg
 
 import gridcentric.nova.extension.manager as gc_manager
+from gridcentric.nova.extension import journal
+from gridcentric.nova.extension import metrics
+from gridcentric.nova.extension import profiler
+from gridcentric.nova import tracing
 import gridcentric.tests.utils as utils
 
 CONF = cfg.CONF
@@ -198,6 +210,106 @@ class GridCentricManagerTestCase(unittest.TestCase):
         self.assertEquals(None, launched_instance['task_state'])
         self.assertEquals(self.gridcentric.host, launched_instance['host'])
 
+    def test_launch_instance_image_refs(self):
+
+        self.vmsconn.set_return_val("launch", None)
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                                        {'metadata': {'images': 'image-1,image-2'}})
+        launched_uuid = utils.create_pre_launched_instance(self.context, source_uuid=blessed_uuid)
+
+        # The artifacts are listed by the blessed instance, not by the new clone.
+        self.gridcentric.launch_instance(self.context, instance_uuid=launched_uuid)
+        self.assertEquals(['image-1', 'image-2'], self.vmsconn.launch_image_refs)
+
+    def test_launch_instance_vms_policy(self):
+
+        CONF.set_override('gridcentric_vms_policy_profiles',
+                          ['latency-first:latency-policy', 'density-first:density-policy'])
+        try:
+            self.vmsconn.set_return_val("launch", None)
+            blessed_uuid = utils.create_blessed_instance(self.context,
+                                            {'metadata': {'gc:vms_policy': 'density-first'}})
+            launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                               source_uuid=blessed_uuid)
+
+            self.gridcentric.launch_instance(self.context, instance_uuid=launched_uuid)
+            self.assertEquals('density-policy', self.vmsconn.launch_vms_policy)
+
+            # The profile given to the launch wins over the blessed instance's.
+            self.vmsconn.set_return_val("launch", None)
+            launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                               source_uuid=blessed_uuid)
+            self.gridcentric.launch_instance(self.context, instance_uuid=launched_uuid,
+                                             params={'vms_policy': 'latency-first'})
+            self.assertEquals('latency-policy', self.vmsconn.launch_vms_policy)
+            metadata = db.instance_metadata_get(self.context, launched_uuid)
+            self.assertEquals('latency-first', metadata['gc:vms_policy'])
+        finally:
+            CONF.clear_override('gridcentric_vms_policy_profiles')
+
+    def test_prefetch_profile(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                                                     {'metadata': {'images': 'blessed-image'}})
+        launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                           {'host': self.gridcentric.host},
+                                                           source_uuid=blessed_uuid)
+
+        self.vmsconn.set_return_val("capture_prefetch_profile", ['prefetch-image'])
+        self.gridcentric._capture_prefetch_profile(self.context, launched_uuid, blessed_uuid)
+
+        self.assertEquals({self.gridcentric.host: 'prefetch-image'},
+                          self.gridcentric._prefetch_refs(self.context, blessed_uuid))
+        # The hint stays out of the user's metadata.
+        metadata = db.instance_metadata_get(self.context, blessed_uuid)
+        self.assertEquals('blessed-image', metadata['images'])
+
+        # Later launches fetch the hint and hand it to vms.
+        self.vmsconn.set_return_val("launch", None)
+        launched_uuid = utils.create_pre_launched_instance(self.context, source_uuid=blessed_uuid)
+        self.gridcentric.launch_instance(self.context, instance_uuid=launched_uuid)
+        self.assertEquals('prefetch-image', self.vmsconn.launch_prefetch_ref)
+        self.assertEquals(['blessed-image', 'prefetch-image'], self.vmsconn.launch_image_refs)
+
+        # Only one hint is recorded.
+        self.gridcentric._capture_prefetch_profile(self.context, launched_uuid, blessed_uuid)
+        self.assertEquals(1, len(self.gridcentric._prefetch_refs(self.context, blessed_uuid)))
+
+    def test_prefetch_profile_hosts(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        db.instance_system_metadata_update(self.context, blessed_uuid,
+                                           {'gc_prefetch_other-host': 'other-image',
+                                            'gc_prefetch_%s' % self.gridcentric.host:
+                                                'local-image'},
+                                           False)
+
+        # The hint recorded on this host is preferred.
+        self.vmsconn.set_return_val("launch", None)
+        launched_uuid = utils.create_pre_launched_instance(self.context, source_uuid=blessed_uuid)
+        self.gridcentric.launch_instance(self.context, instance_uuid=launched_uuid)
+        self.assertEquals('local-image', self.vmsconn.launch_prefetch_ref)
+
+        # Every hint goes along with the blessed instance.
+        self.vmsconn.set_return_val("discard", None)
+        self.gridcentric.discard_instance(self.context, instance_uuid=blessed_uuid)
+        self.assertEquals(['local-image', 'other-image'], sorted(self.vmsconn.discard_image_refs))
+
+    def test_prefetch_profile_exception(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                           {'host': self.gridcentric.host},
+                                                           source_uuid=blessed_uuid)
+
+        self.gridcentric.prefetch_captures.add(blessed_uuid)
+        self.vmsconn.set_return_val("capture_prefetch_profile", utils.TestInducedException())
+        self.gridcentric._capture_prefetch_profile(self.context, launched_uuid, blessed_uuid)
+
+        # Nothing is recorded and another clone on this host can have a go.
+        self.assertEquals({}, self.gridcentric._prefetch_refs(self.context, blessed_uuid))
+        self.assertFalse(blessed_uuid in self.gridcentric.prefetch_captures)
+
     def test_launch_instance_exception(self):
 
         self.vmsconn.set_return_val("launch", utils.TestInducedException())
@@ -252,6 +364,489 @@ class GridCentricManagerTestCase(unittest.TestCase):
         self.assertEquals(None, launched_instance['host'])
 
 
+    def test_cancel_migration(self):
+
+        instance_uuid = utils.create_instance(self.context, {'vm_state': vm_states.ACTIVE})
+        self.assertRaises(exception.NovaException, self.gridcentric.cancel_migration,
+                          self.context, instance_uuid=instance_uuid)
+
+        # A migration that has not reached the destination yet stops by itself.
+        migration = {'dest': 'dest-host', 'launching': False, 'cancelled': False}
+        self.gridcentric.migrations[instance_uuid] = migration
+        self.mock_rpc.cast_log = []
+        self.gridcentric.cancel_migration(self.context, instance_uuid=instance_uuid)
+        self.assertTrue(migration['cancelled'])
+        self.assertEquals([], self.mock_rpc.cast_log)
+
+        # Otherwise the destination aborts its launch.
+        migration['launching'] = True
+        self.gridcentric.cancel_migration(self.context, instance_uuid=instance_uuid)
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.dest-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('cancel_launch', method['method'])
+        self.assertEquals(instance_uuid, method['args']['instance_uuid'])
+
+    def test_cancel_launch(self):
+
+        instance_uuid = utils.create_instance(self.context, {'vm_state': vm_states.ACTIVE})
+        instance_ref = db.instance_get_by_uuid(self.context, instance_uuid)
+
+        # Nothing to abort once the launch is over.
+        self.gridcentric.cancel_launch(self.context, instance_uuid=instance_uuid)
+
+        # A running vms launch is killed.
+        self.gridcentric.incoming_launches[instance_uuid] = {'name': instance_ref['name'],
+                                                             'launching': True,
+                                                             'cancelled': False}
+        self.vmsconn.set_return_val("abort_launch", None)
+        self.gridcentric.cancel_launch(self.context, instance_uuid=instance_uuid)
+        self.assertEquals([], self.vmsconn.return_vals["abort_launch"])
+
+    def test_launch_instance_migrate_cancelled(self):
+
+        self.vmsconn.set_return_val("launch", None)
+        instance_uuid = utils.create_instance(self.context, {'vm_state': vm_states.ACTIVE})
+
+        # The launch was cancelled while it set up the instance networking.
+        original_update = self.gridcentric._instance_update
+        def cancelling_update(context, uuid, **kwargs):
+            if uuid in self.gridcentric.incoming_launches:
+                self.gridcentric.cancel_launch(context, instance_uuid=uuid)
+            return original_update(context, uuid, **kwargs)
+        self.gridcentric._instance_update = cancelling_update
+
+        self.assertRaises(exception.NovaException, self.gridcentric.launch_instance,
+                          self.context, instance_uuid=instance_uuid,
+                          migration_url="migration_url")
+        # The vms launch never started.
+        self.assertEquals([None], self.vmsconn.return_vals["launch"])
+        self.assertEquals({}, self.gridcentric.incoming_launches)
+        self.assertEquals(None, db.instance_get_by_uuid(self.context, instance_uuid)['host'])
+
+    def test_migrate_instance_cancelled_after_launch(self):
+
+        instance_uuid = utils.create_instance(self.context, {'host': self.gridcentric.host})
+        dest_vmsconn = utils.MockVmsConn()
+        dest = gc_manager.GridCentricManager(vmsconn=dest_vmsconn)
+        dest.host = 'dest-host'
+
+        # The cancel reaches the destination just as vms is done launching there, before vms
+        # has set up the control to kill the launch with.
+        def dest_launch(context, instance_name, new_instance_ref, network_info, **kwargs):
+            self.gridcentric.cancel_migration(context, instance_uuid=instance_uuid)
+            (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+            self.assertEquals('%s.dest-host' % CONF.gridcentric_topic, queue)
+            dest.cancel_launch(context, **method['args'])
+        dest_vmsconn.launch = dest_launch
+        dest_vmsconn.set_return_val("abort_launch", None)
+        dest_vmsconn.set_return_val("abort_launch", utils.TestInducedException())
+
+        def call(context, queue, msg, timeout=None):
+            if queue == '%s.dest-host' % CONF.gridcentric_topic:
+                return getattr(dest, msg['method'])(context, **msg['args'])
+        orig_call = gc_manager.rpc.call
+        gc_manager.rpc.call = call
+        self.gridcentric.network_api.get_instance_nw_info = lambda context, instance_ref: []
+        CONF.set_override('gridcentric_outgoing_migration_address', 'eth0')
+        try:
+            for (method, value) in [("bless", ("name", "mcdist://eth0", [])),
+                                    ("post_bless", []), ("pre_migration", None),
+                                    ("launch", None), ("post_migration", None),
+                                    ("discard", None)]:
+                self.vmsconn.set_return_val(method, value)
+            self.mock_rpc.cast_log = []
+
+            self.gridcentric.migrate_instance(self.context, instance_uuid=instance_uuid,
+                                              dest='dest-host')
+        finally:
+            CONF.clear_override('gridcentric_outgoing_migration_address')
+            gc_manager.rpc.call = orig_call
+
+        # The destination tore its launch down, and the instance was relaunched here.
+        self.assertEquals([], dest_vmsconn.return_vals['abort_launch'])
+        self.assertEquals({}, dest.incoming_launches)
+        self.assertEquals([], self.vmsconn.return_vals['launch'])
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(self.gridcentric.host, instance['host'])
+        self.assertEquals(vm_states.ACTIVE, instance['vm_state'])
+
+    def test_learned_target(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context, {'memory_mb': 512})
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': blessed_uuid}})
+        blessed_ref = db.instance_get_by_uuid(self.context, blessed_uuid)
+
+        CONF.set_override('gridcentric_working_set_min_samples', 2)
+        CONF.set_override('gridcentric_working_set_weight', 0.5)
+        CONF.set_override('gridcentric_working_set_margin', 0.25)
+        CONF.set_override('gridcentric_working_set_interval', 0)
+        try:
+            self.vmsconn.set_return_val("working_set", 100 << 20)
+            self.gridcentric._sample_working_sets(self.context)
+            # A single sample is not enough to go on.
+            self.assertEquals("0", self.gridcentric._learned_target(self.context, blessed_ref))
+
+            self.vmsconn.set_return_val("working_set", 200 << 20)
+            self.gridcentric._sample_working_sets(self.context)
+            self.assertEquals({self.gridcentric.host: (150 << 8, 2)},
+                              self.gridcentric._working_sets(self.context, blessed_uuid))
+            self.assertEquals(str(int((150 << 8) * 1.25)),
+                              self.gridcentric._learned_target(self.context, blessed_ref))
+
+            # The samples of other hosts are weighted by their number.
+            db.instance_system_metadata_update(self.context, blessed_uuid,
+                                               {'gc_working_set_other-host': '%s,6' % (50 << 8)},
+                                               False)
+            self.assertEquals(str(int((75 << 8) * 1.25)),
+                              self.gridcentric._learned_target(self.context, blessed_ref))
+
+            # The learned working sets stay out of the user's metadata.
+            self.assertFalse('gc:working_set' in db.instance_metadata_get(self.context,
+                                                                          blessed_uuid))
+        finally:
+            CONF.clear_override('gridcentric_working_set_interval')
+            CONF.clear_override('gridcentric_working_set_min_samples')
+            CONF.clear_override('gridcentric_working_set_weight')
+            CONF.clear_override('gridcentric_working_set_margin')
+
+    def test_set_target(self):
+
+        self.vmsconn.set_return_val("set_target", None)
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': 'blessed'}})
+
+        self.gridcentric.set_target(self.context, instance_uuid=launched_uuid, target="1gb")
+
+        metadata = db.instance_metadata_get(self.context, launched_uuid)
+        self.assertEquals(str(1 << 18), metadata['gc:target'])
+
+    def test_set_target_unsupported(self):
+
+        self.vmsconn.target_supported = False
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': 'blessed'}})
+
+        self.assertRaises(exception.NovaException, self.gridcentric.set_target,
+                          self.context, instance_uuid=launched_uuid, target="1gb")
+        self.assertFalse('gc:target' in db.instance_metadata_get(self.context, launched_uuid))
+
+    def test_set_target_trace_id(self):
+
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': 'blessed'}})
+        trace_ids = []
+        self.vmsconn.set_target = \
+            lambda context, instance_ref, target: trace_ids.append(tracing.current())
+
+        self.gridcentric.set_target(self.context, instance_uuid=launched_uuid, target="1gb",
+                                    trace_id='trace-1')
+        self.gridcentric.set_target(self.context, instance_uuid=launched_uuid, target="1gb")
+
+        self.assertEquals(['trace-1', self.context.request_id], trace_ids)
+        self.assertEquals(None, tracing.current())
+
+    def test_flight_recorder(self):
+
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': 'blessed'}})
+        other_uuid = utils.create_instance(self.context, {'host': 'other-host'})
+        self.gridcentric.recorder.operations.clear()
+
+        self.vmsconn.set_return_val("set_target", None)
+        self.gridcentric.set_target(self.context, instance_uuid=launched_uuid, target="1gb",
+                                    trace_id='trace-1')
+        self.assertRaises(exception.NovaException, self.gridcentric.set_target,
+                          self.context, instance_uuid=other_uuid, target="1gb")
+
+        operations = self.gridcentric.recorder.dump()
+        self.assertEquals(2, len(operations))
+        self.assertEquals('set_target', operations[0]['operation'])
+        self.assertEquals(launched_uuid, operations[0]['instance_uuid'])
+        self.assertEquals('trace-1', operations[0]['trace_id'])
+        self.assertEquals('ok', operations[0]['outcome'])
+        self.assertEquals(['lookup', 'lock wait'],
+                          [name for (name, duration) in operations[0]['phases']])
+        self.assertEquals('error', operations[1]['outcome'])
+
+    def test_metrics(self):
+
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': 'blessed'}})
+        metrics.OPERATIONS.histograms.clear()
+
+        self.vmsconn.set_return_val("set_target", None)
+        self.gridcentric.set_target(self.context, instance_uuid=launched_uuid, target="1gb")
+
+        text = metrics.render()
+        self.assertTrue('# TYPE gridcentric_operation_seconds histogram' in text)
+        self.assertTrue('gridcentric_operation_seconds_count'
+                        '{operation="set_target",outcome="ok"} 1\n' in text)
+        self.assertTrue('gridcentric_operation_seconds_bucket'
+                        '{operation="set_target",outcome="ok",le="+Inf"} 1\n' in text)
+
+    def test_instance_update_retry(self):
+
+        instance_uuid = utils.create_instance(self.context)
+        real_db = self.gridcentric.db
+        writes = []
+        failures = [2]
+
+        class FlakyDb(object):
+            def __getattr__(self, name):
+                return getattr(real_db, name)
+
+            def instance_update(self, context, instance_uuid, values):
+                writes.append(dict(values))
+                if failures[0] > 0:
+                    failures[0] -= 1
+                    raise utils.TestInducedException()
+                return real_db.instance_update(context, instance_uuid, values)
+
+        CONF.set_override('gridcentric_db_retry_delay', 0.001)
+        self.gridcentric.db = FlakyDb()
+        try:
+            first = greenthread.spawn(self.gridcentric._instance_update, self.context,
+                                      instance_uuid, vm_state=vm_states.ERROR)
+            # Let the first update fail once and start retrying.
+            greenthread.sleep(0)
+            self.gridcentric._instance_update(self.context, instance_uuid,
+                                              task_state=task_states.SPAWNING)
+            first.wait()
+        finally:
+            self.gridcentric.db = real_db
+            CONF.clear_override('gridcentric_db_retry_delay')
+
+        # The second update was merged into the retries of the first.
+        self.assertEquals(3, len(writes))
+        self.assertEquals({'vm_state': vm_states.ERROR, 'task_state': task_states.SPAWNING},
+                          writes[-1])
+        self.assertEquals({}, self.gridcentric.pending_updates)
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(vm_states.ERROR, instance['vm_state'])
+        self.assertEquals(task_states.SPAWNING, instance['task_state'])
+
+    def test_relieve_memory_pressure(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuid = utils.create_instance(self.context,
+                                              {'host': self.gridcentric.host,
+                                               'metadata': {'launched_from': blessed_uuid}})
+
+        host_memory = [(1000 << 20, 50 << 20)]
+        self.gridcentric._host_memory = lambda: host_memory[0]
+        CONF.set_override('gridcentric_memory_pressure', 0.1)
+        try:
+            # 50MB short of the wanted 100MB free, out of 200MB resident.
+            self.vmsconn.set_return_val("working_set", 200 << 20)
+            self.vmsconn.set_return_val("set_target", None)
+            self.gridcentric._relieve_memory_pressure(self.context)
+
+            metadata = db.instance_metadata_get(self.context, launched_uuid)
+            self.assertEquals(str(150 << 8), metadata['gc:target'])
+            self.assertEquals({launched_uuid: "0"}, self.gridcentric.pressure_targets)
+
+            # Once the pressure is gone the original target comes back.
+            host_memory[0] = (1000 << 20, 500 << 20)
+            self.vmsconn.set_return_val("set_target", None)
+            self.gridcentric._relieve_memory_pressure(self.context)
+
+            metadata = db.instance_metadata_get(self.context, launched_uuid)
+            self.assertEquals("0", metadata['gc:target'])
+            self.assertEquals({}, self.gridcentric.pressure_targets)
+        finally:
+            CONF.clear_override('gridcentric_memory_pressure')
+
+    def test_get_stats(self):
+
+        launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                           {'host': self.gridcentric.host})
+        self.vmsconn.set_return_val("stats", {'faults': 10, 'resident_pages': 100})
+
+        stats = self.gridcentric.get_stats(self.context, instance_uuid=launched_uuid)
+        self.assertEquals({'faults': 10, 'resident_pages': 100, 'host': self.gridcentric.host},
+                          stats)
+
+    def test_report_capabilities(self):
+
+        utils.create_compute_node(self.context, self.gridcentric.host, 1024)
+        utils.create_pre_launched_instance(self.context,
+                                           {'host': self.gridcentric.host,
+                                            'memory_mb': 512,
+                                            'metadata': {'gc:target': str(256 << 8)}})
+        utils.create_pre_launched_instance(self.context, {'host': self.gridcentric.host})
+        utils.create_pre_launched_instance(self.context, {'host': 'other-host'})
+
+        self.gridcentric._report_capabilities(self.context)
+
+        stats = {}
+        for compute_node in db.compute_node_get_all(self.context):
+            if compute_node['service']['host'] == self.gridcentric.host:
+                stats = dict([(stat['key'], stat['value']) for stat in compute_node['stats']])
+        self.assertEquals("2", stats['gridcentric_clones'])
+        self.assertEquals("256", stats['gridcentric_overcommit_mb'])
+        self.assertEquals("0", stats['gridcentric_memservers'])
+
+        # The stats come back after nova-compute drops them.
+        compute_node = [compute_node for compute_node in db.compute_node_get_all(self.context)
+                        if compute_node['service']['host'] == self.gridcentric.host][0]
+        db.compute_node_update(self.context, compute_node['id'], {'stats': {}}, prune_stats=True)
+        self.gridcentric._report_capabilities(self.context)
+        compute_node = db.compute_node_get(self.context, compute_node['id'])
+        stats = dict([(stat['key'], stat['value']) for stat in compute_node['stats']])
+        self.assertEquals("2", stats['gridcentric_clones'])
+
+    def test_get_stats_other_host(self):
+
+        launched_uuid = utils.create_pre_launched_instance(self.context, {'host': 'other-host'})
+        self.assertRaises(exception.NovaException, self.gridcentric.get_stats,
+                          self.context, instance_uuid=launched_uuid)
+
+    def test_serve_instance(self):
+
+        self.vmsconn.set_return_val("serve", None)
+        self.vmsconn.set_return_val("stop_serving", None)
+        self.gridcentric._get_migration_address = lambda dest: "eth0"
+        blessed_uuid = utils.create_blessed_instance(self.context)
+
+        memory_url = self.gridcentric.serve_instance(self.context, instance_uuid=blessed_uuid,
+                                                     dest="dest-host")
+        self.assertEquals("mcdist://eth0", memory_url)
+        self.assertTrue(memory_url in self.gridcentric.memory_servers)
+
+        # Servers that outlive their batch are stopped.
+        self.gridcentric.memory_servers[memory_url] -= 2 * CONF.gridcentric_fanout_timeout + 1
+        self.gridcentric._reap_memory_servers(self.context)
+        self.assertEquals({}, self.gridcentric.memory_servers)
+
+    def test_migration_address_cache(self):
+
+        resolved = []
+        def resolve(dest):
+            resolved.append(dest)
+            return "eth%d" % len(resolved)
+
+        cache = gc_manager.routes.RouteCache(300)
+        cache.monitor = None
+        self.assertEquals("eth1", cache.lookup("dest-host", resolve))
+        self.assertEquals("eth1", cache.lookup("dest-host", resolve))
+        self.assertEquals(["dest-host"], resolved)
+
+        # A route change drops the cached addresses.
+        class Monitor(object):
+            changes = ["route deleted"]
+            def recv(self, size):
+                if len(self.changes) == 0:
+                    raise socket.error(errno.EAGAIN, "no changes")
+                return self.changes.pop()
+        cache.monitor = Monitor()
+        self.assertEquals("eth2", cache.lookup("dest-host", resolve))
+        self.assertEquals("eth2", cache.lookup("dest-host", resolve))
+
+        # And so does time.
+        cache.ttl = 0
+        cache.entries.clear()
+        self.assertEquals("eth3", cache.lookup("dest-host", resolve))
+        self.assertEquals("eth4", cache.lookup("dest-host", resolve))
+
+    def test_refill_pool(self):
+
+        self.vmsconn.set_return_val("launch", None)
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                                        {'metadata': {'gc:pool_size': '1',
+                                                      'gc:pool_hosts': self.gridcentric.host}})
+
+        self.gridcentric._refill_pools(self.context)
+        # The pool is full, so a second pass should not launch anything.
+        self.gridcentric._refill_pools(self.context)
+
+        pooled_instances = db.instance_get_all_by_filters(self.context,
+                                                {'metadata': {'pooled_from': blessed_uuid},
+                                                 'deleted': False})
+        self.assertEquals(1, len(pooled_instances))
+        self.assertEquals(vm_states.PAUSED, pooled_instances[0]['vm_state'])
+        self.assertEquals(None, pooled_instances[0]['task_state'])
+        self.assertEquals(self.gridcentric.host, pooled_instances[0]['host'])
+
+    def test_refill_pool_other_host(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                                        {'metadata': {'gc:pool_size': '1',
+                                                      'gc:pool_hosts': 'other-host'}})
+
+        self.gridcentric._refill_pools(self.context)
+
+        pooled_instances = db.instance_get_all_by_filters(self.context,
+                                                {'metadata': {'pooled_from': blessed_uuid},
+                                                 'deleted': False})
+        self.assertEquals(0, len(pooled_instances))
+
+    def test_unpool_instance(self):
+
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pooled_instance(self.context,
+                                                   {'host': self.gridcentric.host},
+                                                   source_uuid=blessed_uuid)
+
+        pre_unpool_time = datetime.utcnow()
+        self.gridcentric.unpool_instance(self.context, instance_uuid=pooled_uuid)
+
+        instance = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(vm_states.ACTIVE, instance['vm_state'])
+        self.assertEquals(None, instance['task_state'])
+        self.assertTrue(pre_unpool_time <= instance['launched_at'])
+
+    def test_network_reservoir(self):
+
+        network = db.network_create_safe(self.context, {'uuid': utils.create_uuid(),
+                                                        'label': 'reservoir-test',
+                                                        'cidr': '10.0.0.0/29'})
+        for i in range(2, 6):
+            db.fixed_ip_create(self.context, {'address': '10.0.0.%d' % i,
+                                              'network_id': network['id']})
+
+        CONF.set_override('gridcentric_reservoir_networks', [network['uuid']])
+        CONF.set_override('gridcentric_reservoir_size', 2)
+        try:
+            self.gridcentric._refill_network_reservoir(self.context)
+
+            addresses = self.gridcentric.network_reservoir[network['uuid']]
+            self.assertEquals(2, len(addresses))
+            for address in addresses:
+                fixed_ip = db.fixed_ip_get_by_address(self.context, address)
+                self.assertEquals(self.gridcentric._reservoir_host(), fixed_ip['host'])
+
+            reserved_address = addresses[0]
+            requested_networks = self.gridcentric._claim_reserved_networks(self.context)
+            self.assertEquals([(network['uuid'], reserved_address)], requested_networks)
+            # The address stays out of the pool until the allocation has taken it.
+            fixed_ip = db.fixed_ip_get_by_address(self.context, reserved_address)
+            self.assertEquals(self.gridcentric._reservoir_host(), fixed_ip['host'])
+            self.gridcentric._release_claimed_addresses(self.context, requested_networks)
+            fixed_ip = db.fixed_ip_get_by_address(self.context, reserved_address)
+            self.assertEquals(None, fixed_ip['host'])
+
+            # The reservations left behind by a restart are picked up again.
+            self.gridcentric.network_reservoir = {}
+            self.gridcentric._recover_network_reservoir(self.context)
+            recovered = self.gridcentric.network_reservoir[network['uuid']]
+            self.assertTrue(addresses[0] in recovered)
+            self.assertFalse(reserved_address in recovered)
+
+            # Shrinking the reservoir releases the extra reservations.
+            CONF.set_override('gridcentric_reservoir_size', 0)
+            self.gridcentric._refill_network_reservoir(self.context)
+            self.assertEquals([], self.gridcentric.network_reservoir[network['uuid']])
+        finally:
+            CONF.clear_override('gridcentric_reservoir_networks')
+            CONF.clear_override('gridcentric_reservoir_size')
+
     def test_discard_a_blessed_instance(self):
         self.vmsconn.set_return_val("discard", None)
         blessed_uuid = utils.create_blessed_instance(self.context, source_uuid="UNITTEST_DISCARD")
@@ -274,6 +869,113 @@ class GridCentricManagerTestCase(unittest.TestCase):
             self.assertTrue(pre_discard_time <= discarded_instance['terminated_at'])
             self.assertEquals(vm_states.DELETED, discarded_instance['vm_state'])
 
+    def test_discard_releases_prewarmed_hosts(self):
+        self.vmsconn.set_return_val("discard", None)
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        db.instance_system_metadata_update(self.context, blessed_uuid,
+                                           {'gc_prewarmed_other-host': '1.0,%s' %
+                                                timeutils.strtime(),
+                                            'gc_prewarmed_%s' % self.gridcentric.host: '1.0,%s' %
+                                                timeutils.strtime()},
+                                           False)
+
+        self.mock_rpc.cast_log = []
+        self.gridcentric.discard_instance(self.context, instance_uuid=blessed_uuid)
+
+        # Only the other host is told, this one let go of the artifacts in the discard.
+        (queue, method, kwargs) = self.mock_rpc.cast_log.pop()
+        self.assertEquals('%s.other-host' % CONF.gridcentric_topic, queue)
+        self.assertEquals('release_prewarmed', method['method'])
+        self.assertEquals([], self.mock_rpc.cast_log)
+
+    def _journal_entry(self, operation, instance_uuid, **phases):
+        entry = journal.Entry(self.gridcentric.journal._entry_path(operation, instance_uuid),
+                              operation, instance_uuid)
+        for phase in ['start', 'blessed', 'uploaded', 'launched']:
+            if phase in phases:
+                entry.record(phase, **phases[phase])
+
+    def test_journal_cleared(self):
+        self.gridcentric.journal = journal.Journal(tempfile.mkdtemp())
+        try:
+            self.vmsconn.set_return_val("discard", None)
+            blessed_uuid = utils.create_blessed_instance(self.context)
+            self.gridcentric.discard_instance(self.context, instance_uuid=blessed_uuid)
+            self.assertEquals([], os.listdir(self.gridcentric.journal.path))
+        finally:
+            shutil.rmtree(self.gridcentric.journal.path)
+
+    def test_recover_launch(self):
+        self.gridcentric.journal = journal.Journal(tempfile.mkdtemp())
+        try:
+            launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                               {'vm_state': vm_states.BUILDING})
+            self._journal_entry('launch_instance', launched_uuid,
+                                start={'migration': False}, launched={})
+
+            self.gridcentric._recover_journal(self.context)
+
+            instance = db.instance_get_by_uuid(self.context, launched_uuid)
+            self.assertEquals(vm_states.ACTIVE, instance['vm_state'])
+            self.assertEquals(self.gridcentric.host, instance['host'])
+            self.assertEquals([], os.listdir(self.gridcentric.journal.path))
+        finally:
+            shutil.rmtree(self.gridcentric.journal.path)
+
+    def test_recover_migration_launched(self):
+        self.gridcentric.journal = journal.Journal(tempfile.mkdtemp())
+        orig_call = gc_manager.rpc.call
+        calls = []
+        def call(context, queue, msg, timeout=None):
+            calls.append((queue, msg['method']))
+            return True
+        gc_manager.rpc.call = call
+        try:
+            self.vmsconn.set_return_val("discard", None)
+            instance_uuid = utils.create_instance(self.context,
+                                                  {'host': self.gridcentric.host,
+                                                   'task_state': task_states.MIGRATING})
+            self._journal_entry('migrate_instance', instance_uuid, start={'dest': 'dest-host'},
+                                blessed={'migration_url': 'mcdist://url', 'network_info': []})
+
+            # The destination took the instance over, so it is not relaunched here.
+            self.gridcentric._recover_journal(self.context)
+
+            self.assertEquals([('%s.dest-host' % CONF.gridcentric_topic,
+                                'migration_launch_status')], calls)
+            self.assertEquals([], self.vmsconn.return_vals['discard'])
+            self.assertEquals([], os.listdir(self.gridcentric.journal.path))
+        finally:
+            gc_manager.rpc.call = orig_call
+            shutil.rmtree(self.gridcentric.journal.path)
+
+    def test_migration_launch_status(self):
+        migrated_uuid = utils.create_instance(self.context, {'host': self.gridcentric.host,
+                                                             'vm_state': vm_states.ACTIVE})
+        other_uuid = utils.create_instance(self.context, {'host': 'source-host',
+                                                          'vm_state': vm_states.ACTIVE})
+
+        self.assertTrue(self.gridcentric.migration_launch_status(self.context,
+                                                                 instance_uuid=migrated_uuid))
+        self.assertFalse(self.gridcentric.migration_launch_status(self.context,
+                                                                  instance_uuid=other_uuid))
+
+    def test_recover_bless_rollback(self):
+        self.gridcentric.journal = journal.Journal(tempfile.mkdtemp())
+        try:
+            self.vmsconn.set_return_val("discard", None)
+            self.vmsconn.set_return_val("bless_cleanup", None)
+            blessed_uuid = utils.create_pre_blessed_instance(self.context)
+            self._journal_entry('bless_instance', blessed_uuid, start={'migration': False})
+
+            self.gridcentric._recover_journal(self.context)
+
+            instance = db.instance_get_by_uuid(self.context, blessed_uuid)
+            self.assertEquals(vm_states.ERROR, instance['vm_state'])
+            self.assertEquals([], os.listdir(self.gridcentric.journal.path))
+        finally:
+            shutil.rmtree(self.gridcentric.journal.path)
+
     def test_reset_host_different_host_instance(self):
 
         host = "test-host"
@@ -380,3 +1082,172 @@ class GridCentricManagerTestCase(unittest.TestCase):
         self.assertEquals(dst_host, instance['host'])
         self.assertEquals(None, instance['task_state'])
         self.assertEquals(vm_states.ERROR, instance['vm_state'])
+
+    def test_lifecycle_event_started_src(self):
+
+        src_host = "src-test-host"
+        dst_host = "dst-test-host"
+        instance_uuid = utils.create_instance(self.context,
+                                             {'task_state':task_states.MIGRATING,
+                                              'host': src_host,
+                                              'metadata': {'gc_src_host': src_host,
+                                                           'gc_dst_host': dst_host}})
+        self.gridcentric.host = src_host
+        self.gridcentric._handle_lifecycle_event(
+                virtevent.LifecycleEvent(instance_uuid, virtevent.EVENT_LIFECYCLE_STARTED))
+
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(src_host, instance['host'])
+        self.assertEquals(vm_states.ACTIVE, instance['vm_state'])
+        self.assertEquals(None, instance['task_state'])
+
+    def test_lifecycle_event_stopped_dst(self):
+
+        src_host = "src-test-host"
+        dst_host = "dst-test-host"
+        instance_uuid = utils.create_instance(self.context,
+                                             {'task_state':task_states.MIGRATING,
+                                              'host': dst_host,
+                                              'metadata': {'gc_src_host': src_host,
+                                                           'gc_dst_host': dst_host}})
+        self.gridcentric.host = dst_host
+        self.gridcentric._handle_lifecycle_event(
+                virtevent.LifecycleEvent(instance_uuid, virtevent.EVENT_LIFECYCLE_STOPPED))
+
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(vm_states.ERROR, instance['vm_state'])
+        self.assertEquals(None, instance['task_state'])
+
+    def test_lifecycle_events_only_with_libvirt(self):
+
+        # The fake driver accepts listeners but never emits any event.
+        self.gridcentric._register_lifecycle_events()
+        self.assertFalse(self.gridcentric.lifecycle_events)
+
+    def test_refresh_host_with_lifecycle_events(self):
+
+        host = "test-host"
+        instance_uuid = utils.create_instance(self.context,
+                                             {'task_state':task_states.MIGRATING,
+                                              'host': host,
+                                              'metadata': {'gc_src_host': 'src-test-host',
+                                                           'gc_dst_host': host}})
+        self.gridcentric.host = host
+        self.gridcentric.lifecycle_events = True
+
+        # With lifecycle events the full scan only runs every few ticks.
+        for i in range(CONF.gridcentric_refresh_host_ticks - 1):
+            self.gridcentric._refresh_host(self.context)
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(task_states.MIGRATING, instance['task_state'])
+
+        self.gridcentric._refresh_host(self.context)
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(vm_states.ERROR, instance['vm_state'])
+
+    def test_evacuate_host(self):
+
+        service = db.service_create(self.context, {'host': self.gridcentric.host,
+                                                   'binary': 'nova-gridcentric',
+                                                   'topic': 'gridcentric'})
+        dest = 'evacuation-dest'
+        instance_uuids = [utils.create_instance(self.context, {'host': self.gridcentric.host})
+                          for i in range(3)]
+
+        migrating = []
+        concurrency = []
+        def fake_migrate_instance(context, instance_uuid=None, dest=None):
+            migrating.append(instance_uuid)
+            concurrency.append(len(migrating))
+            greenthread.sleep(0)
+            db.instance_update(context, instance_uuid, {'host': dest, 'task_state': None})
+            migrating.remove(instance_uuid)
+        self.gridcentric.migrate_instance = fake_migrate_instance
+        self.gridcentric.gridcentric_api.find_migration_target = \
+            lambda context, instance_ref, dest_host: dest
+
+        self.gridcentric.evacuate_host(self.context, parallelism=2)
+
+        status = self.gridcentric.evacuation_status(self.context)
+        self.assertTrue(status['done'])
+        self.assertEquals(3, status['total'])
+        self.assertEquals(0, status['pending'])
+        self.assertEquals(sorted(instance_uuids), sorted(status['completed']))
+        self.assertEquals({}, status['failed'])
+        self.assertEquals(2, max(concurrency))
+        for instance_uuid in instance_uuids:
+            self.assertEquals(dest, db.instance_get_by_uuid(self.context, instance_uuid)['host'])
+
+        # The host is drained, so it is no longer picked as a migration target.
+        self.assertTrue(db.service_get(self.context, service['id'])['disabled'])
+
+    def test_evacuate_host_all_failed(self):
+
+        service = db.service_create(self.context, {'host': self.gridcentric.host,
+                                                   'binary': 'nova-gridcentric',
+                                                   'topic': 'gridcentric'})
+        utils.create_instance(self.context, {'host': self.gridcentric.host})
+
+        def failing_migrate_instance(context, instance_uuid=None, dest=None):
+            raise utils.TestInducedException()
+        self.gridcentric.migrate_instance = failing_migrate_instance
+        self.gridcentric.gridcentric_api.find_migration_target = \
+            lambda context, instance_ref, dest_host: 'evacuation-dest'
+
+        self.gridcentric.evacuate_host(self.context)
+
+        # Nothing left the host, so it takes new instances again.
+        self.assertEquals(1, len(self.gridcentric.evacuation_status(self.context)['failed']))
+        self.assertFalse(db.service_get(self.context, service['id'])['disabled'])
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_stack_key_rpc_method(self):
+
+        def _process_data(method):
+            return profiler.stack_key(sys._getframe(), True)
+
+        stack = _process_data('launch_instance')
+        self.assertTrue(stack.startswith('rpc:launch_instance;'))
+        self.assertTrue(stack.endswith(';test_manager.py:_process_data'))
+
+    def test_stack_key_unknown(self):
+
+        self.assertTrue(profiler.stack_key(sys._getframe(), True).startswith('other;'))
+        self.assertTrue(profiler.stack_key(sys._getframe(), False).startswith('thread;'))
+
+    def test_profile_file(self):
+
+        profile_dir = tempfile.mkdtemp()
+        CONF.set_override('gridcentric_profile_dir', profile_dir)
+        try:
+            profile = profiler.Profiler()
+            path = profile.start(seconds=0, interval=0.01)
+
+            # The file is created right away, by this process and for it only.
+            self.assertEquals(0600, os.stat(path).st_mode & 0777)
+            while profile.path != None:
+                greenthread.sleep(0.01)
+            self.assertEquals([os.path.basename(path)], os.listdir(profile_dir))
+        finally:
+            CONF.clear_override('gridcentric_profile_dir')
+            shutil.rmtree(profile_dir)
+
+    def test_profile_file_exists(self):
+
+        profile_dir = tempfile.mkdtemp()
+        CONF.set_override('gridcentric_profile_dir', profile_dir)
+        orig_getpid = profiler.os.getpid
+        profiler.os.getpid = lambda: 'planted'
+        try:
+            # Whatever is already there (e.g. a symlink) is not written through.
+            target = os.path.join(profile_dir, 'target')
+            for seconds in range(-1, 2):
+                os.symlink(target, os.path.join(profile_dir, 'nova-gc-planted-%d.folded' %
+                                                (profiler.time.time() + seconds)))
+            self.assertRaises(OSError, profiler.Profiler().start, 0, 0.01)
+            self.assertFalse(os.path.exists(target))
+        finally:
+            profiler.os.getpid = orig_getpid
+            CONF.clear_override('gridcentric_profile_dir')
+            shutil.rmtree(profile_dir)
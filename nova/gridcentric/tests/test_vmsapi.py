@@ -29,3 +29,71 @@ class GridCentricApiTestCase(unittest.TestCase):
         # Simply verify that we can push a value into the config Management
         config = self.vmsapi.config()
         config.MANAGEMENT['test-value'] = "testvalue"
+
+class MockArguments(object):
+
+    def __init__(self):
+        self.params = {}
+        self.options = {}
+
+    def add_param(self, key, value):
+        self.params[key] = value
+
+    def add_option(self, key, value):
+        self.options[key] = value
+
+class VmsApiLaunchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.launches = []
+        self.orig_launch = vms_api.commands.launch
+        self.orig_arguments = vms_api.vmsrun.Arguments
+        vms_api.commands.launch = lambda *args, **kwargs: self.launches.append(kwargs)
+        vms_api.vmsrun.Arguments = MockArguments
+
+    def tearDown(self):
+        vms_api.commands.launch = self.orig_launch
+        vms_api.vmsrun.Arguments = self.orig_arguments
+
+    def assert_vms_options(self, vmsapi):
+        vmsapi.launch('blessed', 'launched', 0, '/path', guest_params={'key': 'value'},
+                      vms_options={'memory.policy': 'some-policy', 'memory.prefetch': ''})
+        vms_args = self.launches.pop()['vmsargs']
+        self.assertEquals({'key': 'value'}, vms_args.params)
+        # Options without a value are left out.
+        self.assertEquals({'memory.policy': 'some-policy'}, vms_args.options)
+
+    def test_launch_vms_options(self):
+        self.assert_vms_options(vms_api.VmsApi())
+
+    def test_launch_vms_options_26(self):
+        self.assert_vms_options(vms_api.VmsApi26())
+
+class MockControl(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, key):
+        return self.name
+
+class VmsApiControlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.probed = []
+        self.orig_probe = vms_api.control.probe
+        vms_api.control.probe = lambda: self.probed
+        self.vmsapi = vms_api.VmsApi()
+
+    def tearDown(self):
+        vms_api.control.probe = self.orig_probe
+
+    def test_find_control_prunes(self):
+        self.probed = [MockControl('instance-1'), MockControl('instance-2')]
+        self.vmsapi._find_control('instance-1')
+        self.assertEquals(['instance-1', 'instance-2'], sorted(self.vmsapi.controls.keys()))
+
+        # The controls of the instances that are gone are dropped on the next probe.
+        self.probed = [MockControl('instance-3')]
+        self.vmsapi._find_control('instance-3')
+        self.assertEquals(['instance-3'], self.vmsapi.controls.keys())
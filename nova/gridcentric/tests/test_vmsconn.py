@@ -0,0 +1,146 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import tempfile
+import unittest
+
+from eventlet import greenthread
+
+from oslo.config import cfg
+
+from gridcentric.nova.extension import metrics
+import gridcentric.nova.extension.vmsconn as vmsconn
+import gridcentric.tests.utils as utils
+
+CONF = cfg.CONF
+
+class MockFirewallDriver(object):
+
+    def __init__(self):
+        self.call_log = []
+
+    def filter_defer_apply_on(self):
+        self.call_log.append('defer_on')
+
+    def filter_defer_apply_off(self):
+        self.call_log.append('defer_off')
+
+    def apply_instance_filter(self, instance_ref, network_info):
+        if instance_ref['name'] == 'bad-instance':
+            raise utils.TestInducedException()
+        self.call_log.append(instance_ref['name'])
+
+class FirewallBatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.firewall_driver = MockFirewallDriver()
+
+    def test_no_window(self):
+        batcher = vmsconn.FirewallBatcher(self.firewall_driver, 0)
+        batcher.apply_instance_filter({'name': 'instance-1'}, None)
+        self.assertEquals(['instance-1'], self.firewall_driver.call_log)
+
+    def test_batched(self):
+        batcher = vmsconn.FirewallBatcher(self.firewall_driver, 0.01)
+        threads = [greenthread.spawn(batcher.apply_instance_filter,
+                                     {'name': 'instance-%s' % i}, None) for i in range(3)]
+        for thread in threads:
+            thread.wait()
+
+        self.assertEquals(['defer_on', 'instance-0', 'instance-1', 'instance-2', 'defer_off'],
+                          self.firewall_driver.call_log)
+
+    def test_batched_error(self):
+        batcher = vmsconn.FirewallBatcher(self.firewall_driver, 0.01)
+        good_thread = greenthread.spawn(batcher.apply_instance_filter,
+                                        {'name': 'instance-1'}, None)
+        bad_thread = greenthread.spawn(batcher.apply_instance_filter,
+                                       {'name': 'bad-instance'}, None)
+
+        good_thread.wait()
+        try:
+            bad_thread.wait()
+            self.fail("The firewall error should have been re-raised to the launch.")
+        except utils.TestInducedException:
+            pass
+        self.assertEquals(['defer_on', 'instance-1', 'defer_off'], self.firewall_driver.call_log)
+
+class PrewarmTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vms_conn = vmsconn.VmsConnection(None)
+        self.artifacts = []
+        for i in range(2):
+            (fd, path) = tempfile.mkstemp()
+            os.write(fd, 'x' * (1 << 20))
+            os.close(fd)
+            self.artifacts.append(path)
+
+    def tearDown(self):
+        for artifact in self.vms_conn.locked_artifacts.values():
+            artifact.close()
+        for path in self.artifacts:
+            os.unlink(path)
+
+    def test_prewarm(self):
+        residency = self.vms_conn.prewarm(None, {'name': 'blessed'}, self.artifacts)
+        self.assertEquals(1.0, residency)
+        self.assertEquals({}, self.vms_conn.locked_artifacts)
+
+    def test_prewarm_mlock_budget(self):
+        CONF.set_override('gridcentric_prewarm_mlock_budget', 1)
+        try:
+            self.vms_conn.prewarm(None, {'name': 'blessed'}, self.artifacts, mlock=True)
+        finally:
+            CONF.clear_override('gridcentric_prewarm_mlock_budget')
+
+        # Only one of the artifacts fits within the budget.
+        self.assertEquals([self.artifacts[0]], self.vms_conn.locked_artifacts.keys())
+
+    def test_release_prewarmed(self):
+        CONF.set_override('gridcentric_prewarm_mlock_budget', 2)
+        try:
+            self.vms_conn.prewarm(None, {'name': 'blessed'}, self.artifacts, mlock=True)
+        finally:
+            CONF.clear_override('gridcentric_prewarm_mlock_budget')
+
+        self.vms_conn.release_prewarmed(self.artifacts)
+        self.assertEquals({}, self.vms_conn.locked_artifacts)
+        self.assertEquals(set(), self.vms_conn.prewarmed_artifacts)
+
+class TraceCallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metrics.VMS_CALLS.histograms.clear()
+
+    def test_trace_call(self):
+
+        class Traced(object):
+            @vmsconn._trace_call
+            def call(self, fail=False):
+                if fail:
+                    raise utils.TestInducedException()
+                return 'result'
+
+        traced = Traced()
+        self.assertEquals('result', traced.call())
+        self.assertEquals('result', traced.call())
+        self.assertRaises(utils.TestInducedException, traced.call, fail=True)
+
+        histograms = metrics.VMS_CALLS.histograms
+        self.assertEquals(2, histograms[('call', 'ok')].count)
+        self.assertEquals(1, histograms[('call', 'error')].count)
+        self.assertEquals(2, sum(histograms[('call', 'ok')].counts))
@@ -64,6 +64,8 @@ class MockVmsConn(object):
     """
     def __init__(self):
         self.return_vals = {}
+        self.target_supported = True
+        self.prewarmed_artifacts = set()
 
     def set_return_val(self, method, value):
         values = self.return_vals.get(method, [])
@@ -93,13 +95,45 @@ class MockVmsConn(object):
         return self.pop_return_value("bless_cleanup")
 
     def discard(self, context, instance_name, use_image_service=False, image_refs=[]):
+        self.discard_image_refs = image_refs
         return self.pop_return_value("discard")
 
     def launch(self, context, instance_name, new_instance_ref,
                network_info, skip_image_service=False, target=0,
-               migration_url=None, image_refs=[], params={}):
+               migration_url=None, image_refs=[], params={}, vms_policy='', memory_url=None,
+               prefetch_ref=None):
+        self.launch_image_refs = image_refs
+        self.launch_vms_policy = vms_policy
+        self.launch_prefetch_ref = prefetch_ref
         return self.pop_return_value("launch")
 
+    def abort_launch(self, context, instance_name):
+        return self.pop_return_value("abort_launch")
+
+    def serve(self, context, instance_name, instance_ref, memory_url, image_refs=[]):
+        return self.pop_return_value("serve")
+
+    def stop_serving(self, context, memory_url):
+        return self.pop_return_value("stop_serving")
+
+    def set_target(self, context, instance_ref, target):
+        return self.pop_return_value("set_target")
+
+    def supports_target(self):
+        return self.target_supported
+
+    def working_set(self, context, instance_ref):
+        return self.pop_return_value("working_set")
+
+    def stats(self, context, instance_ref):
+        return self.pop_return_value("stats")
+
+    def capture_prefetch_profile(self, context, instance_ref, blessed_ref):
+        return self.pop_return_value("capture_prefetch_profile")
+
+    def release_prewarmed(self, image_refs):
+        self.prewarmed_artifacts.difference_update(image_refs)
+
     def replug(self, instance_name, mac_addresses):
         return self.pop_return_value("replug")
 
@@ -201,13 +235,45 @@ def create_pre_launched_instance(context, instance=None, source_uuid=None):
 
     return create_instance(context, instance)
 
+def create_pooled_instance(context, instance=None, source_uuid=None):
+
+    if source_uuid == None:
+        source_uuid = create_blessed_instance(context)
+    if instance == None:
+        instance = {}
+
+    instance['vm_state'] = vm_states.PAUSED
+    metadata = instance.get('metadata', {})
+    metadata['pooled_from'] = source_uuid
+    instance['metadata'] = metadata
+
+    return create_instance(context, instance)
+
 def fake_networkinfo(*args, **kwargs):
     return network_model.NetworkInfo()
 
-def create_gridcentric_service(context):
+def create_gridcentric_service(context, host=None):
+    if host == None:
+        host = create_uuid()
     service = {'name': 'gridcentric-test-service',
                'topic': 'gridcentric',
-               'host': create_uuid()
+               'host': host
                }
-    db.service_create(context, service)
-    return service
+    return db.service_create(context, service)
+
+def create_compute_node(context, host, free_ram_mb):
+    service = db.service_create(context, {'name': 'compute-test-service',
+                                          'topic': 'compute',
+                                          'host': host})
+    return db.compute_node_create(context, {'service_id': service['id'],
+                                            'vcpus': 1,
+                                            'memory_mb': free_ram_mb,
+                                            'local_gb': 10,
+                                            'vcpus_used': 0,
+                                            'memory_mb_used': 0,
+                                            'local_gb_used': 0,
+                                            'free_ram_mb': free_ram_mb,
+                                            'free_disk_gb': 10,
+                                            'hypervisor_type': 'fake',
+                                            'hypervisor_version': 1,
+                                            'cpu_info': ''})
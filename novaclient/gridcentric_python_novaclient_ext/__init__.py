@@ -79,12 +79,21 @@ def _find_server(cs, server):
 #### ACTIONS ####
 
 @utils.arg('blessed_server', metavar='<blessed instance>', help="ID or name of the blessed instance")
-@utils.arg('--target', metavar='<target memory>', default='0', help="The memory target of the launched instance")
+@utils.arg('--target', metavar='<target memory>', default='0', help="The memory target of the launched instance, or 'auto' for a target learned from earlier clones")
 @utils.arg('--name', metavar='<instance name>', default=None, help='The name of the launched instance')
 @utils.arg('--user_data', metavar='<user-data>', default=None,
            help='User data file to pass to be exposed by the metadata server')
 @utils.arg('--security-groups', metavar='<security groups>', default=None, help='comma separated list of security group names.')
 @utils.arg('--params', action='append', default=[], metavar='<key=value>', help='Guest parameters to send to vms-agent')
+@utils.arg('--vms-policy', metavar='<policy profile>', default=None,
+           help='The vms memory policy profile of the launched instance (e.g. latency-first, '
+                'balanced or density-first)')
+@utils.arg('--hosts', metavar='<hosts>', default=None,
+           help='Comma separated list of hosts to launch one instance on each. The memory of the '
+                'blessed instance is sent to all of them at once.')
+@utils.arg('--idempotency-key', metavar='<key>', default=None,
+           help='A unique key for this launch. Repeating the launch with the same key returns '
+                'the instances of the first launch instead of launching again.')
 def do_launch(cs, args):
     """Launch a new instance."""
     server = _find_server(cs, args.blessed_server)
@@ -104,21 +113,32 @@ def do_launch(cs, args):
     else:
         security_groups = None
 
+    if args.hosts:
+        hosts = args.hosts.split(',')
+    else:
+        hosts = None
+
     launch_servers = cs.gridcentric.launch(server,
                                            target=args.target,
                                            name=args.name,
                                            user_data=user_data,
                                            guest_params=guest_params,
-                                           security_groups=security_groups)
+                                           security_groups=security_groups,
+                                           hosts=hosts,
+                                           vms_policy=args.vms_policy,
+                                           idempotency_key=args.idempotency_key)
 
     for server in launch_servers:
         _print_server(cs, server)
 
 @utils.arg('server', metavar='<instance>', help="ID or name of the instance to bless")
+@utils.arg('--idempotency-key', metavar='<key>', default=None,
+           help='A unique key for this bless. Repeating the bless with the same key returns '
+                'the blessed instance of the first bless instead of blessing again.')
 def do_bless(cs, args):
     """Bless an instance."""
     server = _find_server(cs, args.server)
-    blessed_servers = cs.gridcentric.bless(server)
+    blessed_servers = cs.gridcentric.bless(server, idempotency_key=args.idempotency_key)
     for server in blessed_servers:
         _print_server(cs, server)
 
@@ -135,6 +155,58 @@ def do_gc_migrate(cs, args):
     server = _find_server(cs, args.server)
     cs.gridcentric.migrate(server, args.dest)
 
+@utils.arg('server', metavar='<instance>', help="ID or name of the migrating instance")
+def do_gc_migrate_cancel(cs, args):
+    """Cancel the migration of an instance."""
+    server = _find_server(cs, args.server)
+    cs.gridcentric.migrate_cancel(server)
+
+@utils.arg('server', metavar='<instance>', help="ID or name of the launched instance")
+def do_gc_stats(cs, args):
+    """Show the vms memory counters of a launched instance."""
+    server = _find_server(cs, args.server)
+    utils.print_dict(cs.gridcentric.stats(server))
+
+@utils.arg('blessed_server', metavar='<blessed instance>', help="ID or name of the blessed instance")
+@utils.arg('--hosts', metavar='<hosts>', default=None,
+           help='Comma separated list of hosts to pre-warm (all hosts by default)')
+@utils.arg('--mlock', action='store_true', default=False,
+           help='Lock the artifacts in memory (within the budget of each host)')
+def do_gc_prewarm(cs, args):
+    """Load the artifacts of a blessed instance into the page cache of hosts."""
+    server = _find_server(cs, args.blessed_server)
+    if args.hosts:
+        hosts = args.hosts.split(',')
+    else:
+        hosts = None
+    cs.gridcentric.prewarm(server, hosts=hosts, mlock=args.mlock)
+
+@utils.arg('server', metavar='<instance>', help="ID or name of the launched instance")
+@utils.arg('target', metavar='<target memory>', help="The new memory target, or 0 for none")
+def do_gc_set_target(cs, args):
+    """Change the memory target of a launched instance."""
+    server = _find_server(cs, args.server)
+    cs.gridcentric.set_target(server, args.target)
+
+@utils.arg('host', metavar='<host>', help="Host to evacuate")
+@utils.arg('--parallelism', metavar='<parallelism>', default=None, type=int,
+           help="The number of instances to migrate at the same time")
+def do_gc_evacuate(cs, args):
+    """Migrate all instances off a host using VMS."""
+    cs.gridcentric.evacuate(args.host, parallelism=args.parallelism)
+
+@utils.arg('host', metavar='<host>', help="Host being evacuated")
+def do_gc_evacuation_status(cs, args):
+    """Show the progress of a host evacuation."""
+    status = cs.gridcentric.evacuation_status(args.host)
+    if status == None:
+        print "Host %s has not been evacuated." % args.host
+        return
+    status['failed'] = ', '.join(['%s (%s)' % item for item in status['failed'].items()])
+    status['completed'] = ', '.join(status['completed'])
+    status['migrating'] = ', '.join(status['migrating'])
+    utils.print_dict(status)
+
 def _print_list(servers):
     id_col = 'ID'
     columns = [id_col, 'Name', 'Status', 'Networks']
@@ -292,11 +364,13 @@ class GcServer(servers.Server):
     A server object extended to provide gridcentric capabilities
     """
 
-    def launch(self, target="0", name=None, user_data=None, guest_params={}, security_groups=None):
-        return self.manager.launch(self, target, name, user_data, guest_params, security_groups)
+    def launch(self, target="0", name=None, user_data=None, guest_params={}, security_groups=None,
+               hosts=None, vms_policy=None, idempotency_key=None):
+        return self.manager.launch(self, target, name, user_data, guest_params, security_groups,
+                                   hosts, vms_policy, idempotency_key)
 
-    def bless(self):
-        return self.manager.bless(self)
+    def bless(self, idempotency_key=None):
+        return self.manager.bless(self, idempotency_key=idempotency_key)
 
     def discard(self):
         self.manager.discard(self)
@@ -304,6 +378,18 @@ class GcServer(servers.Server):
     def migrate(self, dest=None):
         self.manager.migrate(self, dest)
 
+    def migrate_cancel(self):
+        self.manager.migrate_cancel(self)
+
+    def set_target(self, target):
+        self.manager.set_target(self, target)
+
+    def prewarm(self, hosts=None, mlock=False):
+        self.manager.prewarm(self, hosts=hosts, mlock=mlock)
+
+    def stats(self):
+        return self.manager.stats(self)
+
     def list_launched(self):
         return self.manager.list_launched(self)
 
@@ -323,7 +409,8 @@ class GcServerManager(servers.ServerManager):
         if not(hasattr(client, 'gridcentric')):
             setattr(client, 'gridcentric', self)
 
-    def launch(self, server, target="0", name=None, user_data=None, guest_params={}, security_groups=None):
+    def launch(self, server, target="0", name=None, user_data=None, guest_params={}, security_groups=None,
+               hosts=None, vms_policy=None, idempotency_key=None):
         params = {'target': target,
                   'guest': guest_params,
                   'security_groups': security_groups}
@@ -331,6 +418,15 @@ class GcServerManager(servers.ServerManager):
         if name != None:
             params['name'] = name
 
+        if hosts:
+            params['hosts'] = hosts
+
+        if vms_policy:
+            params['vms_policy'] = vms_policy
+
+        if idempotency_key:
+            params['idempotency_key'] = idempotency_key
+
         if user_data:
             if hasattr(user_data, 'read'):
                 real_user_data = user_data.read()
@@ -344,8 +440,11 @@ class GcServerManager(servers.ServerManager):
         header, info = self._action("gc_launch", base.getid(server), params)
         return [self.get(server['id']) for server in info]
 
-    def bless(self, server):
-        header, info = self._action("gc_bless", base.getid(server))
+    def bless(self, server, idempotency_key=None):
+        params = None
+        if idempotency_key:
+            params = {'idempotency_key': idempotency_key}
+        header, info = self._action("gc_bless", base.getid(server), params)
         return [self.get(server['id']) for server in info]
 
     def discard(self, server):
@@ -357,6 +456,32 @@ class GcServerManager(servers.ServerManager):
             params['dest'] = dest
         return self._action("gc_migrate", base.getid(server), params)
 
+    def migrate_cancel(self, server):
+        return self._action("gc_migrate_cancel", base.getid(server))
+
+    def set_target(self, server, target):
+        return self._action("gc_set_target", base.getid(server), {'target': target})
+
+    def stats(self, server):
+        header, info = self._action("gc_stats", base.getid(server))
+        return info
+
+    def prewarm(self, server, hosts=None, mlock=False):
+        params = {'mlock': mlock}
+        if hosts:
+            params['hosts'] = hosts
+        return self._action("gc_prewarm", base.getid(server), params)
+
+    def evacuate(self, host, parallelism=None):
+        body = {'evacuate': {}}
+        if parallelism != None:
+            body['evacuate']['parallelism'] = parallelism
+        return self.api.client.post("/gchosts/%s/evacuate" % host, body=body)
+
+    def evacuation_status(self, host):
+        header, info = self.api.client.get("/gchosts/%s" % host)
+        return info['evacuation']
+
     def list_launched(self, server):
         header, info = self._action("gc_list_launched", base.getid(server))
         return [self.get(server['id']) for server in info]